@@ -33,6 +33,8 @@ class XPSException(Exception):
 class XPS:
     # Defines
     MAX_NB_SOCKETS = 100
+    RECV_BUFFER_SIZE = 4096
+    END_OF_API = b',EndOfAPI'
 
     # Global variables
     __sockets = {}
@@ -66,20 +68,35 @@ class XPS:
     @withValidSocket
     def __sendAndReceive (self, socketId, command):
         # print("SEND REC ", command, type(command))
+        # The reply is read into a buffer that grows by doubling, and only
+        # the newly received bytes are searched for the terminator, so long
+        # replies (e.g. gathering data) are read in linear time.
         try:
-            XPS.__sockets[socketId].send(six.b(command))
-            ret = bytes2str(XPS.__sockets[socketId].recv(1024))
-            while (ret.find(',EndOfAPI') == -1):
-                ret += bytes2str(XPS.__sockets[socketId].recv(1024))
+            sock = XPS.__sockets[socketId]
+            sock.send(six.b(command))
+
+            buf = bytearray(self.RECV_BUFFER_SIZE)
+            nbytes = 0
+            end = -1
+            while end == -1:
+                if nbytes == len(buf):
+                    buf.extend(bytearray(len(buf)))
+
+                nrecv = sock.recv_into(memoryview(buf)[nbytes:])
+                if nrecv == 0:
+                    raise socket.error('Connection closed by the XPS')
+
+                end = buf.find(self.END_OF_API,
+                    max(nbytes-len(self.END_OF_API)+1, 0), nbytes+nrecv)
+                nbytes += nrecv
         except socket.timeout:
             return [-2, '']
         except socket.error as err: #  (errNb, errString):
             print( 'Socket error : ', err.errno, err)
             return [-2, '']
 
-        for i in range(len(ret)):
-            if (ret[i] == ','):
-                return [int(ret[0:i]), ret[i+1:-9]]
+        err, _, ret = bytes2str(bytes(buf[:end])).partition(',')
+        return [int(err), ret]
 
     def Send(self, socketId=None, cmd=None, check=False):
         """send and receive command cmd from socketId
@@ -1632,11 +1649,9 @@ class XPS:
         if (error != 0):
             return [error, returnedString]
 
-        i, j, retList = 0, 0, [error]
-        while ((i+j) < len(returnedString) and returnedString[i+j] != ','):
-            j += 1
-        retList.append(eval(returnedString[i:i+j]))
-        return retList
+        # The file name is returned unquoted, so it can't be eval'd
+        fileName, _, element = returnedString.partition(',')
+        return [error, fileName, int(element)]
 
     # MultipleAxesPVTPulseOutputSet :  Configure pulse output on trajectory
     def MultipleAxesPVTPulseOutputSet (self, socketId, GroupName, StartElement, EndElement, TimeInterval):
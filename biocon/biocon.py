@@ -244,6 +244,11 @@ if __name__ == '__main__':
         'sc_vac_pv'             : '18ID:VAC:D:ScatterChamber',
         'local_dir_root'        : '/nas_data/Pilatus1M',
         'remote_dir_root'       : '/nas_data',
+        'log_flush_interval'    : 1, #Max time (s) exposure log values are buffered
+        'log_flush_size'        : 65536, #Max characters of buffered log values
+        'arm_timeout'           : 1, #Max wait in s for the detector to arm before triggering
+        'dark_current_ttl'      : 60, #Time in s cached dark currents are used before being read again
+        'slow_shutter_open_time': 0.1, #Min wait in s between opening the slow shutter and triggering
         'struck_log_vals'       : [{'mx_record': 'mcs3', 'channel': 2, 'name': 'I0',
             'scale': 1, 'offset': 0, 'dark': True, 'norm_time': False}, #Format: (mx_record_name, struck_channel, header_name, scale, offset, use_dark_current, normalize_by_exp_time)
             {'mx_record': 'mcs4', 'channel': 3, 'name': 'I1', 'scale': 1,
@@ -289,7 +294,8 @@ if __name__ == '__main__':
         'remote_pump_ip'        : '164.54.204.53',
         'remote_pump_port'      : '5556',
         'remote_fm_ip'          : '164.54.204.53',
-        'remote_fm_port'        : '5557',
+        'remote_fm_port'        : '5556',
+        'remote_telemetry_port' : '5559',
         'flow_units'            : 'mL/min',
         'sheath_pump'           : ('VICI_M50', 'COM3', [628.2, 13.051], {}),
         'outlet_pump'           : ('VICI_M50', 'COM4', [629.16, 12.354], {}),
@@ -332,6 +338,13 @@ if __name__ == '__main__':
         'pco_direction'         : 'x',
         'pco_pulse_width'       : D('10'), #In microseconds, opt: 0.2, 1, 2.5, 10
         'pco_encoder_settle_t'  : D('0.075'), #In microseconds, opt: 0.075, 1, 4, 12
+        'xps_gathering'         : False, #Record XPS positions during scans
+        'xps_gathering_quantities': ['CurrentPosition'],
+        'xps_gathering_divisor' : 10, #Gather every N 10 kHz XPS servo cycles
+        'pvt_mode'              : False, #Run all scan passes as one XPS PVT trajectory, needs a MultipleAxes group
+        'pvt_serpentine'        : True, #Alternate pass directions in PVT mode
+        'xps_ftp_user'          : 'Administrator',
+        'xps_ftp_password'      : '', #Set for the local controller, not kept in the repository
         # 'encoder_resolution'    : D('0.000001'), #for XMS160, in mm
         # 'encoder_precision'     : 6, #Number of significant decimals in encoder value
         'encoder_resolution'    : D('0.00001'), #for GS30V, in mm
@@ -344,9 +357,10 @@ if __name__ == '__main__':
         'remote_pump_ip'        : '164.54.204.8',
         'remote_pump_port'      : '5556',
         'remote_fm_ip'          : '164.54.204.8',
-        'remote_fm_port'        : '5557',
+        'remote_fm_port'        : '5556',
         'remote_valve_ip'       : '164.54.204.8',
-        'remote_valve_port'     : '5558',
+        'remote_valve_port'     : '5556',
+        'remote_telemetry_port' : '5559',
         'device_communication'  : 'remote',
         'injection_valve'       : [('Rheodyne', 'COM6', [], {'positions' : 2}, 'Injection'),],
         'sample_valve'          : [('Rheodyne', 'COM7', [], {'positions' : 6}, 'Sample'),],
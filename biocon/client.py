@@ -24,7 +24,8 @@ from io import open
 
 import threading
 import logging
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import Future
 import traceback
 import time
 import sys
@@ -34,10 +35,30 @@ if __name__ != '__main__':
 
 import zmq
 
+import commthread
+import netcodec
+
+
+_NO_ANSWER = object()
 
 class ControlClient(threading.Thread):
     """
-
+    Sends device commands to a :py:class:`server.ControlServer`. The client
+    uses a DEALER socket, so several clients can share one server.
+
+    Each request carries an ``id`` which the server returns with the answer,
+    so answers are matched to the request that asked for them and a late
+    answer to a timed out request is discarded rather than being taken as
+    the answer to a later request. Requests are pipelined, several can be
+    in flight at once on the connection.
+
+    Messages are encoded with :py:mod:`netcodec`, using msgpack if both the
+    client and server have it and JSON otherwise.
+
+    Commands can be appended to the ``command_queue`` as before, in which
+    case answers are put in the ``answer_queue`` in the order the commands
+    were sent. Alternatively :py:func:`submit` returns a
+    ``concurrent.futures.Future`` for the answer to that command.
     """
 
     def __init__(self, ip, port, command_queue, answer_queue, abort_event,
@@ -47,7 +68,8 @@ class ControlClient(threading.Thread):
         list of known commands ``_commands`` and known pumps ``known_pumps``.
 
         :param collections.deque command_queue: The queue used to pass commands to
-            the thread.
+            the thread. Should be a :py:class:`commthread.CommandQueue` to
+            avoid polling.
 
         :param threading.Event abort_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
@@ -65,95 +87,54 @@ class ControlClient(threading.Thread):
         self._stop_event = threading.Event()
         self.timeout_event = timeout_event
 
+        self.timeout = 5
+
+        self._request_id = 0
+        self._pending = OrderedDict()
+        self._queued_answers = OrderedDict()
+        self.codec = 'json'
+
+        self.connect_error = defaultdict(int)
+
         logger.info("Connecting to %s on port %s", self.ip, self.port)
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.PAIR)
+        self.socket = self.context.socket(zmq.DEALER)
         self.socket.set(zmq.LINGER, 0)
         self.socket.connect("tcp://{}:{}".format(self.ip, self.port))
 
         self._ping()
 
-        self.connect_error = defaultdict(int)
-
     def run(self):
         """
         Custom run method for the thread.
         """
         while True:
             try:
-                if len(self.command_queue) > 0:
-                    # logger.debug("Getting new command")
-                    command = self.command_queue.popleft()
-                else:
-                    command = None
-
                 if self._abort_event.is_set():
                     logger.debug("Abort event detected")
                     self._abort()
-                    command = None
 
                 if self._stop_event.is_set():
                     logger.debug("Stop event detected")
                     break
 
-                if command is not None:
-                    device = command['device']
-                    device_cmd = command['command']
-                    get_response = command['response']
-                    # logger.debug("For device %s, processing cmd '%s' with args: %s and kwargs: %s ", device, device_cmd[0], ', '.join(['{}'.format(a) for a in device_cmd[1]]), ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()]))
-                    try:
-                        self.socket.send_json(command)
-
-                        start_time = time.time()
-                        while self.socket.poll(10) == 0 and time.time()-start_time < 5:
-                            pass
+                while len(self.command_queue) > 0:
+                    command, future = self._get_command()
 
-                        if self.socket.poll(10) > 0:
-                            answer = self.socket.recv_json()
-                        else:
-                            answer = ''
+                    try:
+                        self._send_request(command, future)
+                    except zmq.ZMQError:
+                        self._ping()
 
-                        if answer == '':
-                            raise zmq.ZMQError(msg="Could not get a response from the server")
-                        else:
-                            self.connect_error[device] = 0
+                if len(self._pending) > 0:
+                    if self.socket.poll(1) > 0:
+                        self._recv_answers()
 
-                        # logger.debug('Command response: %s' %(answer))
+                    self._check_timeouts()
 
-                        if get_response:
-                            self.answer_queue.append(answer)
+                elif isinstance(self.command_queue, commthread.CommandQueue):
+                    self.command_queue.wait(self._is_interrupted)
 
-                    except zmq.ZMQError:
-                        device = command['device']
-                        device_cmd = command['command']
-                        msg = ("Device %s failed to run command '%s' "
-                            "with args: %s and kwargs: %s. Timeout or other ZMQ "
-                            "error." %(device, device_cmd[0],
-                            ', '.join(['{}'.format(a) for a in device_cmd[1]]),
-                            ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()])))
-                        logger.error(msg)
-                        self.connect_error[device] += 1
-                        self._ping()
-                        if not self.timeout_event.set():
-                            self.answer_queue.append(None)
-
-                    except Exception:
-                        device = command['device']
-                        device_cmd = command['command']
-                        msg = ("Device %s failed to run command '%s' "
-                            "with args: %s and kwargs: %s. Exception follows:" %(device, device_cmd[0],
-                            ', '.join(['{}'.format(a) for a in device_cmd[1]]),
-                            ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()])))
-                        logger.error(msg)
-                        logger.error(traceback.print_exc())
-                        self.connect_error[device] += 1
-
-                    if self.connect_error[device] > 5:
-                        msg = ('5 consecutive failures to run a command on device'
-                            '%s.'.format(device))
-                        logger.error(msg)
-                        logger.error("Connection timed out")
-                        self.timeout_event.set()
                 else:
                     time.sleep(0.01)
 
@@ -165,31 +146,181 @@ class ControlClient(threading.Thread):
         else:
             self._abort()
 
+        for req_id, (command, future, send_time) in list(self._pending.items()):
+            self._set_answer(req_id, future, None)
+
+        self._pending.clear()
+
         self.socket.disconnect("tcp://{}:{}".format(self.ip, self.port))
         self.socket.close(0)
         self.context.destroy(0)
 
         logger.info("Quitting remote client thread: %s", self.name)
 
+    def _get_command(self):
+        item = self.command_queue.popleft()
+
+        if isinstance(item, tuple):
+            command, future = item
+        else:
+            command = item
+            future = None
+
+        return command, future
+
+    def _is_interrupted(self):
+        return self._abort_event.is_set() or self._stop_event.is_set()
+
+    def _send_request(self, command, future=None):
+        """
+        Sends a request to the server and registers it as pending.
+
+        :returns: The request id, or ``None`` if the request was cancelled
+            before it was sent.
+        """
+        if future is not None and not future.set_running_or_notify_cancel():
+            return None
+
+        self._request_id += 1
+        req_id = self._request_id
+
+        request = dict(command)
+        request['id'] = req_id
+
+        if future is None and command['response']:
+            self._queued_answers[req_id] = _NO_ANSWER
+
+        self._pending[req_id] = (command, future, time.time())
+
+        try:
+            self.socket.send_multipart(netcodec.encode(request, self.codec),
+                copy=False)
+        except zmq.ZMQError:
+            self._request_failed(command, future, 'Timeout or other ZMQ error.',
+                req_id)
+            raise
+        except Exception:
+            self._request_failed(command, future, 'Exception follows:', req_id)
+            logger.error(traceback.format_exc())
+
+        return req_id
+
+    def _recv_answers(self):
+        """Reads all available answers and matches them to their requests."""
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+
+            reply, codec = netcodec.decode([frame.buffer for frame in frames])
+
+            if not (isinstance(reply, dict) and 'id' in reply):
+                logger.warning("Discarding answer without a request id: %s", reply)
+                continue
+
+            req_id = reply['id']
+            answer = reply['answer']
+
+            if reply.get('codec') in netcodec.CODECS and reply['codec'] != self.codec:
+                logger.info("Using %s encoding for %s", reply['codec'], self.name)
+                self.codec = reply['codec']
+
+            if req_id not in self._pending:
+                logger.debug("Discarding answer to timed out request %s", req_id)
+                continue
+
+            command, future, send_time = self._pending.pop(req_id)
+            self.connect_error[command['device']] = 0
+
+            # logger.debug('Command response: %s' %(answer))
+
+            self._set_answer(req_id, future, answer)
+
+    def _check_timeouts(self):
+        now = time.time()
+        timed_out = []
+
+        for req_id, (command, future, send_time) in self._pending.items():
+            if now - send_time > self.timeout:
+                timed_out.append(req_id)
+            else:
+                break
+
+        if len(timed_out) > 0:
+            for req_id in timed_out:
+                command, future, send_time = self._pending.pop(req_id)
+                self._request_failed(command, future,
+                    'Timeout or other ZMQ error.', req_id)
+
+            self._ping()
+
+    def _request_failed(self, command, future, reason, req_id):
+        device = command['device']
+        device_cmd = command['command']
+        msg = ("Device %s failed to run command '%s' "
+            "with args: %s and kwargs: %s. %s" %(device, device_cmd[0],
+            ', '.join(['{}'.format(a) for a in device_cmd[1]]),
+            ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()]),
+            reason))
+        logger.error(msg)
+        self.connect_error[device] += 1
+
+        self._pending.pop(req_id, None)
+        self._set_answer(req_id, future, None)
+
+        if self.connect_error[device] > 5:
+            msg = ('5 consecutive failures to run a command on device '
+                '{}.'.format(device))
+            logger.error(msg)
+            logger.error("Connection timed out")
+            self.timeout_event.set()
+
+    def _set_answer(self, req_id, future, answer):
+        """
+        Gives the answer to whoever is waiting for it, either the request
+        future or the ``answer_queue``. Answers for the ``answer_queue`` are
+        held until the answers to earlier requests are in, so they keep
+        the order the commands were sent in.
+        """
+        if future is not None:
+            if not future.done():
+                future.set_result(answer)
+
+        elif req_id in self._queued_answers:
+            self._queued_answers[req_id] = answer
+
+            while len(self._queued_answers) > 0:
+                first_id = next(iter(self._queued_answers))
+
+                if self._queued_answers[first_id] is _NO_ANSWER:
+                    break
+
+                self.answer_queue.append(self._queued_answers.pop(first_id))
+
     def _ping(self):
         # logger.debug("Checking if server is active")
-        cmd = {'device': 'server', 'command': ('ping', (), {}), 'response': False}
+        cmd = {'device': 'server', 'command': ('ping', (), {}), 'response': False,
+            'codecs': netcodec.CODECS}
 
         connect_tries = 0
 
         while connect_tries < 5:
-            self.socket.send_json(cmd)
+            future = Future()
+
+            try:
+                req_id = self._send_request(cmd, future)
+            except zmq.ZMQError:
+                req_id = None
 
             start_time = time.time()
-            while self.socket.poll(10) == 0 and time.time()-start_time < 6:
-                pass
+            while not future.done() and time.time()-start_time < 6:
+                if self.socket.poll(10) > 0:
+                    self._recv_answers()
 
-            if self.socket.poll(10) > 0:
-                answer = self.socket.recv_json()
-            else:
-                answer = ''
+            self._pending.pop(req_id, None)
 
-            if answer == 'ping received':
+            if future.done() and future.result() == 'ping received':
                 logger.info("Connection to server verified")
                 connect_tries = 5
             else:
@@ -203,15 +334,242 @@ class ControlClient(threading.Thread):
     def _abort(self):
         """Clears the ``command_queue`` and aborts all current pump motions."""
         logger.info("Aborting remote client thread %s current and future commands", self.name)
-        self.command_queue.clear()
+
+        while True:
+            try:
+                command, future = self._get_command()
+            except IndexError:
+                break
+
+            if future is not None:
+                future.cancel()
+
         self._abort_event.clear()
         logger.debug("Remote client thread %s aborted", self.name)
 
+    def submit(self, command):
+        """
+        Sends a command to the server.
+
+        :param dict command: The command, in the same form as commands
+            appended to the ``command_queue``: ``{'device': device,
+            'command': (cmd, args, kwargs), 'response': bool}``.
+
+        :returns: A future that is completed with the server answer, or
+            with ``None`` if the request failed or timed out.
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        self.command_queue.append((command, future))
+
+        return future
+
+    def abort(self):
+        """Aborts the queued commands."""
+        self._abort_event.set()
+        self._wake()
+
     def stop(self):
         """Stops the thread cleanly."""
         logger.info("Starting to clean up and shut down remote client thread: %s", self.name)
 
         self._stop_event.set()
+        self._wake()
+
+    def _wake(self):
+        if isinstance(self.command_queue, commthread.CommandQueue):
+            self.command_queue.wake()
+
+class TelemetryClient(threading.Thread):
+    """
+    Subscribes to the device telemetry published by a
+    :py:class:`server.ControlServer` and keeps the latest value of each
+    field (e.g. flow rate, pump volume) for each device, so device status
+    can be read without sending a request to the server.
+    """
+
+    def __init__(self, ip, port, subscriptions=None, name='TelemetryClient'):
+        """
+        :param str ip: The server ip.
+
+        :param str port: The server telemetry port.
+
+        :param list subscriptions: The devices to subscribe to, either a
+            device type (e.g. ``'pump'``) to get all devices of that type, or
+            a ``(device type, device name)`` tuple for a single device.
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+
+        logger.info("Starting telemetry client: %s", self.name)
+
+        self.ip = ip
+        self.port = port
+
+        self._stop_event = threading.Event()
+        self._new_subscriptions = deque()
+        self._topics = set()
+
+        self._values = {}
+        self._update_count = 0
+        self._updated = threading.Condition()
+
+        if subscriptions is not None:
+            for sub in subscriptions:
+                if isinstance(sub, tuple):
+                    self.subscribe(*sub)
+                else:
+                    self.subscribe(sub)
+
+        logger.info("Subscribing to telemetry from %s on port %s", self.ip, self.port)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.set(zmq.LINGER, 0)
+        self.socket.connect("tcp://{}:{}".format(self.ip, self.port))
+
+    def run(self):
+        """
+        Custom run method for the thread.
+        """
+        while not self._stop_event.is_set():
+            try:
+                while len(self._new_subscriptions) > 0:
+                    self.socket.setsockopt_string(zmq.SUBSCRIBE,
+                        self._new_subscriptions.popleft())
+
+                if self.socket.poll(100) > 0:
+                    while True:
+                        try:
+                            frames = self.socket.recv_multipart(zmq.NOBLOCK,
+                                copy=False)
+                        except zmq.Again:
+                            break
+
+                        topic = frames[0].bytes.decode('utf-8')
+                        msg, codec = netcodec.decode([frame.buffer
+                            for frame in frames[1:]])
+                        sample_time, values = msg
+
+                        # Subscriptions are prefix matches, so e.g. pump/p1
+                        # also gets pump/p10
+                        device = topic.split('/', 1)[0]
+
+                        if device in self._topics or topic in self._topics:
+                            self._update(topic, sample_time, values)
+
+            except Exception:
+                logger.error('Error in telemetry client thread:\n{}'.format(traceback.format_exc()))
+
+        self.socket.disconnect("tcp://{}:{}".format(self.ip, self.port))
+        self.socket.close(0)
+        self.context.destroy(0)
+
+        logger.info("Quitting telemetry client thread: %s", self.name)
+
+    def _update(self, topic, sample_time, values):
+        with self._updated:
+            topic_values = self._values.setdefault(topic, {})
+
+            for field, value in values.items():
+                topic_values[field] = (sample_time, value)
+
+            self._update_count += 1
+            self._updated.notify_all()
+
+    def subscribe(self, device, name=None):
+        """
+        Subscribes to the telemetry from a device.
+
+        :param str device: The device type, e.g. ``'pump'``.
+
+        :param str name: The device name. If ``None``, subscribes to all
+            devices of the given type.
+        """
+        if name is None:
+            topic = device
+        else:
+            topic = '{}/{}'.format(device, name)
+
+        self._topics.add(topic)
+        self._new_subscriptions.append(topic)
+
+    def get(self, device, names, fields, max_age=None):
+        """
+        Gets the latest telemetry values for several devices.
+
+        :param str device: The device type, e.g. ``'pump'``.
+
+        :param list names: The device names.
+
+        :param list fields: The fields to get for each device, e.g.
+            ``['moving', 'volume']``.
+
+        :param float max_age: If not ``None``, values older than this (in s)
+            are treated as missing.
+
+        :returns: ``(sample_time, values)``, where values is a list with the
+            values of the fields for each device, and sample_time is the
+            time of the oldest of those values. If any value is missing,
+            returns ``(None, None)``.
+        :rtype: tuple
+        """
+        now = time.time()
+        sample_time = None
+        values = []
+
+        with self._updated:
+            for name in names:
+                topic_values = self._values.get('{}/{}'.format(device, name), {})
+                device_values = []
+
+                for field in fields:
+                    if field not in topic_values:
+                        return None, None
+
+                    field_time, value = topic_values[field]
+
+                    if max_age is not None and now - field_time > max_age:
+                        return None, None
+
+                    if sample_time is None or field_time < sample_time:
+                        sample_time = field_time
+
+                    device_values.append(value)
+
+                values.append(device_values)
+
+        return sample_time, values
+
+    def wait(self, update_count=None, timeout=None):
+        """
+        Waits for new telemetry.
+
+        :param int update_count: The update count returned by the last call
+            to this method. Waits until there has been an update since then.
+            If ``None``, waits for the next update.
+
+        :param float timeout: The maximum time to wait in s.
+
+        :returns: The current update count.
+        :rtype: int
+        """
+        with self._updated:
+            if update_count is None:
+                update_count = self._update_count
+
+            self._updated.wait_for(lambda: (self._update_count != update_count
+                or self._stop_event.is_set()), timeout)
+
+            return self._update_count
+
+    def stop(self):
+        """Stops the thread cleanly."""
+        logger.info("Starting to clean up and shut down telemetry client thread: %s", self.name)
+
+        self._stop_event.set()
+
+        with self._updated:
+            self._updated.notify_all()
 
 if __name__ == '__main__':
     logger = logging.getLogger()
@@ -43,6 +43,7 @@ matplotlib.rcParams['backend'] = 'WxAgg'
 
 # import fmcon
 import client
+import commthread
 import pumpcon
 import utils
 
@@ -112,16 +113,18 @@ class CoflowPanel(wx.Panel):
 
         self._create_layout()
 
-        self.coflow_pump_cmd_q = deque()
+        self.coflow_pump_cmd_q = commthread.CommandQueue()
         self.coflow_pump_return_q = deque()
         self.coflow_pump_abort_event = threading.Event()
         self.coflow_pump_event = threading.Event()
 
-        self.coflow_fm_cmd_q = deque()
+        self.coflow_fm_cmd_q = commthread.CommandQueue()
         self.coflow_fm_return_q = deque()
         self.coflow_fm_abort_event = threading.Event()
         self.coflow_fm_event = threading.Event()
 
+        self.fm_telemetry = None
+
         if self.settings['device_communication'] == 'local':
             self.coflow_pump_con = pumpcon.PumpCommThread(self.coflow_pump_cmd_q,
                 self.coflow_pump_return_q, self.coflow_pump_abort_event, 'PumpCon')
@@ -144,6 +147,12 @@ class CoflowPanel(wx.Panel):
                 self.coflow_fm_cmd_q, self.coflow_fm_return_q,
                 self.coflow_fm_abort_event, self.timeout_event, name='FMControlClient')
 
+            if self.settings['remote_telemetry_port'] is not None:
+                self.fm_telemetry = client.TelemetryClient(fm_ip,
+                    self.settings['remote_telemetry_port'], ['fm'],
+                    name='FMTelemetryClient')
+                self.fm_telemetry.start()
+
         self.coflow_pump_con.start()
         self.coflow_fm_con.start()
 
@@ -676,27 +685,51 @@ class CoflowPanel(wx.Panel):
         low_warning = self.settings['warning_threshold_low']
         high_warning = self.settings['warning_threshold_high']
 
+        fm_names = ['sheath_fm', 'outlet_fm']
+
         cycle_time = time.time()
         start_time = copy.copy(cycle_time)
         log_time = time.time()
 
+        # With telemetry from the server, wait for new flow meter readings
+        # instead of requesting them, and fall back to requesting them if
+        # there is no telemetry
+        update_count = None
+        fr_time = None
+        aux_time = None
 
         while not self.stop_get_fr_event.is_set():
-            if not self.stop_get_fr_event.is_set():
-                ret_val = self._send_fmcmd(sheath_fr_cmd, True)
-                if ret_val is not None:
-                    s_type, sheath_fr = ret_val
+            values = None
+
+            if self.fm_telemetry is not None:
+                update_count = self.fm_telemetry.wait(update_count, 1)
+                new_time, values = self.fm_telemetry.get('fm', fm_names,
+                    ['flow_rate'], 1)
+
+                if values is not None and new_time != fr_time:
+                    s_type = o_type = 'flow_rate'
+                    sheath_fr = values[0][0]
+                    outlet_fr = values[1][0]
+                    fr_time = new_time
                 else:
-                    s_type = None
-                    sheath_fr = None
+                    s_type = o_type = None
 
-            if not self.stop_get_fr_event.is_set():
-                ret_val = self._send_fmcmd(outlet_fr_cmd, True)
-                if ret_val is not None:
-                    o_type, outlet_fr = ret_val
-                else:
-                    o_type = None
-                    outlet_fr = None
+            if values is None:
+                if not self.stop_get_fr_event.is_set():
+                    ret_val = self._send_fmcmd(sheath_fr_cmd, True)
+                    if ret_val is not None:
+                        s_type, sheath_fr = ret_val
+                    else:
+                        s_type = None
+                        sheath_fr = None
+
+                if not self.stop_get_fr_event.is_set():
+                    ret_val = self._send_fmcmd(outlet_fr_cmd, True)
+                    if ret_val is not None:
+                        o_type, outlet_fr = ret_val
+                    else:
+                        o_type = None
+                        outlet_fr = None
 
             if s_type == 'flow_rate' and o_type == 'flow_rate':
                 self.get_plot_data_lock.acquire()
@@ -720,37 +753,54 @@ class CoflowPanel(wx.Panel):
                         logger.error('Outlet flow out of bounds (%f to %f): %f', low_warning*self.outlet_setpoint, high_warning*self.outlet_setpoint, outlet_fr)
 
             if time.time() - cycle_time > 0.25:
-                if not self.stop_get_fr_event.is_set():
-                    ret_val = self._send_fmcmd(sheath_density_cmd, True)
-                    if ret_val is not None:
-                        s1_type, sheath_density = ret_val
+                values = None
+
+                if self.fm_telemetry is not None:
+                    new_time, values = self.fm_telemetry.get('fm', fm_names,
+                        ['density', 'temperature'], 1)
+
+                    if values is not None and new_time != aux_time:
+                        s1_type = o1_type = 'density'
+                        s2_type = o2_type = 'temperature'
+                        sheath_density, sheath_t = values[0]
+                        outlet_density, outlet_t = values[1]
+                        aux_time = new_time
                     else:
-                        s1_type = None
-                        sheath_density = None
-
-                if not self.stop_get_fr_event.is_set():
-                    ret_val = self._send_fmcmd(outlet_density_cmd, True)
-                    if ret_val is not None:
-                        o1_type, outlet_density = ret_val
-                    else:
-                        o1_type = None
-                        outlet_density = None
-
-                if not self.stop_get_fr_event.is_set():
-                    ret_val = self._send_fmcmd(sheath_t_cmd, True)
-                    if ret_val is not None:
-                        s2_type, sheath_t = ret_val
-                    else:
-                        s2_type = None
-                        sheath_t = None
-
-                if not self.stop_get_fr_event.is_set():
-                    ret_val = self._send_fmcmd(outlet_t_cmd, True)
-                    if ret_val is not None:
-                        o2_type, outlet_t = ret_val
-                    else:
-                        o2_type = None
-                        outlet_t = None
+                        s1_type = o1_type = None
+                        s2_type = o2_type = None
+
+                if values is None:
+                    if not self.stop_get_fr_event.is_set():
+                        ret_val = self._send_fmcmd(sheath_density_cmd, True)
+                        if ret_val is not None:
+                            s1_type, sheath_density = ret_val
+                        else:
+                            s1_type = None
+                            sheath_density = None
+
+                    if not self.stop_get_fr_event.is_set():
+                        ret_val = self._send_fmcmd(outlet_density_cmd, True)
+                        if ret_val is not None:
+                            o1_type, outlet_density = ret_val
+                        else:
+                            o1_type = None
+                            outlet_density = None
+
+                    if not self.stop_get_fr_event.is_set():
+                        ret_val = self._send_fmcmd(sheath_t_cmd, True)
+                        if ret_val is not None:
+                            s2_type, sheath_t = ret_val
+                        else:
+                            s2_type = None
+                            sheath_t = None
+
+                    if not self.stop_get_fr_event.is_set():
+                        ret_val = self._send_fmcmd(outlet_t_cmd, True)
+                        if ret_val is not None:
+                            o2_type, outlet_t = ret_val
+                        else:
+                            o2_type = None
+                            outlet_t = None
 
                 if s1_type == o1_type and s1_type == 'density' and s2_type == o2_type and s2_type == 'temperature':
                     self.get_plot_data_lock.acquire()
@@ -850,14 +900,14 @@ class CoflowPanel(wx.Panel):
 
         if not self.timeout_event.is_set():
             full_cmd = {'device': 'pump', 'command': cmd, 'response': response}
-            self.coflow_pump_cmd_q.append(full_cmd)
+            answer_future = self.coflow_pump_con.submit(full_cmd)
 
             if response:
-                while len(self.coflow_pump_return_q) == 0 and not self.timeout_event.is_set():
-                    time.sleep(0.01)
+                answer = commthread.wait_for_answer(answer_future,
+                    self.timeout_event, ret_val)
 
                 if not self.timeout_event.is_set():
-                    ret_val = self.coflow_pump_return_q.popleft()
+                    ret_val = answer
                 else:
                     msg = ('Lost connection to the coflow control server. '
                         'Contact your beamline scientist.')
@@ -883,14 +933,14 @@ class CoflowPanel(wx.Panel):
         ret_val = (None, None)
         if not self.timeout_event.is_set():
             full_cmd = {'device': 'fm', 'command': cmd, 'response': response}
-            self.coflow_fm_cmd_q.append(full_cmd)
+            answer_future = self.coflow_fm_con.submit(full_cmd)
 
             if response:
-                while len(self.coflow_fm_return_q) == 0 and not self.timeout_event.is_set():
-                    time.sleep(0.01)
+                answer = commthread.wait_for_answer(answer_future,
+                    self.timeout_event, ret_val)
 
                 if not self.timeout_event.is_set():
-                    ret_val = self.coflow_fm_return_q.popleft()
+                    ret_val = answer
 
                 else:
                     msg = ('Lost connection to the coflow control server. '
@@ -945,6 +995,9 @@ class CoflowPanel(wx.Panel):
         self.coflow_pump_con.stop()
         self.coflow_fm_con.stop()
 
+        if self.fm_telemetry is not None:
+            self.fm_telemetry.stop()
+
         if not self.timeout_event.is_set():
             self.coflow_pump_con.join()
             self.coflow_fm_con.join()
@@ -1284,7 +1337,8 @@ if __name__ == '__main__':
         'remote_pump_ip'        : '164.54.204.53',
         'remote_pump_port'      : '5556',
         'remote_fm_ip'          : '164.54.204.53',
-        'remote_fm_port'        : '5557',
+        'remote_fm_port'        : '5556',
+        'remote_telemetry_port' : '5559',
         'flow_units'            : 'mL/min',
         'sheath_pump'           : ('VICI_M50', 'COM3', [626.2, 9.278], {}),
         'outlet_pump'           : ('VICI_M50', 'COM4', [623.56, 12.222], {}),
@@ -0,0 +1,1300 @@
+# coding: utf-8
+#
+#    Project: BioCAT user beamline control software (BioCON)
+#             https://github.com/biocatiit/beamline-control-user
+#
+#
+#    Principal author:       Jesse Hopkins
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this software.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import object, range, map
+from io import open
+
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import logging
+
+if __name__ != '__main__':
+    logger = logging.getLogger(__name__)
+
+
+def wait_for_answer(future, timeout_event, default=None):
+    """
+    Waits for the answer to a command sent with :py:func:`CommThread.submit`
+    or :py:func:`client.ControlClient.submit`.
+
+    :param concurrent.futures.Future future: The command future.
+
+    :param threading.Event timeout_event: Stop waiting if this is set, e.g.
+        when the connection to the control server is lost.
+
+    :param default: The value returned if there is no answer.
+
+    :returns: The command answer, or ``default`` if the command failed, was
+        cancelled, or ``timeout_event`` was set first.
+    """
+    while not future.done():
+        if timeout_event.is_set():
+            return default
+
+        wait([future], 0.1)
+
+    if future.cancelled() or future.exception() is not None:
+        return default
+
+    return future.result()
+
+
+class AdaptivePoller(object):
+    """
+    Sets the interval for a device monitor loop. The monitor polls every
+    ``min_interval`` while a device is active (e.g. moving, or a value just
+    changed), and backs off exponentially to ``max_interval`` while the
+    devices are idle. :py:func:`wake` makes the monitor poll straight away,
+    e.g. after a user command. ::
+
+        poller = AdaptivePoller(0.5, 16)
+
+        while not stop_event.is_set():
+            start_time = time.time()
+            moving = get_status()
+            poller.update(moving)
+            poller.wait(start_time, stop_event)
+    """
+
+    def __init__(self, min_interval, max_interval, backoff=2):
+        """
+        :param float min_interval: The interval while devices are active, in s.
+
+        :param float max_interval: The longest interval while idle, in s.
+
+        :param float backoff: The interval is multiplied by this after each
+            poll where the devices are idle.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self.interval = min_interval
+        self._wake_event = threading.Event()
+
+        # Wakes so far, and how many of them the current poll started after
+        self._wake_lock = threading.Lock()
+        self._wakes = 0
+        self._seen_wakes = 0
+
+    def update(self, active):
+        """
+        Sets the next interval after a poll. A wake that came during the poll
+        counts as activity, since the poll may have missed what caused it.
+
+        :param bool active: Whether any device was active, for example
+            moving, flowing, or with a changed value.
+        """
+        with self._wake_lock:
+            woken = self._wakes != self._seen_wakes
+
+        if active or woken:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval*self.backoff, self.max_interval)
+
+    def wake(self):
+        """Makes the monitor poll now, and then at the fastest rate."""
+        with self._wake_lock:
+            self._wakes += 1
+            self.interval = self.min_interval
+            self._wake_event.set()
+
+    def wait(self, start_time, stop_event, step=0.1):
+        """
+        Waits until the interval after ``start_time`` has passed, the poller
+        is woken, or ``stop_event`` is set.
+
+        :param float start_time: When the last poll started.
+
+        :param threading.Event stop_event: The monitor stop event, checked
+            every ``step`` s.
+
+        :param float step: How often ``stop_event`` is checked, in s.
+        """
+        while not stop_event.is_set():
+            remaining = start_time + self.interval - time.time()
+
+            if remaining <= 0 or self._wake_event.wait(min(step, remaining)):
+                break
+
+        # The next poll sees any wakes until now
+        with self._wake_lock:
+            self._wake_event.clear()
+            self._seen_wakes = self._wakes
+
+
+class CommandQueue(deque):
+    """
+    A ``collections.deque`` that notifies a waiting control thread when a
+    command is added. It can be used anywhere a plain deque was used as a
+    command queue, but lets the :py:class:`CommThread` block while idle
+    instead of polling the queue.
+    """
+
+    def __init__(self, *args, **kwargs):
+        deque.__init__(self, *args, **kwargs)
+
+        self.not_empty = threading.Condition(threading.Lock())
+
+    def append(self, item):
+        with self.not_empty:
+            deque.append(self, item)
+            self.not_empty.notify_all()
+
+    def appendleft(self, item):
+        with self.not_empty:
+            deque.appendleft(self, item)
+            self.not_empty.notify_all()
+
+    def extend(self, items):
+        with self.not_empty:
+            deque.extend(self, items)
+            self.not_empty.notify_all()
+
+    def wake(self):
+        """Wakes any thread waiting on the queue, e.g. for an abort or stop."""
+        with self.not_empty:
+            self.not_empty.notify_all()
+
+    def wait(self, interrupt=None, timeout=None):
+        """
+        Blocks until the queue is not empty.
+
+        :param interrupt: Optional callable, if it returns ``True`` the wait
+            ends even though the queue is empty. It is checked whenever the
+            queue is woken.
+
+        :param float timeout: Maximum time to wait in seconds. If ``None``
+            (default), waits indefinitely.
+
+        :returns: ``True`` if the queue has items, ``False`` otherwise.
+        :rtype: bool
+        """
+        if interrupt is None:
+            predicate = lambda: len(self) > 0
+        else:
+            predicate = lambda: len(self) > 0 or interrupt()
+
+        with self.not_empty:
+            self.not_empty.wait_for(predicate, timeout)
+
+        return len(self) > 0
+
+
+#: Command priority lanes, highest priority first. Control commands (e.g.
+#: ``'stop'``) run before user commands, which run before monitor polls.
+CONTROL = 0
+USER = 1
+MONITOR = 2
+
+
+class CommandLanes(object):
+    """
+    Pending commands sorted into priority lanes. Items come out highest
+    priority first, and in the order they were added within a lane.
+
+    A monitor item added with a key replaces any queued monitor item with
+    the same key, since only the newest poll is worth running. A control or
+    user item added with a key (e.g. a setpoint) replaces a queued item with
+    the same key, so only the newest value is sent. It takes the place of
+    the old item if nothing else for the same device was queued after it,
+    otherwise the old item is dropped and the new one goes at the end, so
+    it never runs ahead of commands sent before it.
+
+    Control items come out before user items, so when a control item for a
+    device is added (e.g. ``'stop'``) the waiting user items for that
+    device are removed with :py:func:`remove_device`, rather than left to
+    run after it.
+    """
+
+    def __init__(self):
+        # Control and user items are held in [item, key, number, device]
+        # slots, so they can be replaced in place
+        self._lanes = (deque(), deque(), OrderedDict())
+        self._keyed = {}
+
+        # The number of the last control or user item for each device, and
+        # for items that don't name a device, which count for every device
+        self._count = 0
+        self._last = {}
+        self._last_any = 0
+
+        #: The number of items replaced by newer ones.
+        self.coalesced = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def put(self, priority, item, key=None, device=None):
+        """
+        Adds an item.
+
+        :param int priority: :py:data:`CONTROL`, :py:data:`USER`, or
+            :py:data:`MONITOR`.
+
+        :param item: The item.
+
+        :param key: Items with the same key and priority replace each
+            other. If ``None``, the item isn't replaced.
+
+        :param device: The device the item is for, or ``None`` if it isn't
+            for one known device.
+
+        :returns: The item that was replaced, or ``None``.
+        """
+        replaced = None
+
+        if priority == MONITOR:
+            if key is None:
+                key = object()
+
+            replaced = self._lanes[MONITOR].pop(key, None)
+            self._lanes[MONITOR][key] = item
+
+        else:
+            slot = self._keyed.get((priority, key)) if key is not None else None
+
+            if slot is not None:
+                replaced = slot[0]
+
+                if slot[2] == self._last_for(device):
+                    slot[0] = item
+                else:
+                    self._lanes[priority].remove(slot)
+                    del self._keyed[slot[1]]
+                    slot = None
+
+            if slot is None:
+                self._count += 1
+                slot = [item, None, self._count, device]
+                self._lanes[priority].append(slot)
+
+                if key is not None:
+                    slot[1] = (priority, key)
+                    self._keyed[slot[1]] = slot
+
+                if device is None:
+                    self._last_any = self._count
+                else:
+                    self._last[device] = self._count
+
+        if replaced is not None:
+            self.coalesced += 1
+
+        return replaced
+
+    def _last_for(self, device):
+        if device is None:
+            return self._count
+
+        return max(self._last.get(device, 0), self._last_any)
+
+    def remove_device(self, device):
+        """
+        Removes the waiting user items for a device, including coalesced
+        ones, and returns them.
+
+        :param device: The device.
+
+        :rtype: list
+        """
+        lane = self._lanes[USER]
+        removed = [slot for slot in lane if slot[3] == device]
+
+        if len(removed) > 0:
+            kept = [slot for slot in lane if slot[3] != device]
+            lane.clear()
+            lane.extend(kept)
+
+            for slot in removed:
+                if slot[1] is not None:
+                    del self._keyed[slot[1]]
+
+        return [slot[0] for slot in removed]
+
+    def pop(self):
+        """Removes and returns the next item, or ``None`` if there isn't one."""
+        for lane in self._lanes[:MONITOR]:
+            if len(lane) > 0:
+                item, key, number, device = lane.popleft()
+
+                if key is not None:
+                    del self._keyed[key]
+
+                return item
+
+        if len(self._lanes[MONITOR]) > 0:
+            return self._lanes[MONITOR].popitem(last=False)[1]
+
+        return None
+
+    def clear(self):
+        """Removes all items, and returns them."""
+        items = [slot[0] for slot in self._lanes[CONTROL]]
+        items.extend(slot[0] for slot in self._lanes[USER])
+        items.extend(self._lanes[MONITOR].values())
+
+        for lane in self._lanes:
+            lane.clear()
+
+        self._keyed.clear()
+
+        return items
+
+
+class PortWorker(threading.Thread):
+    """
+    Runs jobs for one communication port of a :py:class:`CommThread`, one at
+    a time, highest priority first (see :py:class:`CommandLanes`).
+
+    Jobs are ``(future, function, args, manages_future)``. If
+    ``manages_future`` is ``True`` the function completes the future itself
+    (as :py:func:`CommThread._run_command` does), otherwise the future gets
+    the function's return value or exception.
+    """
+
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+
+        self.lanes = CommandLanes()
+        self._cond = threading.Condition(threading.Lock())
+        self._stopped = False
+
+    def put(self, priority, job, key=None, device=None):
+        """
+        Adds a job to the lanes (see :py:func:`CommandLanes.put`).
+
+        :returns: The job this one replaced, or ``None``.
+        """
+        with self._cond:
+            replaced = self.lanes.put(priority, job, key, device)
+            self._cond.notify()
+
+        return replaced
+
+    def remove_device(self, device):
+        """
+        Removes the waiting user jobs for a device (see
+        :py:func:`CommandLanes.remove_device`), and returns them.
+        """
+        with self._cond:
+            return self.lanes.remove_device(device)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while len(self.lanes) == 0 and not self._stopped:
+                    self._cond.wait()
+
+                if self._stopped:
+                    break
+
+                future, function, args, manages_future = self.lanes.pop()
+
+            if manages_future:
+                function(*args)
+
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+        self.clear()
+
+    def clear(self):
+        """Removes all waiting jobs, cancelling their futures."""
+        with self._cond:
+            jobs = self.lanes.clear()
+
+        for job in jobs:
+            if job[0] is not None:
+                job[0].cancel()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
+class DeviceStateCache(object):
+    """
+    The last known state of each device of a :py:class:`CommThread`, with
+    the time each field was read from the device or set by a command.
+    """
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def update(self, name, **fields):
+        r"""
+        Sets state fields for a device, timestamped now.
+
+        :param str name: The device name.
+
+        :param \*\*fields: The field values, e.g. ``volume=10``.
+        """
+        timestamp = time.time()
+
+        with self._lock:
+            state = self._state.setdefault(name, {})
+
+            for field, value in fields.items():
+                state[field] = (value, timestamp)
+
+    def invalidate(self, name, *fields):
+        """
+        Removes state fields for a device, e.g. because they are changing.
+        If no fields are given, all of the device state is removed.
+        """
+        with self._lock:
+            if len(fields) == 0:
+                self._state.pop(name, None)
+
+            elif name in self._state:
+                for field in fields:
+                    self._state[name].pop(field, None)
+
+    def get(self, name, fields, max_age=None):
+        """
+        Gets state fields for a device.
+
+        :param str name: The device name.
+
+        :param list fields: The fields to get.
+
+        :param float max_age: The oldest value that is returned, in s. If
+            ``None`` (default), any cached value is returned.
+
+        :returns: A dictionary of the fields that are cached and new enough,
+            and a list of the other fields.
+        :rtype: dict, list
+        """
+        now = time.time()
+        values = {}
+        missing = []
+
+        with self._lock:
+            state = self._state.get(name, {})
+
+            for field in fields:
+                if (field in state and (max_age is None
+                    or now - state[field][1] <= max_age)):
+                    values[field] = state[field][0]
+                else:
+                    missing.append(field)
+
+        return values, missing
+
+
+def _chain_future(future, replaced_future):
+    """
+    Gives ``replaced_future`` the answer of ``future``, for a monitor command
+    that was replaced by a newer one.
+    """
+    def copy_answer(done_future):
+        if done_future.cancelled():
+            replaced_future.cancel()
+
+        elif replaced_future.set_running_or_notify_cancel():
+            if done_future.exception() is not None:
+                replaced_future.set_exception(done_future.exception())
+            else:
+                replaced_future.set_result(done_future.result())
+
+    future.add_done_callback(copy_answer)
+
+
+class CommThread(threading.Thread):
+    """
+    Base class for the device control threads (e.g. :py:class:`pumpcon.PumpCommThread`).
+    It takes care of the command dispatch loop: getting commands from the
+    command queue, running them, and handling abort and stop requests.
+
+    Commands can be sent the original way, by appending a
+    ``(command, args, kwargs)`` tuple to the command queue, in which case
+    any answer is put in the return queue. Alternatively :py:func:`submit`
+    returns a ``concurrent.futures.Future`` tied to that command, which
+    gets the command answer when it is done. If the command fails, the
+    future gets the failure answer the thread reports for that command
+    (e.g. ``False`` for a failed connect), or the exception if there is none.
+
+    If the command queue is a :py:class:`CommandQueue`, the thread blocks
+    while idle until a command, abort, or stop arrives. With a plain deque
+    it falls back to polling the queue.
+
+    The ``'batch'`` command runs a list of ``(command, args, kwargs)``
+    commands and answers ``('batch', answers)`` with the answers in the same
+    order (``None`` for a failed command). Commands for devices that share
+    a ``comm_lock`` run one after another, in order, while commands for
+    devices on different ports run in parallel.
+
+    Commands waiting to run are sorted into priority lanes: control
+    (commands in ``control_commands``, e.g. ``'stop'``), user (the
+    default), and monitor (commands in ``monitor_commands``, i.e. status
+    polls). A command runs before any waiting commands in lower priority
+    lanes, and a waiting monitor command sent with :py:func:`submit` is
+    replaced by a newer one with the same arguments, which answers both.
+    Likewise a waiting command in ``coalesce_commands`` (e.g. a setpoint)
+    is replaced by a newer one for the same device, so the device gets only
+    the newest value. The newest value never runs ahead of other commands
+    for that device that were sent before it. A control command for a
+    device cancels the waiting user commands for that device, rather than
+    running ahead of them, so nothing sent before a ``'stop'`` runs after
+    it. :py:func:`submit` can set the priority of a command explicitly. A batch has the highest priority of
+    its commands.
+
+    If ``port_workers`` is ``True``, every command for a known device is
+    handed to a :py:class:`PortWorker` for that device's communication
+    port, so a slow reply on one port doesn't hold up commands for devices
+    on other ports. Commands for the same port run in priority order, and
+    in the order they were sent within a priority. Commands in
+    ``connect_commands`` run on the worker for the port they connect, and
+    later commands for that device name follow them there, so they never
+    run before the device is connected. Other commands that don't name a
+    device run on a general worker, except control commands, which run in
+    the control thread itself so they never wait behind a poll.
+
+    Each thread keeps the last known state of its devices in
+    ``state_cache`` (a :py:class:`DeviceStateCache`), which commands update
+    as they read or change the devices. Subclasses that implement
+    ``_read_state`` can add the ``'get_cached'`` command
+    (:py:func:`_get_cached`), which only queries a device for fields that
+    are older than the caller allows.
+
+    Subclasses fill in ``_commands``, implement ``_abort``, and implement
+    ``_get_device`` to allow batch commands to run in parallel. Command
+    methods should return answers with :py:func:`_return_value`.
+    """
+
+    thread_type = 'device'
+
+    #: The maximum number of commands a batch runs at once.
+    max_batch_workers = 8
+
+    #: Whether commands run on a worker thread for each communication port.
+    port_workers = False
+
+    #: Commands that run in the control lane.
+    control_commands = ('stop',)
+
+    #: Commands that connect a device. The first argument is the
+    #: communication port (or the device itself) and the second is the
+    #: device name.
+    connect_commands = ()
+
+    #: Commands that run in the monitor lane.
+    monitor_commands = ()
+
+    #: Commands where only the newest waiting command for each coalescing
+    #: key is run, e.g. setpoints.
+    coalesce_commands = ()
+
+    def __init__(self, command_queue, return_queue, abort_event, name=None):
+        """
+        :param collections.deque command_queue: The queue used to pass commands
+            to the thread. Should be a :py:class:`CommandQueue` to avoid polling.
+
+        :param collections.deque return_queue: The queue used to return data
+            from the thread.
+
+        :param threading.Event abort_event: An event that is set when the thread
+            needs to abort, and otherwise is not set.
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+
+        self.command_queue = command_queue
+        self.return_queue = return_queue
+        self._abort_event = abort_event
+        self._stop_event = threading.Event()
+
+        self._commands = {}
+
+        # Holds the answer of the command running in each thread, so batch
+        # commands can run in parallel
+        self._local = threading.local()
+        self._batch_pool = None
+
+        # Commands taken from the command queue that haven't run yet
+        self._pending = CommandLanes()
+
+        # One worker per communication port, so commands for a port run in
+        # order, and one for commands that don't name a device
+        self._port_workers = {}
+        self._port_lock = threading.Lock()
+        self._general_key = ('general',)
+
+        # The port worker key for each device sent a connect command
+        self._connect_keys = {}
+
+        #: The last known device state.
+        self.state_cache = DeviceStateCache()
+
+    def run(self):
+        """
+        Custom run method for the thread.
+        """
+        while True:
+            command = self._get_command()
+
+            if self._abort_event.is_set():
+                logger.debug("Abort event detected")
+                if command is not None and command[3] is not None:
+                    command[3].cancel()
+                self._abort()
+                command = None
+
+            if self._stop_event.is_set():
+                logger.debug("Stop event detected")
+                if command is not None and command[3] is not None:
+                    command[3].cancel()
+                self._abort()
+                break
+
+            if command is not None:
+                self._dispatch_command(*command)
+
+        if self._stop_event.is_set():
+            self._stop_event.clear()
+        else:
+            self._abort()
+
+        if self._batch_pool is not None:
+            self._batch_pool.shutdown(wait=False)
+
+        with self._port_lock:
+            for worker in self._port_workers.values():
+                worker.stop()
+            self._port_workers = {}
+
+        self._cleanup()
+
+        logger.info("Quitting %s control thread: %s", self.thread_type, self.name)
+
+    def _get_command(self):
+        """
+        Gets the highest priority command waiting, waiting until one is
+        available or the thread is aborted or stopped. All commands in the
+        command queue are moved into the priority lanes first.
+
+        :returns: A ``(command, args, kwargs, future, priority)`` tuple,
+            where future is ``None`` for commands not sent with
+            :py:func:`submit`, or ``None`` if there is no command.
+        """
+        if len(self._pending) == 0:
+            if isinstance(self.command_queue, CommandQueue):
+                self.command_queue.wait(self._is_interrupted)
+
+            elif len(self.command_queue) == 0:
+                time.sleep(0.01)
+
+        while True:
+            try:
+                item = self.command_queue.popleft()
+            except IndexError:
+                break
+
+            command, args, kwargs = item[:3]
+
+            future = item[3] if len(item) > 3 else None
+            priority = item[4] if len(item) > 4 else None
+
+            if priority is None:
+                priority = self._get_priority(command, args, kwargs)
+
+            cmd = (command, args, kwargs, future, priority)
+            self._put_command(self._pending, cmd, cmd, lambda item: item[3])
+
+        command = self._pending.pop()
+
+        if command is not None:
+            logger.debug("Getting new command")
+
+        return command
+
+    def _has_pending(self):
+        """Returns ``True`` if commands taken from the queue are waiting to run."""
+        return len(self._pending) > 0
+
+    def _get_priority(self, command, args, kwargs):
+        """Returns the priority lane for a command."""
+        if command == 'batch':
+            try:
+                return min(self._get_priority(*cmd) for cmd in args[0])
+            except (IndexError, TypeError, ValueError):
+                return USER
+
+        if command in self.control_commands:
+            return CONTROL
+        elif command in self.monitor_commands:
+            return MONITOR
+        else:
+            return USER
+
+    def _put_command(self, lanes, cmd, item, get_future):
+        """
+        Puts a command in a set of lanes. A monitor command sent with
+        :py:func:`submit` replaces a waiting one with the same arguments,
+        and answers it too. A command in ``coalesce_commands`` replaces a
+        waiting one with the same coalescing key (see
+        :py:func:`_get_coalesce_key`), so superseded setpoints are never
+        sent to the device. A control command for a device cancels the
+        waiting user commands for it, so e.g. a pump never starts after
+        the ``'stop'`` sent after the start.
+
+        :param lanes: The :py:class:`CommandLanes` or :py:class:`PortWorker`.
+
+        :param tuple cmd: The ``(command, args, kwargs, future, priority)``.
+
+        :param item: What to put in the lanes for the command.
+
+        :param callable get_future: Returns the command future from an item.
+        """
+        command, args, kwargs, future, priority = cmd
+
+        if command in self.coalesce_commands:
+            key = self._get_coalesce_key(command, args, kwargs)
+
+        elif priority == MONITOR and future is not None:
+            # Commands without a future answer in the return queue, where a
+            # caller may be counting answers, so they aren't merged
+            key = (command, repr(args), repr(sorted(kwargs.items())))
+
+        else:
+            key = None
+
+        # Setpoints are only moved past commands for other devices
+        device = None
+
+        if priority != MONITOR:
+            try:
+                if self._get_device(args[0]) is not None:
+                    device = args[0]
+            except (IndexError, KeyError, TypeError):
+                pass
+
+        if priority == CONTROL and device is not None:
+            # Commands sent before a stop never run after it
+            for removed in lanes.remove_device(device):
+                logger.debug("Cancelled waiting cmd for %s before cmd '%s'",
+                    device, command)
+
+                removed_future = get_future(removed)
+
+                if removed_future is not None:
+                    removed_future.cancel()
+
+        replaced = lanes.put(priority, item, key, device)
+
+        if replaced is not None:
+            logger.debug("Replaced waiting cmd '%s' with a newer one", command)
+
+            replaced_future = get_future(replaced)
+
+            if replaced_future is None:
+                pass
+            elif future is not None:
+                _chain_future(future, replaced_future)
+            else:
+                replaced_future.cancel()
+
+    def _get_coalesce_key(self, command, args, kwargs):
+        """
+        Returns the coalescing key for a command in ``coalesce_commands``.
+        A waiting command with the same key is replaced by the newer one.
+        The default is the command and the device name, so the newest
+        setpoint for each device and parameter is kept.
+        """
+        try:
+            return (command, args[0])
+        except (IndexError, TypeError):
+            return (command,)
+
+    def _is_interrupted(self):
+        return self._abort_event.is_set() or self._stop_event.is_set()
+
+    def _dispatch_command(self, command, args, kwargs, future=None,
+        priority=USER):
+        """
+        Runs a command, on the worker for its device's communication port if
+        ``port_workers`` is set and the command names a known device. Other
+        commands run on the general worker, or in this thread for control
+        commands or if ``port_workers`` isn't set.
+        """
+        if not self.port_workers:
+            self._run_command(command, args, kwargs, future, priority)
+            return
+
+        key = None
+
+        if command in self.connect_commands:
+            key = self._get_connect_key(args, kwargs)
+
+            if key is not None:
+                self._connect_keys[args[1]] = key
+
+        elif command != 'batch':
+            key = self._get_comm_key(command, args, kwargs)
+
+        if key is None:
+            if priority == CONTROL:
+                self._run_command(command, args, kwargs, future, priority)
+                return
+
+            key = self._general_key
+
+        cmd = (command, args, kwargs, future, priority)
+        job = (future, self._run_port_command, (key,) + cmd, True)
+
+        self._put_command(self._get_port_worker(key), cmd, job,
+            lambda job: job[0])
+
+    def _run_port_command(self, key, command, args, kwargs, future, priority):
+        self._local.on_port_worker = key != self._general_key
+
+        try:
+            self._run_command(command, args, kwargs, future, priority)
+        except Exception:
+            logger.exception("Failed to run cmd '%s' on port worker", command)
+
+            if future is not None and not future.done():
+                future.set_exception(RuntimeError('Command failed'))
+
+    def _get_port_worker(self, key):
+        """Returns the :py:class:`PortWorker` for a communication port."""
+        with self._port_lock:
+            try:
+                worker = self._port_workers[key]
+            except KeyError:
+                worker = PortWorker('{}-{}'.format(self.name,
+                    len(self._port_workers)))
+                worker.start()
+                self._port_workers[key] = worker
+
+        return worker
+
+    def _map_devices(self, function, names):
+        """
+        Calls ``function(name)`` for each device name, in parallel for
+        devices on different communication ports. If ``port_workers`` is
+        set, the calls run on the port workers, at the priority of the
+        command that called this.
+
+        :param callable function: Called with each device name.
+
+        :param list names: The device names.
+
+        :returns: The return values, in the same order as ``names``.
+        :rtype: list
+
+        :raises Exception: The first exception raised by ``function``, after
+            all of the calls are done.
+        """
+        groups = OrderedDict()
+
+        for i, name in enumerate(names):
+            key = self._get_comm_key(None, (name,), {})
+            groups.setdefault(key, []).append(i)
+
+        results = [None]*len(names)
+
+        def run_group(indices):
+            for i in indices:
+                results[i] = function(names[i])
+
+        # A port worker waiting on other port workers could deadlock
+        if (len(groups) <= 1 and not self.port_workers) or getattr(self._local,
+            'on_port_worker', False):
+            for indices in groups.values():
+                run_group(indices)
+
+            return results
+
+        if self.port_workers:
+            # One job per device, so a control command can run in between
+            futures = [self._submit_group(key, run_group, [i]) for key, indices
+                in groups.items() for i in indices]
+        else:
+            futures = [self._submit_group(key, run_group, indices) for key,
+                indices in groups.items()]
+
+        wait(futures)
+
+        for group_future in futures:
+            group_future.result()
+
+        return results
+
+    def _submit_group(self, key, function, *args):
+        """
+        Runs a function on the worker for a communication port, at the
+        priority of the current command, if ``port_workers`` is set.
+        Otherwise it runs on the batch thread pool.
+
+        :rtype: concurrent.futures.Future
+        """
+        if self.port_workers and key is not None:
+            future = Future()
+            priority = getattr(self._local, 'priority', USER)
+
+            self._get_port_worker(key).put(priority, (future, function, args,
+                False))
+
+            return future
+
+        if self._batch_pool is None:
+            self._batch_pool = ThreadPoolExecutor(self.max_batch_workers)
+
+        return self._batch_pool.submit(function, *args)
+
+    def _run_command(self, command, args, kwargs, future=None, priority=USER):
+        """
+        Runs a single command. If the command has a future, the future
+        gets the value returned by the command, or the exception raised.
+        """
+        if future is not None and not future.set_running_or_notify_cancel():
+            logger.debug("Command '%s' was cancelled", command)
+            return
+
+        self._local.priority = priority
+
+        logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ",
+            command, ', '.join(['{}'.format(a) for a in args]),
+            ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()]))
+
+        if command == 'batch':
+            answer = ('batch', self._run_batch(*args, **kwargs))
+
+            if future is not None:
+                future.set_result(answer)
+            else:
+                self.return_queue.append(answer)
+
+            return
+
+        has_result, result, exception = self._call_command(command, args,
+            kwargs, future is not None)
+
+        if future is not None:
+            if exception is not None and not has_result:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _call_command(self, command, args, kwargs, capture):
+        """
+        Calls a command method.
+
+        :param bool capture: If ``True``, the answer is returned rather than
+            put in the return queue.
+
+        :returns: ``(has_result, result, exception)``, where exception is the
+            exception raised by the command, or ``None``.
+        """
+        self._local.capture = capture
+        self._local.result = None
+        self._local.has_result = False
+
+        exception = None
+
+        try:
+            self._commands[command](*args, **kwargs)
+        except Exception as e:
+            msg = ("%s control thread failed to run command '%s' "
+                "with args: %s and kwargs: %s " %(self.thread_type.capitalize(),
+                command, ', '.join(['{}'.format(a) for a in args]),
+                ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()])))
+            logger.exception(msg)
+
+            self._command_failed(command, args, kwargs)
+
+            exception = e
+
+        result = (self._local.has_result, self._local.result, exception)
+
+        self._local.capture = False
+        self._local.result = None
+        self._local.has_result = False
+
+        return result
+
+    def _run_batch(self, commands):
+        """
+        Runs a batch of commands, in parallel where they use different
+        communication ports.
+
+        :param list commands: A list of ``(command, args, kwargs)``.
+
+        :returns: The list of command answers.
+        :rtype: list
+        """
+        groups = OrderedDict()
+
+        for i, (command, args, kwargs) in enumerate(commands):
+            key = self._get_comm_key(command, args, kwargs)
+            groups.setdefault(key, []).append(i)
+
+        answers = [None]*len(commands)
+
+        def run_group(indices):
+            for i in indices:
+                command, args, kwargs = commands[i]
+                has_result, result, exception = self._call_command(command,
+                    args, kwargs, True)
+                answers[i] = result
+
+        if len(groups) == 1 and not self.port_workers:
+            run_group(list(groups.values())[0])
+
+        else:
+            for group_future in [self._submit_group(key, run_group, indices)
+                for key, indices in groups.items()]:
+                group_future.result()
+
+        return answers
+
+    def _get_comm_key(self, command, args, kwargs):
+        """
+        Returns the key used to decide which commands can run in parallel.
+        Commands with the same key run one after another. This is the
+        communication port (the device ``device`` path) if the device has
+        one, otherwise its ``comm_lock``, otherwise the device itself, or
+        ``None`` if the command doesn't name a known device. Devices sent a
+        connect command use the key the connect command ran with.
+        """
+        try:
+            key = self._connect_keys.get(args[0])
+            device = self._get_device(args[0])
+        except (IndexError, KeyError, TypeError):
+            key = None
+            device = None
+
+        if key is not None:
+            return key
+
+        if device is None:
+            return None
+
+        return self._get_device_key(device)
+
+    def _get_connect_key(self, args, kwargs):
+        """
+        Returns the key for a command in ``connect_commands``: the
+        communication port, otherwise the ``comm_lock`` keyword argument,
+        otherwise one for the device name. If the command passes a device
+        rather than a port, the key is that of the device.
+        """
+        try:
+            port, name = args[:2]
+        except ValueError:
+            return None
+
+        if not isinstance(port, (str, type(''))) and port is not None:
+            return self._get_device_key(port)
+
+        if port:
+            return ('port', port)
+
+        comm_lock = kwargs.get('comm_lock')
+
+        if comm_lock is not None:
+            return comm_lock
+
+        return ('device', name)
+
+    def _get_device_key(self, device):
+        """
+        Returns the key for a device: its communication port, otherwise its
+        ``comm_lock``, otherwise the device itself.
+        """
+        port = getattr(device, 'device', None)
+
+        if isinstance(port, (str, type(''))) and port:
+            return ('port', port)
+
+        comm_lock = getattr(device, 'comm_lock', None)
+
+        if comm_lock is not None:
+            return comm_lock
+
+        return device
+
+    def _get_device(self, name):
+        """
+        Returns the connected device with the given name, or ``None``.
+        Subclasses should override this to allow batch commands to run in
+        parallel.
+        """
+        return None
+
+    def _get_cached(self, name, fields, max_age=None):
+        """
+        Gets device state from the ``state_cache``. Fields that aren't cached,
+        or are older than ``max_age``, are read from the device with
+        :py:func:`_read_state`, and the cache is updated. Devices on
+        different ports are read in parallel.
+
+        :param name: The device name, or a list of device names.
+
+        :param list fields: The state fields, e.g. ``['moving', 'volume']``.
+
+        :param float max_age: The oldest cached value that is used, in s. If
+            ``None`` (default), any cached value is used.
+
+        :returns: ``(name, 'cached', values)``, where values is a list of the
+            field values, in the same order as ``fields``. If ``name`` is a
+            list, values is a list of those lists, one for each device.
+        """
+        def get_values(device_name):
+            values, missing = self.state_cache.get(device_name, fields, max_age)
+
+            if missing:
+                read = self._read_state(device_name, missing)
+                values.update(read)
+
+                # None is a failed read, so it isn't cached
+                self.state_cache.update(device_name, **dict((field, value)
+                    for field, value in read.items() if value is not None))
+
+            return [values[field] for field in fields]
+
+        if isinstance(name, (list, tuple)):
+            values = self._map_devices(get_values, name)
+        else:
+            values = get_values(name)
+
+        self._return_value((name, 'cached', values))
+
+    def _read_state(self, name, fields):
+        """
+        Reads state fields from a device, for :py:func:`_get_cached`.
+        Subclasses that support the ``'get_cached'`` command implement this.
+
+        :param str name: The device name.
+
+        :param list fields: The fields to read.
+
+        :returns: The field values.
+        :rtype: dict
+        """
+        raise NotImplementedError('{} control thread does not support '
+            'cached state'.format(self.thread_type.capitalize()))
+
+    def _return_value(self, value):
+        """
+        Returns an answer from a command. For commands sent with
+        :py:func:`submit` this becomes the result of the command future,
+        otherwise it is put in the return queue.
+        """
+        if getattr(self._local, 'capture', False):
+            self._local.result = value
+            self._local.has_result = True
+        else:
+            self.return_queue.append(value)
+
+    def _command_failed(self, command, args, kwargs):
+        """
+        Called when a command raises an exception. Subclasses can override
+        this to report the failure, e.g. to the return queue.
+        """
+        pass
+
+    def _clear_commands(self):
+        """
+        Clears the ``command_queue`` and the priority lanes, cancelling any
+        pending futures, including commands waiting for a port worker.
+        """
+        while True:
+            try:
+                item = self.command_queue.popleft()
+            except IndexError:
+                break
+
+            if len(item) > 3 and item[3] is not None:
+                item[3].cancel()
+
+        for cmd in self._pending.clear():
+            if cmd[3] is not None:
+                cmd[3].cancel()
+
+        with self._port_lock:
+            workers = list(self._port_workers.values())
+
+        for worker in workers:
+            worker.clear()
+
+    def _abort(self):
+        """Clears the ``command_queue``. Subclasses should extend this."""
+        self._clear_commands()
+        self._abort_event.clear()
+
+    def _cleanup(self):
+        """Called when the thread exits. Subclasses can override this."""
+        pass
+
+    def submit(self, command, args=(), kwargs=None, priority=None):
+        """
+        Sends a command to the thread.
+
+        :param str command: The command to run, a key in the ``_commands``
+            dictionary.
+
+        :param args: Positional arguments for the command.
+
+        :param dict kwargs: Keyword arguments for the command.
+
+        :param int priority: The priority lane, :py:data:`CONTROL`,
+            :py:data:`USER` or :py:data:`MONITOR`. If ``None`` (default),
+            it comes from ``control_commands`` and ``monitor_commands``.
+
+        :returns: A future that is completed with the command answer when
+            the command has run.
+        :rtype: concurrent.futures.Future
+        """
+        if kwargs is None:
+            kwargs = {}
+
+        future = Future()
+        self.command_queue.append((command, args, kwargs, future, priority))
+
+        return future
+
+    def abort(self):
+        """Aborts the current and queued commands."""
+        self._abort_event.set()
+        self._wake()
+
+    def stop(self):
+        """Stops the thread cleanly."""
+        logger.info("Starting to clean up and shut down %s control thread: %s",
+            self.thread_type, self.name)
+        self._stop_event.set()
+        self._wake()
+
+    def _wake(self):
+        if isinstance(self.command_queue, CommandQueue):
+            self.command_queue.wake()
@@ -42,34 +42,207 @@ import numpy as np
 
 import motorcon
 import utils
-import XPS_C8_drivers as xps_drivers
+import commthread
+import trajectory
 import epics
 
 utils.set_mppath() #This must be done before importing any Mp Modules.
 import Mp as mp
 import MpCa as mpca
 
-class ExpCommThread(threading.Thread):
+class LogWriter(object):
+    """
+    Writes the .log file for an exposure. The file is opened once and kept
+    open for the whole exposure. Writes are buffered, and written to disk
+    when more than ``flush_size`` characters are buffered or when
+    ``flush_interval`` seconds have passed since the last flush.
+    """
+
+    def __init__(self, log_file, flush_interval=1., flush_size=65536):
+        """
+        Opens the log file, replacing any existing file.
+
+        :param str log_file: The log file path.
+
+        :param float flush_interval: The longest time in seconds that
+            written values are buffered before being written to disk.
+
+        :param int flush_size: The buffered size in characters above which
+            the buffer is written to disk.
+        """
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.time()
+
+        self._file = open(log_file, 'w')
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, text):
+        """
+        Buffers text to write to the log, and flushes the buffer if the
+        flush size or interval has been reached.
+
+        :param str text: The text to write.
+        """
+        self._buffer.append(text)
+        self._buffer_size += len(text)
+
+        if (self._buffer_size >= self.flush_size
+            or time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered text to disk.
+        """
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+
+        self._file.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        """
+        Flushes the buffer and closes the file. Does nothing if the file is
+        already closed.
+        """
+        if not self._file.closed:
+            try:
+                self.flush()
+            finally:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DarkCurrentCache(object):
+    """
+    Caches the dark currents of the struck counters, so they aren't read
+    from the MX records at the start of every exposure. The cached values
+    expire after ``ttl`` seconds, and are dropped when the amplifier gains
+    change.
+    """
+
+    def __init__(self, counters, ttl=60.):
+        """
+        :param list counters: The struck counter MX records.
+
+        :param float ttl: How long in seconds the dark currents are used
+            before they are read again. If 0, they are read every time.
+        """
+        self.counters = counters
+        self.ttl = ttl
+
+        self.timestamp = None
+
+        self._values = {}
+        self._gains = None
+
+    def get(self, log_vals):
+        """
+        Returns the dark currents for an exposure, reading them if the
+        cached values have expired.
+
+        :param list log_vals: The counter log settings, the dark current is
+            0 for counters that don't have ``dark`` set.
+
+        :rtype: list
+        """
+        indices = [i for i, log in enumerate(log_vals) if log['dark']]
+
+        if self.is_stale() or any(i not in self._values for i in indices):
+            self.refresh(indices)
+
+        return [self._values[i] if log['dark'] else 0 for i, log
+            in enumerate(log_vals)]
+
+    def refresh(self, indices=None):
+        """
+        Reads the dark currents of the given counters and of any counters
+        already cached.
+
+        :param list indices: The counter indices to read.
+        """
+        if indices is None:
+            indices = []
+
+        indices = sorted(set(indices) | set(self._values.keys()))
+
+        self._values = dict((i, self.counters[i].get_dark_current())
+            for i in indices)
+        self.timestamp = time.time()
+
+        logger.debug('Read dark currents for counters %s', indices)
+
+    def invalidate(self):
+        """Makes the cached values expire, so they are read again."""
+        self.timestamp = None
+
+    def set_gains(self, gains):
+        """
+        Drops the cached values if the gains are different from the gains
+        last set.
+
+        :param gains: The amplifier gains, in any form that can be compared.
+        """
+        if self._gains is not None and gains != self._gains:
+            logger.info('Amplifier gains changed, dark currents will be read again')
+            self.invalidate()
+
+        self._gains = gains
+
+    def is_stale(self):
+        return (self.timestamp is None
+            or time.time() - self.timestamp >= self.ttl)
+
+    def time_to_stale(self):
+        """
+        Returns the time in seconds until the cached values expire, or None
+        if nothing has been cached yet or caching is off.
+
+        :rtype: float
+        """
+        if not self._values or self.ttl <= 0:
+            return None
+
+        if self.timestamp is None:
+            return 0
+
+        return max(self.timestamp + self.ttl - time.time(), 0)
+
+class ExpCommThread(commthread.CommThread):
+
+    thread_type = 'exposure'
 
     def __init__(self, command_queue, return_queue, abort_event, exp_event,
         settings, name=None):
         """
         Initializes the custom thread.
         """
-        threading.Thread.__init__(self, name=name)
+        commthread.CommThread.__init__(self, command_queue, return_queue,
+            abort_event, name=name)
 
         logger.info("Starting exposure control thread: %s", self.name)
 
-        self.daemon = True
-
-        self.command_queue = command_queue
-        self.return_queue = return_queue
-        self._abort_event = abort_event
         self._exp_event = exp_event
-        self._stop_event = threading.Event()
         self._settings = settings
 
-        self.xps = None
+        self._np_scan_motors = {}
+
+        self._log_writer = None
+        self._dark_cache = None
 
         self._commands = {
             'start_exp'     : self._start_exp,
@@ -187,44 +360,47 @@ class ExpCommThread(threading.Thread):
 
         self._mx_data = mx_data
 
-        while True:
-            if len(self.command_queue) > 0:
-                logger.debug("Getting new command")
-                command, args, kwargs = self.command_queue.popleft()
-            else:
-                command = None
+        self._dark_cache = DarkCurrentCache(mx_data['struck_ctrs'],
+            self._settings['dark_current_ttl'])
 
-            if self._abort_event.is_set():
-                logger.debug("Abort event detected")
-                self._abort()
-                command = None
+        commthread.CommThread.run(self)
 
-            if self._stop_event.is_set():
-                logger.debug("Stop event detected")
-                self._abort()
-                break
+    def _get_command(self):
+        # Re-reads expired dark currents while waiting for a command, so
+        # exposures don't have to wait on the reads
+        if (isinstance(self.command_queue, commthread.CommandQueue)
+            and self._dark_cache is not None and not self._has_pending()):
+            timeout = self._dark_cache.time_to_stale()
 
-            if command is not None:
-                logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ", command, ', '.join(['{}'.format(a) for a in args]), ', '.join(['{}: {}'.format(kw, item) for kw, item in kwargs.items()]))
-                try:
-                    self._commands[command](*args, **kwargs)
-                except Exception:
-                    msg = ("Exposure control thread failed to run command '%s' "
-                        "with args: %s and kwargs: %s " %(command,
-                        ', '.join(['{}'.format(a) for a in args]),
-                        ', '.join(['{}: {}'.format(kw, item) for kw, item in kwargs.items()])))
-                    logger.exception(msg)
-
-                    self.abort_all()
-            else:
-                time.sleep(.01)
+            if (timeout is not None
+                and not self.command_queue.wait(self._is_interrupted, timeout)):
+                if not self._is_interrupted():
+                    try:
+                        self._dark_cache.refresh()
+                    except Exception:
+                        logger.exception('Failed to refresh dark currents')
+                        # Leaves them for the next exposure to read
+                        self.command_queue.wait(self._is_interrupted)
 
-        if self._stop_event.is_set():
-            self._stop_event.clear()
-        else:
-            self._abort()
+                return None
 
-        logger.info("Quitting exposure control thread: %s", self.name)
+        return commthread.CommThread._get_command(self)
+
+    def _get_dark_counts(self, log_vals, metadata):
+        """
+        Returns the dark currents for an exposure from the dark current
+        cache, and adds the time they were read to the metadata.
+        """
+        dark_counts = self._dark_cache.get(log_vals)
+
+        if self._dark_cache.timestamp is not None:
+            metadata['Dark currents read:'] = datetime.datetime.fromtimestamp(
+                self._dark_cache.timestamp).isoformat(str(' '))
+
+        return dark_counts
+
+    def _command_failed(self, command, args, kwargs):
+        self.abort_all()
 
     def _start_exp(self, data_dir, fprefix, num_frames, exp_time, exp_period,
         **kwargs):
@@ -255,7 +431,6 @@ class ExpCommThread(threading.Thread):
         det = self._mx_data['det']          #Detector
 
         struck = self._mx_data['struck']    #Struck SIS3820
-        s_counters = self._mx_data['struck_ctrs']
         # struck_mode_pv = mpca.PV(self._mx_data['struck_pv']+':ChannelAdvance')
         struck_meas_time = kwargs['struck_measurement_time']
         struck_num_meas = kwargs['struck_num_meas']
@@ -448,12 +623,7 @@ class ExpCommThread(threading.Thread):
             struck.stop()
             measurement = struck.read_all()
 
-            dark_counts = []
-            for i in range(len(s_counters)):
-                if log_vals[i]['dark']:
-                    dark_counts.append(s_counters[i].get_dark_current())
-                else:
-                    dark_counts.append(0)
+            dark_counts = self._get_dark_counts(log_vals, kwargs['metadata'])
 
             logger.info('Writing counters')
             self.write_counters_muscle(measurement, struck_num_meas, data_dir,
@@ -583,7 +753,7 @@ class ExpCommThread(threading.Thread):
             autoinject = None
             autoinject_scan = None
 
-        motor_cmd_q = deque()
+        motor_cmd_q = commthread.CommandQueue()
         motor_answer_q = deque()
         abort_event = threading.Event()
         motor_con = motorcon.MotorCommThread(motor_cmd_q, motor_answer_q, abort_event, name='MotorCon')
@@ -670,7 +840,29 @@ class ExpCommThread(threading.Thread):
                         break
                     time.sleep(0.001)
 
-        if scan_type == 'vector':
+        if motor_type == 'Newport_XPS' and tr_scan_settings['pvt_mode']:
+            if scan_type == 'vector':
+                lines = [((x_start, y_start), (x_end, y_end))]*num_runs
+            else:
+                mtr_positions = self._get_tr_step_positions(x_start, x_end,
+                    y_start, y_end, step_axis, step_size, use_gridpoints,
+                    gridpoints)
+
+                if step_axis == 'x':
+                    lines = [((pos, y_start), (pos, y_end)) for pos in
+                        mtr_positions]*num_runs
+                else:
+                    lines = [((x_start, pos), (x_end, pos)) for pos in
+                        mtr_positions]*num_runs
+
+            self._tr_pvt_exp(det, det_filename, exp_time, exp_period,
+                exp_settings, data_dir, fprefix, num_frames, num_runs, struck,
+                ab_burst, dio_out6, dio_out9, dio_out10, motor, motor_con,
+                pco_direction, x_motor, y_motor, lines, tr_flow, autoinject,
+                autoinject_scan, start_autoinject_event, s_counters, log_vals,
+                comp_settings, tr_scan_settings)
+
+        elif scan_type == 'vector':
             next_x = x_start
             next_y = y_start
             step_num = None
@@ -727,30 +919,8 @@ class ExpCommThread(threading.Thread):
                 x_positions = [i*tr_scan_settings['x_pco_step']+tr_scan_settings['x_pco_start']
                     for i in range(num_frames)]
 
-            if not use_gridpoints:
-                if step_axis == 'x':
-                    step_start = x_start
-                    step_end = x_end
-
-                else:
-                    step_start = y_start
-                    step_end = y_end
-
-                if step_start < step_end:
-                    mtr_positions = np.arange(step_start, step_end+step_size, step_size)
-
-                    if mtr_positions[-1] > step_end:
-                        mtr_positions = mtr_positions[:-1]
-
-                else:
-                    mtr_positions = np.arange(step_end, step_start+step_size, step_size)
-
-                    if mtr_positions[-1] > step_start:
-                            mtr_positions = mtr_positions[:-1]
-
-                    mtr_positions = mtr_positions[::-1]
-            else:
-                mtr_positions = gridpoints
+            mtr_positions = self._get_tr_step_positions(x_start, x_end, y_start,
+                y_end, step_axis, step_size, use_gridpoints, gridpoints)
 
             for current_run in range(1,num_runs+1):
                 start = time.time()
@@ -963,6 +1133,19 @@ class ExpCommThread(threading.Thread):
                 if current_run == int(autoinject_scan)+1:
                     start_autoinject_event.set()
 
+        gathering = (motor_type == 'Newport_XPS'
+            and tr_scan_settings['xps_gathering'])
+
+        if gathering:
+            # Gathers for up to twice the nominal scan time, gathering is
+            # stopped when the scan ends
+            divisor = int(tr_scan_settings['xps_gathering_divisor'])
+            num_points = int(2*num_frames*float(exp_period)*10000./divisor)+1000
+
+            gathering = (motor.set_gathering((x_motor, y_motor), (0, 1),
+                tr_scan_settings['xps_gathering_quantities'])
+                and motor.start_gathering(num_points, divisor))
+
         motor_cmd_q.append(('move_absolute', ('TR_motor', (x_end, y_end)), {}))
 
         self._exp_event.set()
@@ -984,6 +1167,9 @@ class ExpCommThread(threading.Thread):
 
         dio_out6.write(1) #Close the slow normally closed xia shutter
 
+        if gathering:
+            motor.stop_gathering()
+
         if motor_type == 'Newport_XPS':
             if pco_direction == 'x':
                 motor.stop_position_compare(x_motor)
@@ -1021,12 +1207,7 @@ class ExpCommThread(threading.Thread):
 
         measurement = struck.read_all()
 
-        dark_counts = []
-        for i in range(len(s_counters)):
-            if log_vals[i]['dark']:
-                dark_counts.append(s_counters[i].get_dark_current())
-            else:
-                dark_counts.append(0)
+        dark_counts = self._get_dark_counts(log_vals, exp_settings['metadata'])
 
         logger.info('Writing counters')
         extra_vals = [['x', x_positions], ['y', y_positions]]
@@ -1034,6 +1215,12 @@ class ExpCommThread(threading.Thread):
             cur_fprefix, exp_period, dark_counts, log_vals,
             exp_settings['metadata'], extra_vals)
 
+        if gathering:
+            gathering_data = motor.get_gathering_data()
+
+            if gathering_data is not None:
+                self.write_gathering_data(gathering_data, data_dir, cur_fprefix)
+
         while det.get_status() & 0x1 !=0:
             time.sleep(0.001)
             if self._abort_event.is_set():
@@ -1045,19 +1232,265 @@ class ExpCommThread(threading.Thread):
             self.tr_abort_cleanup(det, struck, ab_burst, dio_out9, dio_out6,
                 comp_settings, exp_time)
 
+    def _get_tr_step_positions(self, x_start, x_end, y_start, y_end, step_axis,
+        step_size, use_gridpoints, gridpoints):
+        if not use_gridpoints:
+            if step_axis == 'x':
+                step_start = x_start
+                step_end = x_end
+
+            else:
+                step_start = y_start
+                step_end = y_end
+
+            if step_start < step_end:
+                mtr_positions = np.arange(step_start, step_end+step_size, step_size)
+
+                if mtr_positions[-1] > step_end:
+                    mtr_positions = mtr_positions[:-1]
+
+            else:
+                mtr_positions = np.arange(step_end, step_start+step_size, step_size)
+
+                if mtr_positions[-1] > step_start:
+                        mtr_positions = mtr_positions[:-1]
+
+                mtr_positions = mtr_positions[::-1]
+        else:
+            mtr_positions = gridpoints
+
+        return mtr_positions
+
+    def _tr_pvt_exp(self, det, det_filename, exp_time, exp_period, exp_settings,
+        data_dir, fprefix, num_frames, num_runs, struck, ab_burst, dio_out6,
+        dio_out9, dio_out10, motor, motor_con, pco_direction, x_motor, y_motor,
+        lines, tr_flow, autoinject, autoinject_scan, start_autoinject_event,
+        s_counters, log_vals, comp_settings, tr_scan_settings):
+        """
+        Runs every scan pass as a single XPS PVT trajectory. The controller
+        runs the passes and the moves between them without waiting on this
+        thread, position compare triggers the exposures, and this thread
+        only follows the trajectory progress. The detector and struck are
+        armed once for all of the passes, so the data are one image series
+        and one log file.
+
+        Position compare stays enabled for the whole trajectory, so every
+        pass has to move along the position compare axis and the moves
+        between passes must not, otherwise they would trigger extra
+        exposures. In practice this means serpentine passes, stepped
+        along the other axis.
+        """
+        if tr_scan_settings['pvt_serpentine']:
+            lines = trajectory.serpentine(lines)
+
+        if pco_direction == 'x':
+            pco_motor = x_motor
+            pco_index = 0
+            pco_positions = [i*tr_scan_settings['x_pco_step']
+                +tr_scan_settings['x_pco_start'] for i in range(num_frames)]
+        else:
+            pco_motor = y_motor
+            pco_index = 1
+            pco_positions = [i*tr_scan_settings['y_pco_step']
+                +tr_scan_settings['y_pco_start'] for i in range(num_frames)]
+
+        other_index = 1 - pco_index
+
+        for pass_num, (start, end) in enumerate(lines):
+            if start[pco_index] == end[pco_index]:
+                logger.error('PVT scan pass %i does not move along the '
+                    'position compare (%s) axis', pass_num+1, pco_direction)
+                return
+
+            if (pass_num > 0 and abs(start[pco_index]
+                -lines[pass_num-1][1][pco_index]) > 1e-9):
+                logger.error('The move before PVT scan pass %i moves along '
+                    'the position compare (%s) axis and would trigger extra '
+                    'exposures. PVT mode needs serpentine scans with the '
+                    'steps along the other axis.', pass_num+1, pco_direction)
+                return
+
+        try:
+            segments, passes = trajectory.raster_trajectory(lines,
+                float(tr_scan_settings['scan_speed']),
+                float(tr_scan_settings['scan_accel']),
+                float(tr_scan_settings['return_speed']),
+                float(tr_scan_settings['return_accel']))
+        except ValueError as e:
+            logger.error('Failed to make the PVT trajectory: %s', e)
+            return
+
+        if not tr_scan_settings['xps_ftp_password']:
+            logger.error('No XPS FTP password is set (xps_ftp_password), '
+                'so the PVT trajectory can not be loaded')
+            return
+
+        traj_name = 'BioCON_TR.trj'
+
+        load_future = motor_con.submit('load_trajectory', ('TR_motor',
+            traj_name, segments, tr_scan_settings['xps_ftp_user'],
+            tr_scan_settings['xps_ftp_password']),
+            {'positioner': tr_scan_settings['motor_group_name']})
+
+        # Trajectory displacements start from the current position
+        move_future = motor_con.submit('move_absolute', ('TR_motor',
+            lines[0][0]))
+
+        if not load_future.result() or not move_future.result():
+            logger.error('Failed to set up the PVT trajectory')
+            return
+
+        # Frame positions, the other axis is read off the line at each trigger
+        frame_pos = [[], []]
+        frame_pass = []
+        for pass_num, (start, end) in enumerate(lines):
+            if start[pco_index] <= end[pco_index]:
+                pass_pco = pco_positions
+            else:
+                pass_pco = pco_positions[::-1]
+
+            slope = ((end[other_index]-start[other_index])
+                /(end[pco_index]-start[pco_index]))
+
+            frame_pos[pco_index].extend(pass_pco)
+            frame_pos[other_index].extend([start[other_index]
+                +(float(pos)-start[pco_index])*slope for pos in pass_pco])
+            frame_pass.extend([pass_num+1]*num_frames)
+
+        total_frames = num_frames*len(lines)
+        passes_per_run = len(lines)//num_runs
+
+        if det.get_status() & 0x1 !=0:
+            try:
+                det.abort()
+            except (mp.Device_Action_Failed_Error, mp.Unparseable_String_Error):
+                pass
+            try:
+                det.abort()
+            except (mp.Device_Action_Failed_Error, mp.Unparseable_String_Error):
+                pass
+
+        struck.stop()
+        ab_burst.stop()
+
+        dio_out9.write(0) # Make sure the NM shutter is closed
+        dio_out10.write(0) # Make sure the trigger is off
+
+        det.set_duration_mode(total_frames)
+        struck.set_num_measurements(total_frames)
+
+        if total_frames <= 9999:
+            exp_start_num = '0001'
+
+        elif total_frames > 9999 and total_frames <= 99999:
+            exp_start_num = '00001'
+
+        elif total_frames > 99999:
+            exp_start_num = '000001'
+
+        det_filename.put('{}_{}.tif'.format(fprefix, exp_start_num))
+
+        dio_out6.write(0) #Open the slow normally closed xia shutter
+
+        struck.start()
+        ab_burst.arm()
+        det.arm()
+
+        logger.debug('starting pco on %s', pco_motor)
+        motor.start_position_compare(pco_motor)
+
+        gathering = tr_scan_settings['xps_gathering']
+
+        if gathering:
+            divisor = int(tr_scan_settings['xps_gathering_divisor'])
+            num_points = int(1.2*trajectory.get_duration(segments)*10000./divisor)+1000
+
+            gathering = (motor.set_gathering((x_motor, y_motor), (0, 1),
+                tr_scan_settings['xps_gathering_quantities'])
+                and motor.start_gathering(num_points, divisor))
+
+        logger.info('Running %i scan passes as a PVT trajectory (%s s)',
+            len(lines), round(trajectory.get_duration(segments), 3))
+
+        run_future = motor_con.submit('run_trajectory', ('TR_motor', traj_name),
+            {'positioner': tr_scan_settings['motor_group_name']})
+
+        self._exp_event.set()
+
+        next_pass = 0
+        while not run_future.done():
+            if self._abort_event.is_set():
+                self.tr_abort_cleanup(det, struck, ab_burst, dio_out9, dio_out6,
+                    comp_settings, exp_time)
+                return
+
+            element = motor.get_trajectory_element(
+                tr_scan_settings['motor_group_name'])
+
+            while (element is not None and next_pass < len(passes)
+                and element >= passes[next_pass]['first_segment']):
+                if next_pass % passes_per_run == 0:
+                    current_run = next_pass//passes_per_run + 1
+
+                    logger.info('Scan %s started', current_run)
+                    self.return_queue.append(['scan', current_run])
+
+                    if tr_flow and autoinject == 'after_scan':
+                        if current_run == int(autoinject_scan)+1:
+                            start_autoinject_event.set()
+
+                next_pass += 1
+
+            time.sleep(0.05)
+
+        dio_out6.write(1) #Close the slow normally closed xia shutter
+
+        if gathering:
+            motor.stop_gathering()
+
+        motor.stop_position_compare(pco_motor)
+
+        if not run_future.result():
+            logger.error('PVT trajectory failed after %i of %i passes',
+                next_pass, len(lines))
+
+        measurement = struck.read_all()
+
+        dark_counts = self._get_dark_counts(log_vals, exp_settings['metadata'])
+
+        logger.info('Writing counters')
+        extra_vals = [['x', frame_pos[0]], ['y', frame_pos[1]],
+            ['pass', frame_pass]]
+        self.write_counters_struck(measurement, total_frames, data_dir,
+            fprefix, exp_period, dark_counts, log_vals,
+            exp_settings['metadata'], extra_vals)
+
+        if gathering:
+            gathering_data = motor.get_gathering_data()
+
+            if gathering_data is not None:
+                self.write_gathering_data(gathering_data, data_dir, fprefix)
+
+        while det.get_status() & 0x1 !=0:
+            time.sleep(0.001)
+            if self._abort_event.is_set():
+                self.tr_abort_cleanup(det, struck, ab_burst, dio_out9, dio_out6,
+                    comp_settings, exp_time)
+                break
+
     def scan_exposure(self, exp_settings, comp_settings):
         logger.debug('Setting up scan exposure')
 
         scan_settings = comp_settings['scan']
 
         num_scans = scan_settings['num_scans']
-        scan_motors = copy.deepcopy(scan_settings['motors'])
 
         for current_run in range(1,num_scans+1):
             self.return_queue.append(['scan', current_run])
 
             self._inner_scan_exp(exp_settings, scan_settings,
-                scan_motors, OrderedDict(), current_run)
+                copy.deepcopy(scan_settings['motors']), OrderedDict(),
+                current_run)
 
         self._exp_event.clear()
 
@@ -1066,7 +1499,6 @@ class ExpCommThread(threading.Thread):
         det = self._mx_data['det']          #Detector
 
         struck = self._mx_data['struck']    #Struck SIS3820
-        s_counters = self._mx_data['struck_ctrs']
 
         ab_burst = self._mx_data['ab_burst']   #Shutter control signal
         cd_burst = self._mx_data['cd_burst']   #Struck LNE/channel advance signal
@@ -1102,7 +1534,7 @@ class ExpCommThread(threading.Thread):
         cur_trig = 0
         struck_num_meas = 0
         struck_meas_time = 0
-        kwargs = {}
+        kwargs = {'metadata': exp_settings['metadata']}
 
 
         total_shutter_speed = shutter_speed_open+shutter_speed_close+shutter_pad
@@ -1117,12 +1549,7 @@ class ExpCommThread(threading.Thread):
 
         log_vals = exp_settings['struck_log_vals']
 
-        dark_counts = []
-        for i in range(len(s_counters)):
-            if log_vals[i]['dark']:
-                dark_counts.append(s_counters[i].get_dark_current())
-            else:
-                dark_counts.append(0)
+        dark_counts = self._get_dark_counts(log_vals, exp_settings['metadata'])
 
         motor_num, motor_params = scan_motors.popitem(False)
         my_scan_motors = copy.deepcopy(scan_motors)
@@ -1142,14 +1569,16 @@ class ExpCommThread(threading.Thread):
                 self._mx_data['motors'][motor_name] = motor
 
         elif motor_type == 'Newport':
-            if self.xps is None:
+            if motor_name not in self._np_scan_motors:
                 np_group = motor_params['np_group']
                 np_index = motor_params['np_index']
                 np_axes = motor_params['np_axes']
-                self.xps = xps_drivers.XPS()
-                motor = motorcon.NewportXPSSingleAxis('Scan', self.xps,
-                    scan_settings['motor_ip'], int(scan_settings['motor_port']),
-                    20, np_group, np_axes, motor_name, np_index)
+                self._np_scan_motors[motor_name] = motorcon.NewportXPSSingleAxis(
+                    'Scan', None, scan_settings['motor_ip'],
+                    int(scan_settings['motor_port']), 20, np_group, np_axes,
+                    motor_name, np_index)
+
+            motor = self._np_scan_motors[motor_name]
 
 
         initial_motor_position = float(motor.get_position())
@@ -1187,58 +1616,129 @@ class ExpCommThread(threading.Thread):
             gh_burst.setup(exp_period, exp_time, num_frames, 0, 1, -1)
             continuous_exp = True
 
-        for position in mtr_positions:
-            logger.debug('Position: {}'.format(position))
-            if self._abort_event.is_set():
-                break
+        if len(my_scan_motors) > 0: # Recursive case
+            for position in mtr_positions:
+                logger.debug('Position: {}'.format(position))
+                if self._abort_event.is_set():
+                    break
 
-            motor.move_absolute(position)
+                motor.move_absolute(position)
+
+                while motor.is_busy():
+                    time.sleep(0.01)
+                    if self._abort_event.is_set():
+                        motor.stop()
+                        motor.move_absolute(initial_motor_position)
+                        break
 
-            while motor.is_busy():
-                time.sleep(0.01)
                 if self._abort_event.is_set():
-                    motor.stop()
-                    motor.move_absolute(initial_motor_position)
                     break
 
-            if self._abort_event.is_set():
-                break
+                motor_positions['m{}'.format(motor_num)] = position
 
-            motor_positions['m{}'.format(motor_num)] = position
+                self._inner_scan_exp(exp_settings, scan_settings,
+                    copy.deepcopy(my_scan_motors), motor_positions, current_run)
 
-            if len(my_scan_motors) > 0: # Recursive case
-                    self._inner_scan_exp(exp_settings, scan_motors, motor_positions)
+        else:   # Base case for recursion:
+            if num_frames <= 9999:
+                exp_start_num = '0001'
 
-            else:   # Base case for recursion:
-                cur_fprefix = '{}_{:04}'.format(fprefix, current_run)
+            elif num_frames > 9999 and num_frames <= 99999:
+                exp_start_num = '00001'
+
+            elif num_frames > 99999:
+                exp_start_num = '000001'
 
-                # new_fname = '{}_{:04}'.format(cur_fprefix)
-                logger.debug(motor_positions)
-                for mprefix, pos in motor_positions.items():
+            # File names and log headers for every point are made up front,
+            # so nothing but the move and arming happens between exposures
+            points = []
+            for position in mtr_positions:
+                point_positions = OrderedDict(motor_positions)
+                point_positions['m{}'.format(motor_num)] = position
+
+                cur_fprefix = '{}_{:04}'.format(fprefix, current_run)
+                for mprefix, pos in point_positions.items():
                     cur_fprefix = cur_fprefix + '_{}_{}'.format(mprefix, pos)
 
-                if num_frames <= 9999:
-                    exp_start_num = '0001'
+                extra_vals = []
+                for mprefix, pos in point_positions.items():
+                    extra_vals.append([mprefix, np.ones(num_frames)*float(pos)])
 
-                elif num_frames > 9999 and num_frames <= 99999:
-                    exp_start_num = '00001'
+                points.append({
+                    'position'  : position,
+                    'fprefix'   : cur_fprefix,
+                    'fname'     : '{}_{}.tif'.format(cur_fprefix, exp_start_num),
+                    'extra_vals': extra_vals,
+                    'header'    : self.format_log_header(exp_settings['metadata'],
+                        log_vals, extra_vals),
+                    })
 
-                elif num_frames > 99999:
-                    exp_start_num = '000001'
+            dead_times = []
+            last_done = time.time()
 
-                new_fname = '{}_{}.tif'.format(cur_fprefix, exp_start_num)
+            for point_num, point in enumerate(points):
+                logger.debug('Position: {}'.format(point['position']))
+                if self._abort_event.is_set():
+                    break
 
-                extra_vals = []
-                for mprefix, pos in motor_positions.items():
-                    extra_vals.append([mprefix, np.ones(num_frames)*float(pos)])
+                point_start = time.time()
 
+                motor.move_absolute(point['position'])
 
-                self._inner_fast_exp(self, det, det_datadir, det_filename, struck,
-                    ab_burst, ab_burst_2, dio_out6, dio_out9, dio_out10,
-                    continuous_exp, wait_for_trig, exp_type, data_dir, new_fname,
-                    cur_fprefix, log_vals, extra_vals, dark_counts, cur_trig,
-                    exp_time, exp_period, num_frames, struck_num_meas,
-                    struck_meas_time, kwargs)
+                # Arms while the motor moves, which overlaps for motors with
+                # non-blocking moves
+                shutter_open_time = self._arm_fast_exp(det, det_datadir,
+                    det_filename, struck, ab_burst, ab_burst_2, dio_out6,
+                    dio_out9, dio_out10, exp_type, data_dir, point['fname'],
+                    point['fprefix'], log_vals, point['extra_vals'],
+                    exp_settings['metadata'], point['header'])
+
+                while motor.is_busy():
+                    time.sleep(0.001)
+                    if self._abort_event.is_set():
+                        motor.stop()
+                        motor.move_absolute(initial_motor_position)
+                        break
+
+                if self._abort_event.is_set():
+                    self.fast_mode_abort_cleanup(det, struck, ab_burst,
+                        ab_burst_2, dio_out9, dio_out6, exp_time)
+                    self.close_log()
+                    break
+
+                moved = time.time()
+                timing = {}
+
+                try:
+                    finished = self._inner_fast_exp(det, det_datadir, det_filename,
+                        struck, ab_burst, ab_burst_2, dio_out6, dio_out9,
+                        dio_out10, continuous_exp, wait_for_trig, exp_type,
+                        data_dir, point['fname'], point['fprefix'], log_vals,
+                        point['extra_vals'], dark_counts, cur_trig, exp_time,
+                        exp_period, num_frames, struck_num_meas, struck_meas_time,
+                        kwargs, shutter_open_time, timing)
+                finally:
+                    self.close_log()
+
+                if not finished:
+                    break
+
+                dead_time = timing['triggered'] - last_done
+                dead_times.append(dead_time)
+
+                logger.info(('Scan point %i dead time: %.3f s (point setup '
+                    '%.3f s, move and arm %.3f s, ready %.3f s, trigger '
+                    '%.3f s)'), point_num+1, dead_time, point_start-last_done,
+                    moved-point_start, timing['ready']-moved,
+                    timing['triggered']-timing['ready'])
+
+                last_done = timing['done']
+
+            if dead_times:
+                logger.info(('Scan dead time: %.3f s total, %.3f s mean, '
+                    '%.3f s max over %i points'), sum(dead_times),
+                    sum(dead_times)/len(dead_times), max(dead_times),
+                    len(dead_times))
 
     def fast_exposure(self, data_dir, fprefix, num_frames, exp_time, exp_period,
         exp_type='standard', **kwargs):
@@ -1246,7 +1746,6 @@ class ExpCommThread(threading.Thread):
         det = self._mx_data['det']          #Detector
 
         struck = self._mx_data['struck']    #Struck SIS3820
-        s_counters = self._mx_data['struck_ctrs']
 
         if exp_type == 'muscle':
             struck_meas_time = kwargs['struck_measurement_time']
@@ -1302,12 +1801,7 @@ class ExpCommThread(threading.Thread):
             logger.info('Continuous mode')
             continuous_exp = True
 
-        dark_counts = []
-        for i in range(len(s_counters)):
-            if log_vals[i]['dark']:
-                dark_counts.append(s_counters[i].get_dark_current())
-            else:
-                dark_counts.append(0)
+        dark_counts = self._get_dark_counts(log_vals, kwargs['metadata'])
 
         extra_vals = []
 
@@ -1399,11 +1893,15 @@ class ExpCommThread(threading.Thread):
 
             new_fname = '{}_{}.tif'.format(cur_fprefix, exp_start_num)
 
-            finished = self._inner_fast_exp(det, det_datadir, det_filename,
-                struck, ab_burst, ab_burst_2, dio_out6, dio_out9, dio_out10,
-                continuous_exp, wait_for_trig, exp_type, data_dir, new_fname,
-                cur_fprefix, log_vals, extra_vals, dark_counts, cur_trig, exp_time,
-                exp_period, num_frames, struck_num_meas, struck_meas_time, kwargs)
+            try:
+                finished = self._inner_fast_exp(det, det_datadir, det_filename,
+                    struck, ab_burst, ab_burst_2, dio_out6, dio_out9, dio_out10,
+                    continuous_exp, wait_for_trig, exp_type, data_dir, new_fname,
+                    cur_fprefix, log_vals, extra_vals, dark_counts, cur_trig,
+                    exp_time, exp_period, num_frames, struck_num_meas,
+                    struck_meas_time, kwargs)
+            finally:
+                self.close_log()
 
             if not finished:
                 #Abort happened in the inner function
@@ -1475,12 +1973,17 @@ class ExpCommThread(threading.Thread):
 
         return ret_status, timeouts
 
-    def _inner_fast_exp(self, det, det_datadir, det_filename, struck, ab_burst,
-        ab_burst_2, dio_out6, dio_out9, dio_out10, continuous_exp, wait_for_trig,
-        exp_type, data_dir, new_fname, cur_fprefix, log_vals, extra_vals,
-        dark_counts, cur_trig, exp_time, exp_period, num_frames, struck_num_meas,
-        struck_meas_time, kwargs):
+    def _arm_fast_exp(self, det, det_datadir, det_filename, struck, ab_burst,
+        ab_burst_2, dio_out6, dio_out9, dio_out10, exp_type, data_dir, new_fname,
+        cur_fprefix, log_vals, extra_vals, metadata, header=None):
+        """
+        Gets the detector, struck and triggers ready for an exposure, up to
+        (but not including) opening the fast shutter and triggering. Nothing
+        is exposed until the trigger, so this can run while a motor moves.
 
+        :returns: The time the slow shutter was opened.
+        :rtype: float
+        """
         if det.get_status() & 0x1 !=0:
             try:
                 det.abort()
@@ -1491,8 +1994,6 @@ class ExpCommThread(threading.Thread):
             except (mp.Device_Action_Failed_Error, mp.Unparseable_String_Error):
                 pass
 
-        aborted = False
-
         struck.stop()
         ab_burst.stop()
 
@@ -1507,6 +2008,7 @@ class ExpCommThread(threading.Thread):
         det_filename.put(new_fname)
 
         dio_out6.write(0) #Open the slow normally closed xia shutter
+        shutter_open_time = time.time()
 
         ab_burst.get_status() #Maybe need to clear this status?
 
@@ -1517,15 +2019,69 @@ class ExpCommThread(threading.Thread):
         if exp_type == 'muscle':
             ab_burst_2.arm()
 
+        if exp_type != 'muscle':
+            self.write_log_header(data_dir, cur_fprefix, log_vals, metadata,
+                extra_vals, header)
+
+        return shutter_open_time
+
+    def wait_for_ready(self, det, shutter_open_time):
+        """
+        Waits until the detector is armed and the slow shutter has had
+        ``slow_shutter_open_time`` to open. If the detector doesn't report
+        armed within ``arm_timeout`` (the old fixed wait) this goes ahead
+        anyway.
+
+        :returns: True if the detector reported armed.
+        :rtype: bool
+        """
+        shutter_ready = shutter_open_time + self._settings['slow_shutter_open_time']
+        timeout = time.time() + self._settings['arm_timeout']
+
+        armed = False
+
+        while time.time() < timeout and not self._abort_event.is_set():
+            if not armed:
+                armed = (det.get_status() & 0x1) != 0
+
+            if armed and time.time() >= shutter_ready:
+                break
+
+            time.sleep(0.001)
+
+        if not armed:
+            logger.warning('Detector did not report armed after %s s',
+                self._settings['arm_timeout'])
+
+        return armed
+
+    def _inner_fast_exp(self, det, det_datadir, det_filename, struck, ab_burst,
+        ab_burst_2, dio_out6, dio_out9, dio_out10, continuous_exp, wait_for_trig,
+        exp_type, data_dir, new_fname, cur_fprefix, log_vals, extra_vals,
+        dark_counts, cur_trig, exp_time, exp_period, num_frames, struck_num_meas,
+        struck_meas_time, kwargs, shutter_open_time=None, timing=None):
+        """
+        Runs an exposure. If ``shutter_open_time`` is given the exposure was
+        already armed by :py:meth:`_arm_fast_exp`, which returned it. If
+        ``timing`` is given, the times the exposure was ready, triggered
+        and done are put in it.
+        """
+        aborted = False
+
+        if shutter_open_time is None:
+            shutter_open_time = self._arm_fast_exp(det, det_datadir,
+                det_filename, struck, ab_burst, ab_burst_2, dio_out6, dio_out9,
+                dio_out10, exp_type, data_dir, new_fname, cur_fprefix, log_vals,
+                extra_vals, kwargs['metadata'])
+
         if continuous_exp:
             if not exp_type == 'muscle' and not wait_for_trig:
                 dio_out9.write(1)
 
-        if exp_type != 'muscle':
-            self.write_log_header(data_dir, cur_fprefix, log_vals,
-                kwargs['metadata'])
+        self.wait_for_ready(det, shutter_open_time)
 
-        time.sleep(1)
+        if timing is not None:
+            timing['ready'] = time.time()
 
         self.wait_for_trigger(wait_for_trig, cur_trig, exp_time, ab_burst,
             ab_burst_2, det, struck, dio_out6, dio_out9, dio_out10)
@@ -1539,6 +2095,9 @@ class ExpCommThread(threading.Thread):
         logger.debug('Exposures started')
         self._exp_event.set()
 
+        if timing is not None:
+            timing['triggered'] = time.time()
+
         last_meas = 0
 
         timeouts = 0
@@ -1573,8 +2132,8 @@ class ExpCommThread(threading.Thread):
                         prev_meas = last_meas
 
                     self.append_log_counters(cvals, prev_meas, current_meas,
-                        data_dir, cur_fprefix, exp_period, num_frames,
-                        dark_counts, log_vals, extra_vals)
+                        cur_fprefix, exp_period, num_frames, dark_counts,
+                        log_vals, extra_vals)
 
                     last_meas = current_meas
 
@@ -1597,9 +2156,11 @@ class ExpCommThread(threading.Thread):
                     prev_meas = last_meas
 
                 self.append_log_counters(cvals, prev_meas, current_meas,
-                    data_dir, cur_fprefix, exp_period, num_frames, dark_counts,
+                    cur_fprefix, exp_period, num_frames, dark_counts,
                     log_vals, extra_vals)
 
+            self.close_log()
+
         else:
             struck.stop()
             measurement = struck.read_all()
@@ -1621,6 +2182,9 @@ class ExpCommThread(threading.Thread):
 
         logger.info('Exposures done')
 
+        if timing is not None:
+            timing['done'] = time.time()
+
         if self._abort_event.is_set():
             if not aborted:
                 self.fast_mode_abort_cleanup(det, struck, ab_burst, ab_burst_2,
@@ -1631,25 +2195,37 @@ class ExpCommThread(threading.Thread):
         return True
 
     def write_log_header(self, data_dir, fprefix, log_vals, metadata,
-            extra_vals=None):
+            extra_vals=None, header=None):
+        """
+        Opens the exposure log file, which stays open until :py:meth:`close_log`
+        is called, and writes the header. ``header`` can be given if it was
+        already made with :py:meth:`format_log_header`.
+        """
+        self.close_log()
+
         data_dir = data_dir.replace(self._settings['remote_dir_root'],
             self._settings['local_dir_root'], 1)
 
-        header = self.format_log_header(metadata, log_vals, extra_vals)
+        if header is None:
+            header = self.format_log_header(metadata, log_vals, extra_vals)
 
         log_file = os.path.join(data_dir, '{}.log'.format(fprefix))
 
-        with open(log_file, 'w') as f:
-            f.write(header)
+        self._log_writer = LogWriter(log_file,
+            self._settings['log_flush_interval'],
+            self._settings['log_flush_size'])
+        self._log_writer.write(header)
+        self._log_writer.flush()
 
         logger.info(header.split('\n')[-2])
 
-    def append_log_counters(self, cvals, prev_meas, cur_meas, data_dir,
-            fprefix, exp_period, num_frames, dark_counts, log_vals,
-            extra_vals=None):
+    def append_log_counters(self, cvals, prev_meas, cur_meas, fprefix,
+            exp_period, num_frames, dark_counts, log_vals, extra_vals=None):
+        """
+        Writes the log lines for measurements ``prev_meas+1`` to ``cur_meas``
+        to the log file opened by :py:meth:`write_log_header`.
+        """
         logger.debug('Appending log counters to file')
-        data_dir = data_dir.replace(self._settings['remote_dir_root'],
-            self._settings['local_dir_root'], 1)
 
         if num_frames <= 9999:
             zpad = 4
@@ -1660,16 +2236,22 @@ class ExpCommThread(threading.Thread):
         elif num_frames > 99999:
             zpad = 6
 
-        log_file = os.path.join(data_dir, '{}.log'.format(fprefix))
+        vals = self.format_log_values(prev_meas+1, cur_meas+1, fprefix,
+            exp_period, cvals, log_vals, dark_counts, extra_vals, zpad)
 
-        with open(log_file, 'a') as f:
-            for i in range(prev_meas+1, cur_meas+1):
-                val = self.format_log_value(i, fprefix, exp_period, cvals,
-                    log_vals, dark_counts, extra_vals, zpad)
+        self._log_writer.write(''.join(vals))
 
-                f.write(val)
+        for val in vals:
+            logger.info(val.rstrip('\n'))
 
-                logger.info(val.rstrip('\n'))
+    def close_log(self):
+        """
+        Flushes and closes the exposure log file, if one is open.
+        """
+        if self._log_writer is not None:
+            log_writer = self._log_writer
+            self._log_writer = None
+            log_writer.close()
 
     def write_counters_struck(self, cvals, num_frames, data_dir,
             fprefix, exp_period, dark_counts, log_vals, metadata,
@@ -1694,11 +2276,24 @@ class ExpCommThread(threading.Thread):
 
         with open(log_file, 'w') as f:
             f.write(header)
-            for i in range(num_frames):
-                val = self.format_log_value(i, fprefix, exp_period, cvals,
-                    log_vals, dark_counts, extra_vals, zpad)
+            f.write(''.join(self.format_log_values(0, num_frames, fprefix,
+                exp_period, cvals, log_vals, dark_counts, extra_vals, zpad)))
 
-                f.write(val)
+    def write_gathering_data(self, data, data_dir, fprefix):
+        """
+        Saves motor gathered data as a numpy ``.npy`` file next to the
+        exposure log, named ``{fprefix}_gathering.npy``.
+        """
+        data_dir = data_dir.replace(self._settings['remote_dir_root'],
+            self._settings['local_dir_root'], 1)
+
+        gathering_file = os.path.join(data_dir,
+            '{}_gathering.npy'.format(fprefix))
+
+        np.save(gathering_file, data)
+
+        logger.info('Saved %i gathered motor positions to %s', len(data),
+            gathering_file)
 
     def format_log_header(self, metadata, log_vals, extra_vals):
         header = self._get_header(metadata, log_vals)
@@ -1713,11 +2308,29 @@ class ExpCommThread(threading.Thread):
 
     def format_log_value(self, index, fprefix, exp_period, cvals, log_vals, dark_counts,
         extra_vals, zpad):
-        val = "{0}_{1:0{2}d}.tif\t{3}".format(fprefix, index+1, zpad,
-            exp_period*index)
+        return self.format_log_values(index, index+1, fprefix, exp_period,
+            cvals, log_vals, dark_counts, extra_vals, zpad)[0]
+
+    def format_log_values(self, start, stop, fprefix, exp_period, cvals,
+        log_vals, dark_counts, extra_vals, zpad):
+        """
+        Formats the log file lines for frames ``start`` to ``stop-1``. The
+        counter scaling is done on numpy arrays over the whole frame range,
+        and each value is formatted the same way as a python float, so the
+        lines are the same as formatting one frame at a time.
+
+        :returns: The log lines, each ending in a newline.
+        :rtype: list
+        """
+        indices = range(start, stop)
 
-        exp_time = cvals[0][index]/50.e6
-        val = val + "\t{}".format(exp_time)
+        columns = [
+            ['{}_{}.tif'.format(fprefix, str(i+1).zfill(zpad)) for i in indices],
+            ['{}'.format(exp_period*i) for i in indices],
+            ]
+
+        exp_time = np.asarray(cvals[0][start:stop], dtype=np.float64)/50.e6
+        columns.append(list(map(str, exp_time.tolist())))
 
         for j, log in enumerate(log_vals):
             dark = dark_counts[j]
@@ -1725,20 +2338,19 @@ class ExpCommThread(threading.Thread):
             offset = log['offset']
             chan = log['channel']
 
-            counter = (cvals[chan][index]-(dark+offset)*exp_time)/scale
+            counts = np.asarray(cvals[chan][start:stop], dtype=np.float64)
+            counter = (counts-(dark+offset)*exp_time)/scale
 
-            if log['norm_time'] and exp_time > 0:
-                counter = counter/exp_time
+            if log['norm_time']:
+                np.divide(counter, exp_time, out=counter, where=exp_time>0)
 
-            val = val + "\t{}".format(counter)
+            columns.append(list(map(str, counter.tolist())))
 
         if extra_vals is not None:
             for ev in extra_vals:
-                val = val + "\t{}".format(ev[1][index])
-
-        val = val + "\n"
+                columns.append(list(map('{}'.format, ev[1][start:stop])))
 
-        return val
+        return ['\t'.join(row)+'\n' for row in zip(*columns)]
 
     def write_counters_muscle(self, cvals, num_frames, data_dir, fprefix,
         exp_period, dark_counts, log_vals, metadata, extra_vals=None):
@@ -1883,9 +2495,9 @@ class ExpCommThread(threading.Thread):
 
     def _add_metadata(self, metadata):
         if self._settings['use_old_i0_gain']:
-            i0_gain = mx_data['ki0'].get_gain()
+            i0_gain = self._mx_data['ki0'].get_gain()
         else:
-            value = mx_data['ki0'].get()
+            value = self._mx_data['ki0'].get()
             if value == 0:
                 i0_gain = 1e+07
             elif value == 1:
@@ -1902,6 +2514,9 @@ class ExpCommThread(threading.Thread):
         metadata['I2 gain:'] = '{:.0e}'.format(self._mx_data['ki2'].get_gain())
         metadata['I3 gain:'] = '{:.0e}'.format(self._mx_data['ki3'].get_gain())
 
+        self._dark_cache.set_gains((metadata['I0 gain:'], metadata['I1 gain:'],
+            metadata['I2 gain:'], metadata['I3 gain:']))
+
         atten_length = 0
         for atten in sorted(self._mx_data['attenuators'].keys()):
             atten_in = not self._mx_data['attenuators'][atten].read()
@@ -2060,7 +2675,7 @@ class ExpCommThread(threading.Thread):
 
         self._abort_event.set()
         self._exp_event.clear()
-        self.command_queue.clear()
+        self._clear_commands()
         self.return_queue.clear()
 
     def _abort(self):
@@ -2068,17 +2683,12 @@ class ExpCommThread(threading.Thread):
         Clears the ``command_queue`` and the ``return_queue``.
         """
         logger.info("Aborting exposure control thread %s current and future commands", self.name)
-        self.command_queue.clear()
+        self._clear_commands()
         self.return_queue.clear()
 
         self._abort_event.clear()
         logger.debug("Exposure control thread %s aborted", self.name)
 
-    def stop(self):
-        """Stops the thread cleanly."""
-        logger.info("Starting to clean up and shut down exposure control thread: %s", self.name)
-        self._stop_event.set()
-
 class ExpPanel(wx.Panel):
     """
     This pump panel supports standard flow controls and settings, including
@@ -2137,7 +2747,7 @@ class ExpPanel(wx.Panel):
 
         self.settings = settings
 
-        self.exp_cmd_q = deque()
+        self.exp_cmd_q = commthread.CommandQueue()
         self.exp_ret_q = deque()
         self.abort_event = threading.Event()
         self.exp_event = threading.Event()
@@ -2515,7 +3125,7 @@ class ExpPanel(wx.Panel):
         return
 
     def stop_exp(self):
-        self.abort_event.set()
+        self.exp_con.abort()
         self.set_status('Aborting')
         wx.CallAfter(self._on_exp_finish)
 
@@ -3208,7 +3818,7 @@ class ExpPanel(wx.Panel):
             self.pipeline_timer.Stop()
 
         if self.exp_event.is_set() and not self.abort_event.is_set():
-            self.abort_event.set()
+            self.exp_con.abort()
             time.sleep(2)
 
         try:
@@ -3309,6 +3919,11 @@ if __name__ == '__main__':
         'i0_gain_pv'            : '18ID_D_BPM_Gain:Level-SP'
         'local_dir_root'        : '/nas_data/Pilatus1M',
         'remote_dir_root'       : '/nas_data',
+        'log_flush_interval'    : 1, #Max time (s) exposure log values are buffered
+        'log_flush_size'        : 65536, #Max characters of buffered log values
+        'arm_timeout'           : 1, #Max wait in s for the detector to arm before triggering
+        'dark_current_ttl'      : 60, #Time in s cached dark currents are used before being read again
+        'slow_shutter_open_time': 0.1, #Min wait in s between opening the slow shutter and triggering
         'struck_log_vals'       : [{'mx_record': 'mcs3', 'channel': 2, 'name': 'I0',
             'scale': 1, 'offset': 0, 'dark': True, 'norm_time': False}, #Format: (mx_record_name, struck_channel, header_name, scale, offset, use_dark_current, normalize_by_exp_time)
             {'mx_record': 'mcs4', 'channel': 3, 'name': 'I1', 'scale': 1,
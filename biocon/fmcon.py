@@ -36,6 +36,8 @@ if __name__ != '__main__':
 import wx
 import serial.tools.list_ports as list_ports
 
+import commthread
+
 #NOTE: RIGHT NOW, ONLY WORKS WITH 32bit elveflow stuff. The 64bit stuff seems to be broken.
 sys.path.append('C:\\Users\\biocat\\Elveflow_SDK_V3_03_00\\DLL64\\Elveflow64DLL') #add the path of the library here
 sys.path.append('C:\\Users\\biocat\\Elveflow_SDK_V3_03_00\\python_64')#add the path of the LoadElveflow.py
@@ -265,7 +267,7 @@ class SoftFlowMeter(FlowMeter):
     def flow_rate(self, rate):
         self._flow_rate = rate
 
-class FlowMeterCommThread(threading.Thread):
+class FlowMeterCommThread(commthread.CommThread):
     """
     This class creates a control thread for flow meters attached to the system.
     This thread is designed for using a GUI application. For command line
@@ -296,6 +298,11 @@ class FlowMeterCommThread(threading.Thread):
         my_pumpcon.stop()
     """
 
+    thread_type = 'flow meter'
+
+    monitor_commands = ('get_flow_rate', 'get_density', 'get_temperature',
+        'get_fr_multi', 'get_all_multi', 'get_cached')
+
     def __init__(self, command_queue, return_queue, abort_event, name=None):
         """
         Initializes the custom thread. Important parameters here are the
@@ -310,16 +317,11 @@ class FlowMeterCommThread(threading.Thread):
         :param threading.Event abort_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
         """
-        threading.Thread.__init__(self, name=name)
-        self.daemon = True
+        commthread.CommThread.__init__(self, command_queue, return_queue,
+            abort_event, name=name)
 
         logger.info("Starting flow meter control thread: %s", self.name)
 
-        self.command_queue = command_queue
-        self.return_queue = return_queue
-        self._abort_event = abort_event
-        self._stop_event = threading.Event()
-
         self._commands = {'connect'         : self._connect_fm,
                         'get_flow_rate'     : self._get_flow_rate,
                         'set_units'         : self._set_units,
@@ -329,6 +331,7 @@ class FlowMeterCommThread(threading.Thread):
                         'get_fr_multi'      : self._get_flow_rate_multiple,
                         'get_all_multi'     : self._get_all_multiple,
                         'set_flow_rate'     : self._set_flow_rate, #Simulations only!
+                        'get_cached'        : self._get_cached,
                         }
 
         self._connected_fms = OrderedDict()
@@ -337,53 +340,16 @@ class FlowMeterCommThread(threading.Thread):
             'Soft'  : SoftFlowMeter,
             }
 
-    def run(self):
-        """
-        Custom run method for the thread.
-        """
-        while True:
-            if len(self.command_queue) > 0:
-                logger.debug("Getting new command")
-                command, args, kwargs = self.command_queue.popleft()
-            else:
-                command = None
-
-            if self._abort_event.is_set():
-                logger.debug("Abort event detected")
-                self._abort()
-                command = None
-
-            if self._stop_event.is_set():
-                logger.debug("Stop event detected")
-                self._abort()
-                break
-
-            if command is not None:
-                logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ", command, ', '.join(['{}'.format(a) for a in args]), ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()]))
-                try:
-                    self._commands[command](*args, **kwargs)
-                except Exception:
-                    msg = ("Flow meter control thread failed to run command '%s' "
-                        "with args: %s and kwargs: %s " %(command,
-                        ', '.join(['{}'.format(a) for a in args]),
-                        ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()])))
-                    logger.exception(msg)
-
-                    if command == 'connect' or command == 'disconnect':
-                        self.return_queue.append((command, False))
-
-            else:
-                time.sleep(0.01)
-
-        if self._stop_event.is_set():
-            self._stop_event.clear()
-        else:
-            self._abort()
+    def _command_failed(self, command, args, kwargs):
+        if command == 'connect' or command == 'disconnect':
+            self._return_value((command, False))
 
+    def _cleanup(self):
         for fm in self._connected_fms.values():
             fm.stop()
 
-        logger.info("Quitting flow meter control thread: %s", self.name)
+    def _get_device(self, name):
+        return self._connected_fms.get(name)
 
     def _connect_fm(self, device, name, fm_type, **kwargs):
         """
@@ -405,18 +371,20 @@ class FlowMeterCommThread(threading.Thread):
         logger.info("Connecting flow meter %s", name)
         new_fm = self.known_fms[fm_type](device, name, **kwargs)
         self._connected_fms[name] = new_fm
+        self.state_cache.invalidate(name)
         logger.debug("Flow meter %s connected", name)
 
-        self.return_queue.append(('connected', True))
+        self._return_value(('connected', True))
 
     def _disconnect(self, name):
         logger.info("Disconnecting flow meter %s", name)
         fm = self._connected_fms[name]
         fm.stop()
         del self._connected_fms[name]
+        self.state_cache.invalidate(name)
         logger.debug("Flow meter %s disconnected", name)
 
-        self.return_queue.append(('disconnected', True))
+        self._return_value(('disconnected', True))
 
     def _get_flow_rate(self, name):
         """
@@ -428,9 +396,10 @@ class FlowMeterCommThread(threading.Thread):
         logger.debug("Getting flow meter %s flow rate", name)
         fm = self._connected_fms[name]
         flow_rate = fm.flow_rate
+        self.state_cache.update(name, flow_rate=flow_rate)
         logger.debug("Flow meter %s flow rate: %f", name, flow_rate)
 
-        self.return_queue.append(('flow_rate', flow_rate))
+        self._return_value(('flow_rate', flow_rate))
 
     def _set_flow_rate(self, name, flow_rate):
         """
@@ -442,9 +411,10 @@ class FlowMeterCommThread(threading.Thread):
         logger.debug("Setting flow meter %s flow rate", name)
         fm = self._connected_fms[name]
         fm.flow_rate = flow_rate
+        self.state_cache.update(name, flow_rate=flow_rate)
         logger.debug("Flow meter %s flow rate set to: %f", name, flow_rate)
 
-        self.return_queue.append(('set_flow_rate', True))
+        self._return_value(('set_flow_rate', True))
 
     def _get_density(self, name):
         """
@@ -458,9 +428,10 @@ class FlowMeterCommThread(threading.Thread):
         logger.debug("Getting flow meter %s density", name)
         fm = self._connected_fms[name]
         density = fm.density
+        self.state_cache.update(name, density=density)
         logger.debug("Flow meter %s density: %f", name, density)
 
-        self.return_queue.append(('density', density))
+        self._return_value(('density', density))
 
     def _get_temperature(self, name):
         """
@@ -474,9 +445,10 @@ class FlowMeterCommThread(threading.Thread):
         logger.debug("Getting flow meter %s temperature", name)
         fm = self._connected_fms[name]
         temperature = fm.temperature
+        self.state_cache.update(name, temperature=temperature)
         logger.debug("Flow meter %s temperature: %f", name, temperature)
 
-        self.return_queue.append(('temperature', temperature))
+        self._return_value(('temperature', temperature))
 
     def _set_units(self, name, units):
         """
@@ -491,62 +463,86 @@ class FlowMeterCommThread(threading.Thread):
         logger.info("Setting flow meter %s units", name)
         fm = self._connected_fms[name]
         fm.units = units
+        # The cached flow rate is in the old units
+        self.state_cache.invalidate(name, 'flow_rate')
         logger.debug("Flow meter %s units set", name)
 
-    def _get_flow_rate_multiple(self, names):
+    def _get_flow_rate_multiple(self, names=None):
         """
         This method gets the flow rate measured by a flow meter.
 
-        :param str name: The unique identifier for a flow meter that was used
-            in the :py:func:`_connect_fm` method.
+        :param list names: The unique identifiers for the flow meters that
+            were used in the :py:func:`_connect_fm` method. If ``None``, gets
+            all connected flow meters.
         """
         logger.debug("Getting multiple flow rates")
+        if names is None:
+            names = list(self._connected_fms.keys())
+
         flow_rates = []
         for name in names:
             fm = self._connected_fms[name]
             flow_rate = fm.flow_rate
+            self.state_cache.update(name, flow_rate=flow_rate)
             flow_rates.append(flow_rate)
 
-        self.return_queue.append(('multi_flow', names, flow_rates))
+        self._return_value(('multi_flow', names, flow_rates))
 
-    def _get_all_multiple(self, names):
+    def _get_all_multiple(self, names=None):
         """
         This method gets the flow rate measured by a flow meter.
 
-        :param str name: The unique identifier for a flow meter that was used
-            in the :py:func:`_connect_fm` method.
+        :param list names: The unique identifiers for the flow meters that
+            were used in the :py:func:`_connect_fm` method. If ``None``, gets
+            all connected flow meters.
         """
         logger.debug("Getting multiple flow rates")
+        if names is None:
+            names = list(self._connected_fms.keys())
+
         vals = []
         for name in names:
             fm = self._connected_fms[name]
             if isinstance(fm, BFS):
                 density = fm.density
                 temperature = fm.temperature
+                self.state_cache.update(name, density=density,
+                    temperature=temperature)
             else:
                 density = None
                 temperature = None
             flow_rate = fm.flow_rate
+            self.state_cache.update(name, flow_rate=flow_rate)
             vals.append((flow_rate, density, temperature))
 
-        self.return_queue.append(('multi_all', names, vals))
+        self._return_value(('multi_all', names, vals))
+
+    def _read_state(self, name, fields):
+        fm = self._connected_fms[name]
+        values = {}
+
+        for field in fields:
+            if field == 'flow_rate':
+                values[field] = fm.flow_rate
+            elif field in ('density', 'temperature'):
+                # Only the BFS flow meters measure these
+                values[field] = getattr(fm, field) if isinstance(fm, BFS) else None
+            else:
+                raise KeyError('Unknown flow meter state field {}'.format(field))
+
+        return values
 
     def _abort(self):
         """
         Clears the ``command_queue`` and the ``return_queue``.
         """
         logger.info("Aborting flow meter control thread %s current and future commands", self.name)
-        self.command_queue.clear()
+        self._clear_commands()
         self.return_queue.clear()
 
         self._abort_event.clear()
         logger.debug("Flow meter control thread %s aborted", self.name)
 
-    def stop(self):
-        """Stops the thread cleanly."""
-        logger.info("Starting to clean up and shut down flow meter control thread: %s", self.name)
-        self._stop_event.set()
-
 class FlowMeterPanel(wx.Panel):
     """
     This flow meter panel supports standard settings, including connection settings,
@@ -909,7 +905,7 @@ class FlowMeterFrame(wx.Frame):
         """
         super(FlowMeterFrame, self).__init__(*args, **kwargs)
         logger.debug('Setting up the FlowMeterFrame')
-        self.fm_cmd_q = deque()
+        self.fm_cmd_q = commthread.CommandQueue()
         self.fm_return_q = deque()
         self.abort_event = threading.Event()
         self.fm_con = FlowMeterCommThread(self.fm_cmd_q, self.fm_return_q,
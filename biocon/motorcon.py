@@ -24,6 +24,8 @@ from io import open
 
 import traceback
 import threading
+import ftplib
+import io
 import time
 import collections
 from collections import OrderedDict, deque
@@ -41,9 +43,359 @@ import serial.tools.list_ports as list_ports
 import zaber.serial as zaber #pip install zaber.serial
 
 import XPS_C8_drivers as xps_drivers
+import commthread
+import trajectory
 import utils
 
 
+# The XPS driver keeps its socket table at the class level and resets it
+# when an instance is made, so one driver instance is shared by every pool.
+_xps_driver = None
+_xps_pools = {}
+_xps_pool_lock = threading.RLock()
+
+def get_xps_pool(ip_address, port, timeout=20):
+    """
+    Returns the process-wide connection pool for an XPS controller, creating
+    it the first time it is requested.
+
+    :param str ip_address: The XPS IP address.
+
+    :param int port: The XPS port.
+
+    :param float timeout: The socket timeout, used when the pool is created.
+
+    :rtype: XPSConnectionPool
+    """
+    global _xps_driver
+
+    key = (ip_address, int(port))
+
+    with _xps_pool_lock:
+        if _xps_driver is None:
+            _xps_driver = xps_drivers.XPS()
+
+        if key not in _xps_pools:
+            _xps_pools[key] = XPSConnectionPool(_xps_driver, ip_address,
+                int(port), timeout)
+
+        return _xps_pools[key]
+
+def get_xps_pool_usage():
+    """
+    Returns the usage of every XPS connection pool, as returned by
+    :py:meth:`XPSConnectionPool.get_usage`.
+
+    :returns: A dictionary keyed by ``(ip_address, port)``.
+    :rtype: collections.OrderedDict
+    """
+    with _xps_pool_lock:
+        pools = list(_xps_pools.items())
+
+    return OrderedDict((key, pool.get_usage()) for key, pool in pools)
+
+class _PooledSocket(object):
+
+    def __init__(self, socket_id, purpose):
+        self.socket_id = socket_id
+        self.purpose = purpose
+        self.lock = threading.Lock()
+        self.users = 0
+        self.leases = 0
+        self.calls = 0
+        self.wait_time = 0.
+        self.last_used = time.time()
+
+class _PooledXPS(object):
+    """
+    Stands in for the XPS driver. Each driver call holds the lock of the
+    socket it is made on, so a socket shared by several motors is only used
+    by one thread at a time.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        func = getattr(self._pool.driver, name)
+
+        if not callable(func):
+            return func
+
+        def call(socket_id, *args, **kwargs):
+            return self._pool.call(func, socket_id, *args, **kwargs)
+
+        return call
+
+class XPSConnectionPool(object):
+    """
+    A pool of sockets to one Newport XPS controller, shared by all of the
+    motors in the process. Get the pool for a controller with
+    :py:func:`get_xps_pool`.
+
+    Sockets are handed out by purpose: ``'status'`` sockets are used for
+    status reads and settings, and ``'motion'`` sockets for the move calls,
+    which block until the move is done. An idle socket is reused if there is
+    one. Otherwise a new socket is opened if there are fewer than
+    ``max_sockets`` for that purpose. If there are already that many, status
+    sockets are shared, the least used first. Motion sockets are never
+    shared, since a move would wait for another motor's move to finish, so
+    :py:meth:`acquire` raises an error instead. Calls made through
+    :py:attr:`xps` hold a lock on the socket they use. Idle sockets that
+    haven't been used for ``health_check_interval`` seconds are checked
+    before being handed out, and closed if the controller doesn't answer.
+    """
+
+    def __init__(self, driver, ip_address, port, timeout=20, max_sockets=None,
+        health_check_interval=30.):
+        """
+        :param driver: The XPS driver.
+        :type driver: XPS_C8_drivers.XPS
+
+        :param str ip_address: The XPS IP address.
+
+        :param int port: The XPS port.
+
+        :param float timeout: The socket timeout.
+
+        :param dict max_sockets: The maximum number of sockets for each
+            purpose, ``None`` for no limit. Defaults to 3 status sockets, and
+            no limit on motion sockets, so each motor gets its own.
+
+        :param float health_check_interval: How long in seconds a socket
+            can be idle before it is checked when it is next handed out.
+        """
+        self.driver = driver
+        self.ip_address = ip_address
+        self.port = port
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self.max_sockets = {'status': 3, 'motion': None}
+        if max_sockets is not None:
+            self.max_sockets.update(max_sockets)
+
+        #: The driver to make calls with, see :py:class:`_PooledXPS`.
+        self.xps = _PooledXPS(self)
+
+        self._sockets = OrderedDict()
+        self._reconnects = 0
+
+        # Sockets being opened, which count towards max_sockets
+        self._opening = dict((purpose, 0) for purpose in self.max_sockets)
+
+    def acquire(self, purpose):
+        """
+        Hands out a socket. Release it with :py:meth:`release` when done.
+
+        :param str purpose: Either ``'status'`` or ``'motion'``.
+
+        :returns: The socket id, or -1 if no socket could be opened.
+        :rtype: int
+
+        :raises RuntimeError: If a motion socket is needed and there are
+            already ``max_sockets`` of them in use.
+        """
+        while True:
+            # Connecting and health checks can take up to the socket timeout,
+            # so they are done without holding the pool lock
+            with _xps_pool_lock:
+                my_socket, check = self._reserve(purpose)
+
+                if my_socket is None:
+                    self._opening[purpose] += 1
+
+            if my_socket is None:
+                try:
+                    my_socket = self._connect(purpose)
+                finally:
+                    with _xps_pool_lock:
+                        self._opening[purpose] -= 1
+
+                if my_socket is None:
+                    return -1
+
+                with _xps_pool_lock:
+                    self._sockets[my_socket.socket_id] = my_socket
+                    my_socket.users += 1
+
+                break
+
+            if not check or self._check_socket(my_socket):
+                break
+
+        with _xps_pool_lock:
+            my_socket.leases += 1
+
+            logger.debug('XPS %s:%i %s socket %i handed out, %i user(s)',
+                self.ip_address, self.port, purpose, my_socket.socket_id,
+                my_socket.users)
+
+        return my_socket.socket_id
+
+    def _reserve(self, purpose):
+        """
+        Picks a socket and adds a user to it, with the pool lock held.
+
+        :returns: The socket, or ``None`` if a new one should be opened, and
+            whether the socket needs a health check.
+        """
+        sockets = [sock for sock in self._sockets.values()
+            if sock.purpose == purpose]
+
+        for sock in sockets:
+            if sock.users == 0:
+                sock.users += 1
+                check = time.time() - sock.last_used >= self.health_check_interval
+                return sock, check
+
+        max_sockets = self.max_sockets[purpose]
+
+        if max_sockets is None or len(sockets) + self._opening[purpose] < max_sockets:
+            return None, False
+
+        if purpose == 'motion':
+            msg = ('All {} motion sockets to the XPS at {}:{} are in use, and '
+                'motion sockets are not shared'.format(max_sockets,
+                self.ip_address, self.port))
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        my_socket = min(sockets, key=lambda sock: sock.users)
+        my_socket.users += 1
+
+        return my_socket, False
+
+    def release(self, socket_id):
+        """
+        Returns a socket from :py:meth:`acquire` to the pool. The socket is
+        kept open for reuse.
+
+        :param int socket_id: The socket id.
+        """
+        with _xps_pool_lock:
+            sock = self._sockets.get(socket_id)
+
+            if sock is not None:
+                sock.users = max(sock.users-1, 0)
+                sock.last_used = time.time()
+
+    def call(self, func, socket_id, *args, **kwargs):
+        """
+        Calls a driver function on a pool socket, holding the socket lock.
+        """
+        sock = self._sockets.get(socket_id)
+
+        if sock is None:
+            return func(socket_id, *args, **kwargs)
+
+        start = time.time()
+
+        with sock.lock:
+            sock.wait_time += time.time() - start
+            sock.calls += 1
+
+            try:
+                return func(socket_id, *args, **kwargs)
+            finally:
+                sock.last_used = time.time()
+
+    def close(self):
+        """Closes all of the pool sockets."""
+        with _xps_pool_lock:
+            for socket_id in list(self._sockets.keys()):
+                self._close_socket(socket_id)
+
+    def get_usage(self):
+        """
+        Returns the pool usage for each purpose: the number of open
+        sockets, the maximum, the current users, the total handouts, the
+        number of calls, and the total time in seconds calls waited for a
+        socket that was in use.
+
+        :rtype: dict
+        """
+        usage = {}
+
+        with _xps_pool_lock:
+            for purpose, max_sockets in self.max_sockets.items():
+                sockets = [sock for sock in self._sockets.values()
+                    if sock.purpose == purpose]
+
+                usage[purpose] = {
+                    'sockets'       : len(sockets),
+                    'max_sockets'   : max_sockets,
+                    'users'         : sum(sock.users for sock in sockets),
+                    'leases'        : sum(sock.leases for sock in sockets),
+                    'calls'         : sum(sock.calls for sock in sockets),
+                    'wait_time'     : sum(sock.wait_time for sock in sockets),
+                    }
+
+            usage['reconnects'] = self._reconnects
+
+        return usage
+
+    def log_usage(self):
+        """Logs the pool usage."""
+        usage = self.get_usage()
+
+        for purpose in self.max_sockets:
+            logger.info('XPS %s:%i %s sockets: %i/%s open, %i user(s), %i calls, '
+                '%.3f s waiting', self.ip_address, self.port, purpose,
+                usage[purpose]['sockets'], usage[purpose]['max_sockets'],
+                usage[purpose]['users'], usage[purpose]['calls'],
+                usage[purpose]['wait_time'])
+
+    def _connect(self, purpose):
+        logger.debug('Opening a %s socket to the XPS at %s:%i', purpose,
+            self.ip_address, self.port)
+
+        socket_id = self.driver.TCP_ConnectToServer(self.ip_address, self.port,
+            self.timeout)
+
+        if socket_id == -1:
+            logger.error('Failed to open a %s socket to the XPS at %s:%i',
+                purpose, self.ip_address, self.port)
+            return None
+
+        sock = _PooledSocket(socket_id, purpose)
+
+        logger.info('Opened %s socket %i to the XPS at %s:%i', purpose,
+            socket_id, self.ip_address, self.port)
+
+        return sock
+
+    def _check_socket(self, sock):
+        """
+        Checks that the controller answers on a socket reserved by
+        :py:meth:`_reserve`, and closes it if not. Called without the pool
+        lock held, so a dead socket doesn't hold up the other pools.
+        """
+        ret = self.call(self.driver.ElapsedTimeGet, sock.socket_id)
+
+        if ret[0] != 0:
+            logger.warning('XPS %s:%i %s socket %i failed its health check, '
+                'closing it', self.ip_address, self.port, sock.purpose,
+                sock.socket_id)
+
+            with _xps_pool_lock:
+                self._close_socket(sock.socket_id)
+                self._reconnects += 1
+
+            return False
+
+        return True
+
+    def _close_socket(self, socket_id):
+        sock = self._sockets.pop(socket_id, None)
+
+        if sock is None:
+            return
+
+        with sock.lock:
+            self.driver.TCP_CloseSocket(socket_id)
+
+
 class Motor(object):
     """
     This class contains the settings and communication for a generic pump.
@@ -212,6 +564,9 @@ class NewportXPSMotor(Motor):
 
         :param name: A unique identifier for the pump
         :type name: str
+
+        :param xps: Not used, kept for compatibility. The motor sockets come
+            from the shared pool for the controller, see :py:func:`get_xps_pool`.
         """
 
         Motor.__init__(self, '{}:{}'.format(ip_address, port), name)
@@ -222,9 +577,11 @@ class NewportXPSMotor(Motor):
         self.group = group
         self.num_axes = num_axes
 
-        self.xps = xps
+        self._pool = get_xps_pool(ip_address, self.port, timeout)
+        self.xps = self._pool.xps
 
         self.sockets = {}
+        self._status_strings = {}
 
         self.connect_to_xps('general')
         self.connect_to_xps('status')
@@ -249,9 +606,17 @@ class NewportXPSMotor(Motor):
         self._scale = 1
         self._units = 'mm/s'
 
+        self._gathering_types = []
+
     def connect_to_xps(self, socket_name):
         logger.debug('%s connecting to the XPS at %s:%i', self.name, self.ip_address, self.port)
-        my_socket = self.xps.TCP_ConnectToServer(self.ip_address, self.port, self.timeout)
+
+        if socket_name == 'move':
+            purpose = 'motion'
+        else:
+            purpose = 'status'
+
+        my_socket = self._pool.acquire(purpose)
 
         if my_socket != -1:
             logger.info('%s connected to the XPS at %s:%i on socket %i', self.name,
@@ -277,15 +642,55 @@ class NewportXPSMotor(Motor):
             descrip = None
 
         else:
+            descrip = self._get_group_status_string(group_status)
+
+        return group_status, descrip
+
+    def _get_group_status_string(self, group_status):
+        # Status descriptions are fixed, so each one is only read once
+        if group_status not in self._status_strings:
             error, descrip = self.xps.GroupStatusStringGet(self.sockets['status'], group_status)
 
             if error !=0:
                 self.get_error('status', self.sockets['status'], error, descrip)
-            else:
-                # logger.debug('Group status: %i - %s', group_status, descrip)
-                pass
+                return descrip
 
-        return group_status, descrip
+            self._status_strings[group_status] = descrip
+
+        return self._status_strings[group_status]
+
+    def get_group_state(self):
+        """
+        Gets the positions of all of the group positioners, the group status,
+        and whether the group is moving. This takes one position read and
+        one status read on the status socket, instead of one read per
+        positioner.
+
+        :returns: ``(positions, status, descrip, moving)``, where positions
+            is a list of the user positions in group positioner order. If
+            there is an error, positions is an empty list and status is None.
+        :rtype: tuple
+        """
+        ret = self.xps.GroupPositionCurrentGet(self.sockets['status'],
+            self.group, self.num_axes)
+
+        error = ret[0]
+
+        if error != 0:
+            self.get_error('status', self.sockets['status'], error, ret[1])
+            return [], None, None, False
+
+        positions = [pos*self._scale + self._offset[i] for i, pos in
+            enumerate(ret[1:])]
+
+        status, descrip = self.get_group_status()
+
+        if status is None:
+            return [], None, None, False
+
+        moving = (status >= 43 and status <= 45) or status == 47
+
+        return positions, status, descrip, moving
 
     def get_controller_status(self):
         error, controller_status = self.xps.ControllerStatusGet(self.sockets['status'])
@@ -939,6 +1344,302 @@ class NewportXPSMotor(Motor):
         return success
 
 
+    def set_gathering(self, positioners, indices, quantities=('CurrentPosition',)):
+        """
+        Configures the XPS data gathering. Gathering records the given
+        quantities of each positioner every ``divisor`` servo cycles once
+        started with :py:meth:`start_gathering`.
+
+        :param list positioners: The full positioner names (e.g. ``XY.X``).
+
+        :param list indices: The axis index of each positioner, used to
+            convert positions to user units.
+
+        :param list quantities: The positioner quantities to gather, e.g.
+            ``CurrentPosition``, ``SetpointPosition``, ``FollowingError``
+            or ``CurrentVelocity``.
+
+        :returns: True if successful.
+        :rtype: bool
+        """
+        types = ['{}.{}'.format(positioner, quantity) for positioner in
+            positioners for quantity in quantities]
+        type_indices = [index for index in indices for quantity in quantities]
+
+        logger.debug('Setting %s gathering configuration: %s', self.group,
+            ', '.join(types))
+
+        error, ret = self.xps.GatheringConfigurationSet(self.sockets['general'],
+            types)
+
+        if error != 0:
+            self.get_error('general', self.sockets['general'], error, ret)
+            success = False
+        else:
+            success = True
+            self._gathering_types = list(zip(types, type_indices))
+            logger.info('Set %s gathering configuration: %s', self.group,
+                ', '.join(types))
+
+        return success
+
+    def start_gathering(self, num_points, divisor=1):
+        """
+        Starts gathering the configured quantities. Gathering stops when
+        ``num_points`` points have been gathered or :py:meth:`stop_gathering`
+        is called.
+
+        :param int num_points: The number of points to gather. This is
+            reduced to the controller maximum if it is larger.
+
+        :param int divisor: Points are gathered every ``divisor`` servo
+            cycles (the XPS servo rate is 10 kHz).
+
+        :returns: True if successful.
+        :rtype: bool
+        """
+        num_points = int(num_points)
+        divisor = int(divisor)
+
+        logger.debug('Starting %s gathering', self.group)
+
+        ret = self.xps.GatheringCurrentNumberGet(self.sockets['general'])
+
+        if ret[0] == 0 and num_points > ret[2]:
+            logger.warning('Requested %i gathering points, but the %s maximum is '
+                '%i', num_points, self.group, ret[2])
+            num_points = ret[2]
+
+        error, ret = self.xps.GatheringRun(self.sockets['general'], num_points,
+            divisor)
+
+        if error != 0:
+            self.get_error('general', self.sockets['general'], error, ret)
+            success = False
+        else:
+            success = True
+            logger.info('Started %s gathering: %i points every %i servo cycles',
+                self.group, num_points, divisor)
+
+        return success
+
+    def stop_gathering(self):
+        """
+        Stops gathering. The gathered data stays on the controller until
+        gathering is started again.
+
+        :returns: True if successful.
+        :rtype: bool
+        """
+        logger.debug('Stopping %s gathering', self.group)
+
+        error, ret = self.xps.GatheringStop(self.sockets['general'])
+
+        if error != 0:
+            self.get_error('general', self.sockets['general'], error, ret)
+            success = False
+        else:
+            success = True
+            logger.info('Stopped %s gathering', self.group)
+
+        return success
+
+    def get_gathering_number(self):
+        """
+        Returns the number of points gathered so far and the maximum number
+        of points that can be gathered with the current configuration.
+
+        :rtype: tuple
+        """
+        ret = self.xps.GatheringCurrentNumberGet(self.sockets['general'])
+
+        error = ret[0]
+
+        if error != 0:
+            self.get_error('general', self.sockets['general'], error, ret[1])
+            current = None
+            maximum = None
+        else:
+            current = ret[1]
+            maximum = ret[2]
+
+        return current, maximum
+
+    def get_gathering_data(self, chunk_size=5000):
+        """
+        Reads the gathered data from the controller. The data are read in
+        chunks of up to ``chunk_size`` lines, and the chunk size is halved if
+        the controller can't send that many lines in one reply.
+
+        :param int chunk_size: The number of lines to read per request.
+
+        :returns: A structured array with a float field for each gathered
+            type (``positioner.quantity``), in user units for positions, or
+            None if the data couldn't be read.
+        :rtype: numpy.ndarray
+        """
+        logger.debug('Reading %s gathered data', self.group)
+
+        num_points, maximum = self.get_gathering_number()
+
+        if num_points is None:
+            return None
+
+        types = self._gathering_types
+        data = np.empty(num_points, dtype=[(str(t), np.float64) for t, _ in types])
+        values = data.view(np.float64).reshape(num_points, len(types))
+
+        index = 0
+        while index < num_points:
+            nlines = min(chunk_size, num_points-index)
+
+            error, ret = self.xps.GatheringDataMultipleLinesGet(
+                self.sockets['general'], index, nlines)
+
+            if error != 0:
+                if chunk_size > 1:
+                    chunk_size = chunk_size//2
+                    continue
+
+                self.get_error('general', self.sockets['general'], error, ret)
+                return None
+
+            chunk = np.fromstring(ret.replace('\n', ';'), sep=';')
+
+            if chunk.size != nlines*len(types):
+                logger.error('Got %i values reading %s gathered data, expected %i',
+                    chunk.size, self.group, nlines*len(types))
+                return None
+
+            values[index:index+nlines] = chunk.reshape(nlines, len(types))
+            index += nlines
+
+        for i, (gtype, axis_index) in enumerate(types):
+            if gtype.endswith('Position'):
+                values[:, i] = values[:, i]*self._scale + self._offset[axis_index]
+
+        logger.info('Read %i %s gathered points', num_points, self.group)
+
+        return data
+
+    def load_trajectory(self, filename, segments, user, password,
+        positioner=None):
+        """
+        Writes a PVT trajectory to the controller trajectory folder over FTP
+        and checks it with the controller. The group has to be a
+        MultipleAxes group to run PVT trajectories.
+
+        :param str filename: The trajectory file name on the controller.
+
+        :param list segments: The trajectory, in user units, as made by
+            :py:func:`trajectory.raster_trajectory`.
+
+        :param str user: The controller FTP user name.
+
+        :param str password: The controller FTP password.
+
+        :param str positioner: The group to check the trajectory for.
+            Defaults to the motor group.
+
+        :returns: True if the trajectory was loaded and verified.
+        :rtype: bool
+        """
+        if positioner is None:
+            positioner = self.group
+
+        # Offsets cancel for displacements, so only the scale is applied
+        cor_segments = [(seg_time, [disp/self._scale for disp in disps],
+            [vel/self._scale for vel in vels]) for seg_time, disps, vels
+            in segments]
+
+        text = trajectory.format_pvt(cor_segments)
+
+        logger.debug('Uploading %s trajectory %s (%i elements)', positioner,
+            filename, len(segments))
+
+        try:
+            ftp = ftplib.FTP(self.ip_address, timeout=self.timeout)
+            ftp.login(user, password)
+            ftp.cwd('/Admin/Public/Trajectories')
+            ftp.storbinary('STOR {}'.format(filename),
+                io.BytesIO(text.encode('ascii')))
+            ftp.quit()
+        except Exception:
+            logger.error('Failed to upload %s trajectory %s:\n%s', positioner,
+                filename, traceback.format_exc())
+            return False
+
+        error, ret = self.xps.MultipleAxesPVTVerification(self.sockets['general'],
+            positioner, filename)
+
+        if error != 0:
+            self.get_error('general', self.sockets['general'], error, ret)
+            success = False
+        else:
+            success = True
+            logger.info('Loaded %s trajectory %s (%i elements)', positioner,
+                filename, len(segments))
+
+        return success
+
+    def run_trajectory(self, filename, num_executions=1, positioner=None):
+        """
+        Runs a trajectory loaded with :py:meth:`load_trajectory`. This
+        blocks on the move socket until the trajectory is done, so progress
+        should be read with :py:meth:`get_trajectory_element`.
+
+        :param str filename: The trajectory file name on the controller.
+
+        :param int num_executions: The number of times to run the trajectory.
+
+        :param str positioner: The group to run the trajectory on. Defaults
+            to the motor group.
+
+        :returns: True if the trajectory ran without error.
+        :rtype: bool
+        """
+        if positioner is None:
+            positioner = self.group
+
+        logger.debug('Running %s trajectory %s', positioner, filename)
+
+        error, ret = self.xps.MultipleAxesPVTExecution(self.sockets['move'],
+            positioner, filename, int(num_executions))
+
+        if error != 0:
+            self.get_error('move', self.sockets['move'], error, ret)
+            success = False
+        else:
+            success = True
+            logger.info('Finished %s trajectory %s', positioner, filename)
+
+        return success
+
+    def get_trajectory_element(self, positioner=None):
+        """
+        Returns the trajectory element being run, counted from 1, or None if
+        it can't be read.
+
+        :param str positioner: The group running the trajectory. Defaults to
+            the motor group.
+
+        :rtype: int
+        """
+        if positioner is None:
+            positioner = self.group
+
+        ret = self.xps.MultipleAxesPVTParametersGet(self.sockets['status'],
+            positioner)
+
+        if ret[0] != 0:
+            self.get_error('status', self.sockets['status'], ret[0], ret[1])
+            element = None
+        else:
+            element = ret[2]
+
+        return element
+
+
     def stop(self, positioner=None):
         if positioner is None:
             positioner = self.group
@@ -949,11 +1650,14 @@ class NewportXPSMotor(Motor):
         self.stop(positioner)
 
     def disconnect(self):
-        """Close any communication connections"""
+        """Returns the motor sockets to the connection pool"""
         for socket_id in self.sockets.values():
             logger.info('%s disconnecting from the XPS at %s:%i on socket %s', self.name,
                 self.ip_address, self.port, socket_id)
-            self.xps.TCP_CloseSocket(socket_id)
+            self._pool.release(socket_id)
+
+        self.sockets = {}
+        self._pool.log_usage()
 
 class NewportXPSSingleAxis(object):
 
@@ -1327,7 +2031,7 @@ class ZaberMotor(object):
         """Close any communication connections"""
         pass #Should be implimented in each subclass
 
-class MotorCommThread(threading.Thread):
+class MotorCommThread(commthread.CommThread):
     """
     This class creates a control thread for pumps attached to the system.
     This thread is designed for using a GUI application. For command line
@@ -1359,6 +2063,11 @@ class MotorCommThread(threading.Thread):
         my_pumpcon.stop()
     """
 
+    thread_type = 'motor'
+
+    monitor_commands = ('get_position', 'is_moving', 'positioner_is_moving',
+        'get_positioner_position', 'group_status', 'controller_status')
+
     def __init__(self, command_queue, answer_queue, abort_event, motor=None,
         name=None):
         """
@@ -1371,15 +2080,12 @@ class MotorCommThread(threading.Thread):
         :param threading.Event abort_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
         """
-        threading.Thread.__init__(self, name=name)
-        self.daemon = True
+        commthread.CommThread.__init__(self, command_queue, answer_queue,
+            abort_event, name=name)
 
         logger.info("Starting motor control thread: %s", self.name)
 
-        self.command_queue = command_queue
-        self.answer_queue = answer_queue
-        self._abort_event = abort_event
-        self._stop_event = threading.Event()
+        self.answer_queue = self.return_queue
 
         self._commands = {'connect'     : self._connect_motor,
             'disconnect'                : self._disconnect_motor,
@@ -1416,6 +2122,12 @@ class MotorCommThread(threading.Thread):
             'stop_position_compare'     : self._stop_position_compare,
             'get_position_compare_pulse': self._get_position_compare_pulse,
             'set_position_compare_pulse': self._set_position_compare_pulse,
+            'set_gathering'             : self._set_gathering,
+            'start_gathering'           : self._start_gathering,
+            'stop_gathering'            : self._stop_gathering,
+            'get_gathering_data'        : self._get_gathering_data,
+            'load_trajectory'           : self._load_trajectory,
+            'run_trajectory'            : self._run_trajectory,
             }
 
         self._connected_motors = OrderedDict()
@@ -1427,48 +2139,9 @@ class MotorCommThread(threading.Thread):
             'Zaber' : ZaberMotor,
             }
 
-    def run(self):
-        """
-        Custom run method for the thread.
-        """
-        while True:
-            if len(self.command_queue) > 0:
-                logger.debug("Getting new command")
-                command, args, kwargs = self.command_queue.popleft()
-            else:
-                command = None
-
-            if self._abort_event.is_set():
-                logger.debug("Abort event detected")
-                self._abort()
-                command = None
-
-            if self._stop_event.is_set():
-                logger.debug("Stop event detected")
-                self._abort()
-                break
-
-            if command is not None:
-                logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ", command, ', '.join(['{}'.format(a) for a in args]), ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()]))
-                try:
-                    self._commands[command](*args, **kwargs)
-                except Exception:
-                    msg = ("Motor control thread failed to run command '%s' "
-                        "with args: %s and kwargs: %s " %(command,
-                        ', '.join(['{}'.format(a) for a in args]),
-                        ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()])))
-                    logger.exception(msg)
-
-                    if command == 'connect' or command == 'disconnect':
-                        self.answer_queue.append(False)
-            else:
-                time.sleep(.01)
-
-        if self._stop_event.is_set():
-            self._stop_event.clear()
-        else:
-            self._abort()
-        logger.info("Quitting motor control thread: %s", self.name)
+    def _command_failed(self, command, args, kwargs):
+        if command == 'connect' or command == 'disconnect':
+            self._return_value(False)
 
     def _connect_motor(self, device, name, motor_type, **kwargs):
         """
@@ -1493,7 +2166,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Connecting motor %s", name)
         new_motor = self.known_motors[motor_type](device, name, **kwargs)
         self._connected_motors[name] = new_motor
-        self.answer_queue.append(True)
+        self._return_value(True)
         logger.debug("Motor %s connected", name)
 
     def _disconnect_motor(self, name, **kwargs):
@@ -1509,13 +2182,13 @@ class MotorCommThread(threading.Thread):
         motor = self._connected_motors[name]
         motor.disconnect()
         del self._connected_motors[name]
-        self.answer_queue.append(True)
+        self._return_value(True)
         logger.debug("Motor %s disconnected", name)
 
     def _add_motor(self, motor, name, **kwargs):
         logger.info('Adding motor %s', name)
         self._connected_motors[name] = motor
-        self.answer_queue.append(True)
+        self._return_value(True)
         logger.debug('Motor %s added', name)
 
     def _get_controller_status(self, name, **kwargs):
@@ -1530,7 +2203,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Getting motor %s controller status", name)
         motor = self._connected_motors[name]
         status, descrip = motor.get_controller_status()
-        self.answer_queue.append((status, descrip))
+        self._return_value((status, descrip))
         logger.debug("Got motor %s controller status", name)
 
     def _get_group_status(self, name, **kwargs):
@@ -1545,7 +2218,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Getting motor %s group status", name)
         motor = self._connected_motors[name]
         status, descrip = motor.get_group_status()
-        self.answer_queue.append((status, descrip))
+        self._return_value((status, descrip))
         logger.debug("Got motor %s group status", name)
 
     def _get_position(self, name, **kwargs):
@@ -1560,7 +2233,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Getting motor %s position(s)", name)
         motor = self._connected_motors[name]
         position = motor.position
-        self.answer_queue.append(position)
+        self._return_value(position)
         logger.debug("Got motor %s positions", name)
 
     def _set_position(self, name, positions, **kwargs):
@@ -1589,7 +2262,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Getting motor %s positioner %s position(s)", name, positioner)
         motor = self._connected_motors[name]
         position = motor.get_positioner_position(positioner, index)
-        self.answer_queue.append(position)
+        self._return_value(position)
         logger.debug("Got motor %s positioner %s positions", name, positioner)
 
     def _set_positioner_position(self, name, positioner, index, positions, **kwargs):
@@ -1618,7 +2291,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Getting motor %s units", name)
         motor = self._connected_motors[name]
         units = motor.units
-        self.answer_queue.append(units)
+        self._return_value(units)
         logger.debug("Got motor %s units", name)
 
     def _set_units(self, name, units, **kwargs):
@@ -1650,7 +2323,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Checking if motor %s is moving", name)
         motor = self._connected_motors[name]
         is_moving = motor.is_moving()
-        self.answer_queue.append(is_moving)
+        self._return_value(is_moving)
         logger.debug("Motor %s is moving: %s", name, str(is_moving))
 
     def _positioner_is_moving(self, name, positioner, **kwargs):
@@ -1668,7 +2341,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Checking if motor %s is moving", name)
         motor = self._connected_motors[name]
         is_moving = motor.positioner_is_moving()
-        self.answer_queue.append(is_moving)
+        self._return_value(is_moving)
         logger.debug("Motor %s is moving: %s", name, str(is_moving))
 
     def _move_relative(self, name, displacements, **kwargs):
@@ -1686,7 +2359,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Moving motor %s relative", name)
         motor = self._connected_motors[name]
         success = motor.move_relative(displacements)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s moved relative", name)
 
     def _move_absolute(self, name, positions, **kwargs):
@@ -1704,7 +2377,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Moving motor %s absolute", name)
         motor = self._connected_motors[name]
         success = motor.move_absolute(positions)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s moved absolute", name)
 
     def _move_positioner_relative(self, name, positioner, index, displacements, **kwargs):
@@ -1722,7 +2395,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Moving motor %s positioner %s relative", name, positioner)
         motor = self._connected_motors[name]
         success = motor.move_positioner_relative(positioner, index, displacements)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s positioner %s moved relative", name, positioner)
 
     def _move_positioner_absolute(self, name, positioner, index, positions, **kwargs):
@@ -1740,7 +2413,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Moving motor %s positioner %s absolute", name, positioner)
         motor = self._connected_motors[name]
         success = motor.move_positioner_absolute(positioner, index, positions)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s positioner %s moved absolute", name, positioner)
 
     def _home(self, name, **kwargs):
@@ -1758,7 +2431,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Homing motor %s", name)
         motor = self._connected_motors[name]
         success = motor.home()
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s homed", name)
 
     def _home_positioner(self, name, positioner, **kwargs):
@@ -1776,7 +2449,7 @@ class MotorCommThread(threading.Thread):
         logger.info("Homing motor %s positioner %s", name, positioner)
         motor = self._connected_motors[name]
         success = motor.home_positioner(positioner)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Motor %s positioner %s homed", name, positioner)
 
     def _get_high_limit(self, name, **kwargs):
@@ -1797,7 +2470,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Getting motor %s high limit", name)
         motor = self._connected_motors[name]
         limit = motor.get_high_limit(**kwargs)
-        self.answer_queue.append(limit)
+        self._return_value(limit)
         if 'positioner' in kwargs:
             logger.debug("Got motor %s positioner %s high limit", name, kwargs['positioner'])
         else:
@@ -1821,7 +2494,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Getting motor %s low limit", name)
         motor = self._connected_motors[name]
         limit = motor.get_low_limit(**kwargs)
-        self.answer_queue.append(limit)
+        self._return_value(limit)
         if 'positioner' in kwargs:
             logger.debug("Got motor %s positioner %s low limit", name, kwargs['positioner'])
         else:
@@ -1834,7 +2507,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Getting motor %s limits", name)
         motor = self._connected_motors[name]
         limit = motor.get_limits(**kwargs)
-        self.answer_queue.append(limit)
+        self._return_value(limit)
         if 'positioner' in kwargs:
             logger.debug("Got motor %s positioner %s limits", name, kwargs['positioner'])
         else:
@@ -1858,7 +2531,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Setting motor %s high limit", name)
         motor = self._connected_motors[name]
         success = motor.set_high_limit(limit, **kwargs)
-        self.answer_queue.append(success)
+        self._return_value(success)
         if 'positioner' in kwargs:
             logger.debug("Set motor %s positioner %s high limit", name, kwargs['positioner'])
         else:
@@ -1882,7 +2555,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Setting motor %s low limit", name)
         motor = self._connected_motors[name]
         success = motor.set_low_limit(limit, **kwargs)
-        self.answer_queue.append(success)
+        self._return_value(success)
         if 'positioner' in kwargs:
             logger.debug("Set motor %s positioner %s low limit", name, kwargs['positioner'])
         else:
@@ -1906,7 +2579,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Setting motor %s limits", name)
         motor = self._connected_motors[name]
         success = motor.set_limits(low_limit, high_limit, **kwargs)
-        self.answer_queue.append(success)
+        self._return_value(success)
         if 'positioner' in kwargs:
             logger.debug("Set motor %s positioner %s limits", name, kwargs['positioner'])
         else:
@@ -1930,7 +2603,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Getting motor %s velocity", name)
         motor = self._connected_motors[name]
         velocity = motor.get_velocity(**kwargs)
-        self.answer_queue.append(velocity)
+        self._return_value(velocity)
         if 'positioner' in kwargs:
             logger.debug("Got motor %s positioner %s velocity", name, kwargs['positioner'])
         else:
@@ -1954,7 +2627,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Setting motor %s velocity", name)
         motor = self._connected_motors[name]
         success = motor.set_velocity(velocity, **kwargs)
-        self.answer_queue.append(success)
+        self._return_value(success)
         if 'positioner' in kwargs:
             logger.debug("Set motor %s positioner %s velocity", name, kwargs['positioner'])
         else:
@@ -1978,7 +2651,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Getting motor %s acceleration", name)
         motor = self._connected_motors[name]
         acceleration = motor.get_acceleration(**kwargs)
-        self.answer_queue.append(acceleration)
+        self._return_value(acceleration)
         if 'positioner' in kwargs:
             logger.debug("Got motor %s positioner %s acceleration", name, kwargs['positioner'])
         else:
@@ -2002,7 +2675,7 @@ class MotorCommThread(threading.Thread):
             logger.info("Setting motor %s acceleration", name)
         motor = self._connected_motors[name]
         success = motor.set_acceleration(acceleration, **kwargs)
-        self.answer_queue.append(success)
+        self._return_value(success)
         if 'positioner' in kwargs:
             logger.debug("Set motor %s positioner %s acceleration", name, kwargs['positioner'])
         else:
@@ -2024,7 +2697,7 @@ class MotorCommThread(threading.Thread):
             name, positioner)
         motor = self._connected_motors[name]
         min_pos, max_pos, step, enable = motor.get_position_compare(positioner, index)
-        self.answer_queue.append((min_pos, max_pos, step, enable))
+        self._return_value((min_pos, max_pos, step, enable))
         logger.debug("Got motor %s positioner %s position compare settings", \
             name, positioner)
 
@@ -2046,7 +2719,7 @@ class MotorCommThread(threading.Thread):
         motor = self._connected_motors[name]
         success = motor.set_position_compare(positioner, index, min_pos, max_pos,
             step)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Set motor %s positioner %s position compare settings", \
             name, positioner)
 
@@ -2066,7 +2739,7 @@ class MotorCommThread(threading.Thread):
             name, positioner)
         motor = self._connected_motors[name]
         success = motor.start_position_compare(positioner, index)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Started motor %s positioner %s position compare", \
             name, positioner)
 
@@ -2086,7 +2759,7 @@ class MotorCommThread(threading.Thread):
             name, positioner)
         motor = self._connected_motors[name]
         success = motor.stop_position_compare(positioner, index)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Stopped motor %s positioner %s position compare", \
             name, positioner)
 
@@ -2106,7 +2779,7 @@ class MotorCommThread(threading.Thread):
          settings", name, positioner)
         motor = self._connected_motors[name]
         pulse_width, encoder_settle_time = motor.get_position_compare_pulse(positioner, index)
-        self.answer_queue.append((pulse_width, encoder_settle_time))
+        self._return_value((pulse_width, encoder_settle_time))
         logger.debug("Got motor %s positioner %s position compare pulse \
             settings", name, positioner)
 
@@ -2128,14 +2801,126 @@ class MotorCommThread(threading.Thread):
         motor = self._connected_motors[name]
         success = motor.set_position_compare(positioner, index, pulse_width,
             encoder_settle_time)
-        self.answer_queue.append(success)
+        self._return_value(success)
         logger.debug("Set motor %s positioner %s position compare pulse \
             settings", name, positioner)
 
+    def _set_gathering(self, name, positioners, indices, **kwargs):
+        """
+        This method configures the motor data gathering.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :param list positioners: The positioners to gather data for.
+
+        :param list indices: The axis index of each positioner.
+
+        :rtype: bool
+        """
+        logger.info("Setting motor %s gathering", name)
+        motor = self._connected_motors[name]
+        success = motor.set_gathering(positioners, indices, **kwargs)
+        self._return_value(success)
+        logger.debug("Set motor %s gathering", name)
+
+    def _start_gathering(self, name, num_points, **kwargs):
+        """
+        This method starts the motor data gathering.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :param int num_points: The number of points to gather.
+
+        :rtype: bool
+        """
+        logger.info("Starting motor %s gathering", name)
+        motor = self._connected_motors[name]
+        success = motor.start_gathering(num_points, **kwargs)
+        self._return_value(success)
+        logger.debug("Started motor %s gathering", name)
+
+    def _stop_gathering(self, name, **kwargs):
+        """
+        This method stops the motor data gathering.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :rtype: bool
+        """
+        logger.info("Stopping motor %s gathering", name)
+        motor = self._connected_motors[name]
+        success = motor.stop_gathering()
+        self._return_value(success)
+        logger.debug("Stopped motor %s gathering", name)
+
+    def _get_gathering_data(self, name, **kwargs):
+        """
+        This method returns the motor gathered data.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :returns: The gathered data, see
+            :py:meth:`NewportXPSMotor.get_gathering_data`.
+        :rtype: numpy.ndarray
+        """
+        logger.info("Getting motor %s gathered data", name)
+        motor = self._connected_motors[name]
+        data = motor.get_gathering_data(**kwargs)
+        self._return_value(data)
+        logger.debug("Got motor %s gathered data", name)
+
+    def _load_trajectory(self, name, filename, segments, user, password,
+        **kwargs):
+        """
+        This method loads and verifies a PVT trajectory on the motor
+        controller.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :param str filename: The trajectory file name on the controller.
+
+        :param list segments: The trajectory segments.
+
+        :param str user: The controller FTP user name.
+
+        :param str password: The controller FTP password.
+
+        :rtype: bool
+        """
+        logger.info("Loading motor %s trajectory %s", name, filename)
+        motor = self._connected_motors[name]
+        success = motor.load_trajectory(filename, segments, user, password,
+            **kwargs)
+        self._return_value(success)
+        logger.debug("Loaded motor %s trajectory %s", name, filename)
+
+    def _run_trajectory(self, name, filename, **kwargs):
+        """
+        This method runs a loaded PVT trajectory. It blocks until the
+        trajectory is done.
+
+        :param str name: The unique identifier for a motor that was used in the
+            :py:func:`_connect_motor` method.
+
+        :param str filename: The trajectory file name on the controller.
+
+        :rtype: bool
+        """
+        logger.info("Running motor %s trajectory %s", name, filename)
+        motor = self._connected_motors[name]
+        success = motor.run_trajectory(filename, **kwargs)
+        self._return_value(success)
+        logger.debug("Ran motor %s trajectory %s", name, filename)
+
     def _abort(self):
         """Clears the ``command_queue`` and aborts all current motor motions."""
         logger.info("Aborting motor control thread %s current and future commands", self.name)
-        self.command_queue.clear()
+        self._clear_commands()
 
         for name, motor in self._connected_motors.items():
             try:
@@ -2146,11 +2931,6 @@ class MotorCommThread(threading.Thread):
         self._abort_event.clear()
         logger.debug("Motor control thread %s aborted", self.name)
 
-    def stop(self):
-        """Stops the thread cleanly."""
-        logger.info("Starting to clean up and shut down motor control thread: %s", self.name)
-        self._stop_event.set()
-
 class MotorPanel(wx.Panel):
     """
     This pump panel supports standard flow controls and settings, including
@@ -2216,6 +2996,7 @@ class MotorPanel(wx.Panel):
         self.ports = ports
 
         self.monitor_event = threading.Event()
+        self.poller = commthread.AdaptivePoller(0.1, 2)
         self.monitor_thread = threading.Thread(target=self._update_status)
         self.monitor_thread.daemon = True
 
@@ -3019,10 +3800,7 @@ class MotorPanel(wx.Panel):
             else:
                 num_axes = 2
 
-            if frame.xps is None:
-                frame.xps = xps_drivers.XPS()
-
-            self.motor = NewportXPSMotor(group, frame.xps, ip, port, 20, group, num_axes)
+            self.motor = NewportXPSMotor(group, None, ip, port, 20, group, num_axes)
 
             group_status, descrip = self.motor.get_group_status()
 
@@ -3208,6 +3986,8 @@ class MotorPanel(wx.Panel):
         elif cmd == 'add_motor':
             self.motor_cmd_q.append(('add_motor', (self.motor, self.name), kwargs))
 
+        self.poller.wake()
+
     def _get_response(self):
         start_time = time.time()
         while len(self.answer_q) == 0 and time.time()-start_time < 5:
@@ -3268,39 +4048,51 @@ class MotorPanel(wx.Panel):
                 time.sleep(0.1)
 
     def _update_status(self):
-        interval = 0.1
+        # Labels are only updated when they change, so many open panels
+        # don't flood the GUI thread
+        labels = {}
 
-        start_time = time.time()
-        while True and not self.monitor_event.is_set():
-            if time.time() - start_time > interval:
-                if self.motor_params['type'] == 'Newport_XPS':
-                    mtr1_position = self.motor.get_positioner_position(self.motor_params['mtr1'], 0)
-                    wx.CallAfter(self.pos.SetLabel, str(mtr1_position))
+        def set_label(key, ctrl, label):
+            if labels.get(key) != label:
+                labels[key] = label
+                wx.CallAfter(ctrl.SetLabel, label)
+                return True
 
-                    if self.motor_params['num_axes'] == 2:
-                        mtr2_position = self.motor.get_positioner_position(self.motor_params['mtr2'], 0)
-                        wx.CallAfter(self.pos2.SetLabel, str(mtr2_position))
+            return False
 
-                    status, descrip = self.motor.get_group_status()
-                    wx.CallAfter(self._set_status, status, descrip)
+        # Polls fast while the motor moves or its state changes, and backs
+        # off while it is idle
+        while not self.monitor_event.is_set():
+            start_time = time.time()
+            active = False
 
-                    if int(status)>=43 and int(status)<=45:
-                        wx.CallAfter(self.moving.SetLabel, 'True')
-                    else:
-                        wx.CallAfter(self.moving.SetLabel, 'False')
+            if self.motor_params['type'] == 'Newport_XPS':
+                positions, status, descrip, moving = self.motor.get_group_state()
 
-                else:
-                    mtr_position = self.motor.position
-                    wx.CallAfter(self.pos.SetLabel, str(mtr_position))
+                if status is not None:
+                    active = set_label('pos', self.pos, str(positions[0])) or active
 
-                    if self.motor.is_moving():
-                        wx.CallAfter(self.moving.SetLabel, 'True')
-                    else:
-                        wx.CallAfter(self.moving.SetLabel, 'False')
+                    if self.motor_params['num_axes'] == 2:
+                        active = set_label('pos2', self.pos2, str(positions[1])) or active
+
+                    if labels.get('status') != status:
+                        labels['status'] = status
+                        wx.CallAfter(self._set_status, status, descrip)
+                        active = True
+
+                    active = set_label('moving', self.moving, str(moving)) or active
+                    active = active or bool(moving)
 
-                start_time = time.time()
             else:
-                time.sleep(.01)
+                mtr_position = self.motor.position
+                moving = self.motor.is_moving()
+
+                active = set_label('pos', self.pos, str(mtr_position))
+                active = set_label('moving', self.moving, str(moving)) or active
+                active = active or bool(moving)
+
+            self.poller.update(active)
+            self.poller.wait(start_time, self.monitor_event, 0.01)
 
 
     def on_exit(self):
@@ -3328,7 +4120,7 @@ class MotorFrame(wx.Frame):
         """
         super(MotorFrame, self).__init__(*args, **kwargs)
         logger.debug('Setting up the PumpFrame')
-        self.motor_cmd_q = deque()
+        self.motor_cmd_q = commthread.CommandQueue()
         self.motor_answer_q = deque()
         self.abort_event = threading.Event()
         self.motor_con = MotorCommThread(self.motor_cmd_q, self.motor_answer_q, self.abort_event, name='MotorCon')
@@ -3338,7 +4130,6 @@ class MotorFrame(wx.Frame):
 
         self.motors =[]
 
-        self.xps = None
         self.zaber = {}
 
         self._get_ports()
@@ -0,0 +1,169 @@
+# coding: utf-8
+#
+#    Project: BioCAT user beamline control software (BioCON)
+#             https://github.com/biocatiit/beamline-control-user
+#
+#
+#    Principal author:       Jesse Hopkins
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Message encoding for the :py:class:`server.ControlServer` and
+:py:class:`client.ControlClient` zmq messages.
+
+Messages are encoded as a list of zmq frames. JSON messages are a single
+frame. msgpack messages start with a tag byte that is never used by msgpack
+or JSON, so a receiver can tell the two apart without knowing which one the
+sender uses. Numpy arrays in msgpack messages are sent as extra frames
+holding the raw array data, and decoded as arrays that use the received
+frame memory, so large arrays are not copied. In JSON messages they are
+sent as lists.
+
+msgpack is optional, if it is not installed only JSON is available.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import object, range, map
+from io import open
+
+import json
+import logging
+
+if __name__ != '__main__':
+    logger = logging.getLogger(__name__)
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_MSGPACK_TAG = b'\xc1'
+_NDARRAY_EXT = 1
+
+#: The codecs available, in order of preference.
+if msgpack is not None:
+    CODECS = ['msgpack', 'json']
+else:
+    CODECS = ['json']
+
+
+def choose_codec(codecs):
+    """
+    Chooses the codec to use with a peer.
+
+    :param list codecs: The codecs the peer supports, in order of preference.
+
+    :returns: The first of the peer codecs that is available here, or
+        ``'json'`` if there are none.
+    :rtype: str
+    """
+    for codec in codecs:
+        if codec in CODECS:
+            return codec
+
+    return 'json'
+
+def encode(obj, codec='json'):
+    """
+    Encodes a message.
+
+    :param obj: The message.
+
+    :param str codec: The codec, either ``'json'`` or ``'msgpack'``.
+
+    :returns: The list of zmq frames for the message. Array frames
+        reference the array data, so the arrays must not be changed until
+        the message is sent.
+    :rtype: list
+    """
+    if codec == 'msgpack' and msgpack is not None:
+        buffers = []
+
+        def default(o):
+            if isinstance(o, np.ndarray) and not o.dtype.hasobject:
+                o = np.ascontiguousarray(o)
+                header = msgpack.packb([len(buffers),
+                    np.lib.format.dtype_to_descr(o.dtype), o.shape])
+                buffers.append(memoryview(o.reshape(-1).view(np.uint8)))
+
+                return msgpack.ExtType(_NDARRAY_EXT, header)
+
+            return _to_builtin(o)
+
+        payload = msgpack.packb(obj, default=default, use_bin_type=True)
+
+        return [_MSGPACK_TAG + payload] + buffers
+
+    else:
+        return [json.dumps(obj, default=_to_builtin).encode('utf-8')]
+
+def decode(frames):
+    """
+    Decodes a message.
+
+    :param list frames: The message zmq frames, as bytes or buffers.
+
+    :returns: ``(message, codec)``, where codec is the codec the message
+        was encoded with.
+    :rtype: tuple
+    """
+    payload = frames[0]
+
+    if bytes(payload[:1]) == _MSGPACK_TAG:
+        if msgpack is None:
+            raise ValueError('Received a msgpack message, but msgpack is not installed')
+
+        def ext_hook(code, data):
+            if code == _NDARRAY_EXT:
+                index, descr, shape = msgpack.unpackb(data, raw=False)
+                dtype = np.lib.format.descr_to_dtype(_to_descr(descr))
+
+                return np.frombuffer(frames[index+1], dtype=dtype).reshape(shape)
+
+            return msgpack.ExtType(code, data)
+
+        msg = msgpack.unpackb(memoryview(payload)[1:], ext_hook=ext_hook,
+            raw=False)
+        codec = 'msgpack'
+
+    else:
+        msg = json.loads(bytes(payload).decode('utf-8'))
+        codec = 'json'
+
+    return msg, codec
+
+def _to_builtin(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    elif isinstance(o, np.generic):
+        return o.item()
+
+    raise TypeError('Object of type {} can not be encoded'.format(type(o).__name__))
+
+def _to_descr(descr):
+    # msgpack turns the tuples in a structured array descr into lists
+    if isinstance(descr, list):
+        fields = []
+
+        for field in descr:
+            name = tuple(field[0]) if isinstance(field[0], list) else field[0]
+            field_descr = (name, _to_descr(field[1])) + tuple(tuple(shape)
+                for shape in field[2:])
+            fields.append(field_descr)
+
+        return fields
+
+    return descr
@@ -50,7 +50,6 @@ import scipy.optimize
 import scipy.interpolate
 
 import motorcon
-import XPS_C8_drivers as xps_drivers
 import utils
 utils.set_mppath() #This must be done before importing any Mp Modules.
 import Mp as mp
@@ -113,8 +112,6 @@ class ScanProcess(multiprocessing.Process):
         when the stop_event is set, and that allows the process to end gracefully.
         """
 
-        self.xps = xps_drivers.XPS()
-
         mp.set_user_interrupt_function(self._stop_scan)
 
         while True:
@@ -158,7 +155,7 @@ class ScanProcess(multiprocessing.Process):
         self.mx_database = mp.setup_database(self.db_path)
         self.mx_database.set_plot_enable(2)
 
-        self.np_motor = motorcon.NewportXPSMotor('XY', self.xps, '164.54.204.76', 5001, 20, 'XY', 2)
+        self.np_motor = motorcon.NewportXPSMotor('XY', None, '164.54.204.76', 5001, 20, 'XY', 2)
 
     def _get_devices(self):
         """
@@ -24,6 +24,8 @@ from io import open
 
 import traceback
 import threading
+import contextlib
+import re
 import time
 import collections
 from collections import OrderedDict, deque
@@ -41,24 +43,44 @@ import serial.tools.list_ports as list_ports
 import wx
 from six import string_types
 
+import commthread
+
 print_lock = threading.RLock()
 
 class SerialComm(object):
     """
     This class impliments a generic serial communication setup. The goal is
     to provide a lightweight wrapper around a pyserial Serial device to make sure
-    ports are properly opened and closed whenever used.
+    ports are properly opened and closed whenever used. In persistent mode
+    the port is instead opened once and kept open for the lifetime of the
+    device, and is reopened automatically after a communication error.
+    Persistent connections are shared between all devices on a port, see
+    :py:func:`get_comm`.
     """
+    _shared_comms = {}
+    _shared_comms_lock = threading.Lock()
+
+    # How far (in s) a read may run past the deadline in _read_frame
+    timeout_slack = 0.05
+
     def __init__(self, port=None, baudrate=9600, bytesize=serial.EIGHTBITS,
         parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=None,
         xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False,
-        inter_byte_timeout=None, exclusive=None):
+        inter_byte_timeout=None, exclusive=None, persistent=False):
         """
         Parameters are all of those accepted by a
         `pyserial.Serial <https://pyserial.readthedocs.io/en/latest/pyserial_api.html#serial.Serial>`_
         device, defaults are set to those default values.
+
+        :param bool persistent: If ``True``, the port is left open between
+            commands instead of being opened and closed around every read
+            and write. Defaults to ``False``.
         """
         self.ser = None
+        self.port = port
+        self.persistent = persistent
+        self._frame_buffer = bytearray()
+        self._users = 1
 
         logger.info("Attempting to connect to serial device on port %s", port)
 
@@ -71,15 +93,190 @@ class SerialComm(object):
         except serial.SerialException:
             logger.exception("Failed to connect to serial device on port %s", port)
         finally:
-            if self.ser is not None:
+            if self.ser is not None and not self.persistent:
                 self.ser.close()
 
+    @classmethod
+    def get_comm(cls, port, persistent=False, **kwargs):
+        """
+        Returns a ``SerialComm`` (of the calling class) for the port. In
+        persistent mode the port can only be held open once, so devices
+        that are daisy-chained on the same port (and so share a
+        ``comm_lock``) share a single persistent connection. The port is
+        closed when the last device using it calls :py:func:`close`.
+        Outside of persistent mode a new ``SerialComm`` is returned.
+
+        :param str port: The device comport as sent to pyserial.
+
+        :param bool persistent: Whether to use a persistent connection.
+
+        :param \*\*kwargs: Any other ``SerialComm`` parameters. For a port
+            that is already open these must match those used to open it.
+
+        :returns: The serial communication object for the port.
+        :rtype: SerialComm
+        """
+        if not persistent:
+            return cls(port, **kwargs)
+
+        with SerialComm._shared_comms_lock:
+            comm = SerialComm._shared_comms.get(port)
+
+            if comm is not None and comm.ser is not None:
+                if type(comm) is not cls:
+                    logger.error("Serial device on port %s is already open as "
+                        "a %s", port, type(comm).__name__)
+                    raise ValueError("Port %s is already open as a %s"
+                        %(port, type(comm).__name__))
+
+                comm._users += 1
+                logger.info("Sharing persistent connection to serial device "
+                    "on port %s", port)
+
+            else:
+                comm = cls(port, persistent=True, **kwargs)
+                SerialComm._shared_comms[port] = comm
+
+        return comm
+
     def __repr__(self):
         return self.ser
 
     def __str__(self):
         return print(self.ser)
 
+    @contextlib.contextmanager
+    def _open_port(self):
+        """
+        Context manager that yields an open Serial device. Outside of
+        persistent mode the port is opened on entry and closed on exit.
+        In persistent mode the port is only (re)opened if it isn't already
+        open, and it is closed if a communication error occurs so that the
+        next command reconnects.
+        """
+        if not self.persistent:
+            with self.ser as s:
+                yield s
+
+        else:
+            if not self.ser.is_open:
+                logger.info("Reconnecting to serial device on port %s", self.ser.port)
+                self.ser.open()
+
+            try:
+                yield self.ser
+            except (serial.SerialException, OSError):
+                logger.error("Communication error on serial device on port %s, "
+                    "closing port", self.ser.port)
+                self.ser.close()
+                raise
+
+    def close(self):
+        """
+        Closes the serial port. For a persistent connection shared between
+        several devices, the port is only closed once every device has
+        closed it.
+        """
+        with SerialComm._shared_comms_lock:
+            if self._users > 1:
+                self._users -= 1
+                return
+
+            self._users = 0
+            if SerialComm._shared_comms.get(self.port) is self:
+                del SerialComm._shared_comms[self.port]
+
+        if self.ser is not None:
+            self.ser.close()
+
+    def _clear_input(self, s):
+        """
+        Discards any unread bytes left over from a previous command, both
+        in the partial frame buffer and, for a persistent port, in the
+        serial input buffer. Called before a new command is sent.
+
+        :param serial.Serial s: The open serial device.
+        """
+        if len(self._frame_buffer) > 0:
+            logger.debug("Discarding %r from serial device on port %s",
+                bytes(self._frame_buffer), self.ser.port)
+            del self._frame_buffer[:]
+
+        if self.persistent:
+            s.reset_input_buffer()
+
+    def _read_frame(self, s, terminator, timeout=None):
+        """
+        Reads a response frame from the serial device. This blocks in the
+        serial read (rather than polling) until the terminator has been
+        received or the timeout expires. Data are accumulated in a partial
+        frame buffer, so a response that arrives split across several reads
+        is stitched together, and any bytes received after the terminator
+        are kept for the next frame.
+
+        :param serial.Serial s: The open serial device.
+
+        :param terminator: The terminator that ends the frame. Can be a
+            string, a list of strings (any of which ends the frame), or a
+            compiled bytes regular expression.
+
+        :param float timeout: Deadline in seconds for the whole frame, which
+            may be overrun by up to ``timeout_slack``. If ``None`` (default),
+            waits until the terminator is received.
+
+        :returns: The ascii (decoded) frame including the terminator. If
+            the timeout expires, whatever partial frame was received.
+        :rtype: str
+        """
+        if isinstance(terminator, string_types):
+            terminator = [terminator]
+
+        if not hasattr(terminator, 'search'):
+            terminator = re.compile(b'|'.join([re.escape(term.encode())
+                for term in terminator]))
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        old_timeout = s.timeout
+        match = terminator.search(self._frame_buffer)
+
+        try:
+            while match is None:
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+
+                    # Setting the timeout reconfigures the port, so it's only
+                    # shortened once the read could overrun the deadline by
+                    # more than timeout_slack
+                    if s.timeout is None or s.timeout > remaining + self.timeout_slack:
+                        s.timeout = remaining
+
+                elif s.timeout is not None:
+                    s.timeout = None
+
+                ret = s.read(max(1, s.in_waiting))
+                if len(ret) > 0:
+                    self._frame_buffer.extend(ret)
+                    match = terminator.search(self._frame_buffer)
+        finally:
+            if s.timeout != old_timeout:
+                s.timeout = old_timeout
+
+        if match is not None:
+            end = match.end()
+        else:
+            end = len(self._frame_buffer)
+            logger.debug("Timed out waiting for response from serial device "
+                "on port %s", self.ser.port)
+
+        frame = bytes(self._frame_buffer[:end])
+        del self._frame_buffer[:end]
+
+        return frame.decode('ascii')
+
     def read(self, size=1):
         """
         This wraps the Serial.read() function for reading in a specified
@@ -91,8 +288,12 @@ class SerialComm(object):
         :returns: The ascii (decoded) value of the ``Serial.read()``
         :rtype: str
         """
-        with self.ser as s:
-            ret = s.read(size)
+        with self._open_port() as s:
+            ret = bytes(self._frame_buffer[:size])
+            del self._frame_buffer[:size]
+
+            if len(ret) < size:
+                ret = ret + s.read(size-len(ret))
 
         logger.debug("Read %i bytes from serial device on port %s", size, self.ser.port)
         logger.debug("Serial device on port %s returned %s", self.ser.port, ret.decode('utf-8'))
@@ -107,15 +308,17 @@ class SerialComm(object):
         :returns: The ascii (decoded) value of the ``Serial.read()``
         :rtype: str
         """
-        with self.ser as s:
-            ret = s.read(s.in_waiting)
+        with self._open_port() as s:
+            ret = bytes(self._frame_buffer) + s.read(s.in_waiting)
+            del self._frame_buffer[:]
 
         logger.debug("Read all waiting bytes from serial device on port %s", self.ser.port)
         logger.debug("Serial device on port %s returned %s", self.ser.port, ret.decode('utf-8'))
 
         return ret.decode('utf-8')
 
-    def write(self, data, get_response=False, send_term_char = '\r\n', term_char='>'):
+    def write(self, data, get_response=False, send_term_char = '\r\n',
+        term_char='>', timeout=None):
         """
         This warps the Serial.write() function. It encodes the input
         data if necessary. It can return any expected response from the
@@ -127,6 +330,10 @@ class SerialComm(object):
         :param term_char: The terminal character expected in a response
         :type term_char: str
 
+        :param timeout: Deadline in seconds to wait for the response. If
+            ``None`` (default), waits until the response is received.
+        :type timeout: float
+
         :returns: The requested response, or an empty string
         :rtype: str
         """
@@ -138,15 +345,11 @@ class SerialComm(object):
 
         out = ''
         try:
-            with self.ser as s:
+            with self._open_port() as s:
+                self._clear_input(s)
                 s.write(data)
                 if get_response:
-                    while not out.endswith(term_char):
-                        if s.in_waiting > 0:
-                            ret = s.read(s.in_waiting)
-                            out += ret.decode('ascii')
-
-                        time.sleep(.001)
+                    out = self._read_frame(s, term_char, timeout)
         except ValueError:
             logger.exception("Failed to write '%s' to serial device on port %s", data, self.ser.port)
 
@@ -160,7 +363,7 @@ class MForceSerialComm(SerialComm):
     errors.
     """
 
-    def write(self, data, get_response=True, term_char='>'):
+    def write(self, data, get_response=True, term_char='>', timeout=1):
         """
         This warps the Serial.write() function. It encodes the input
         data if necessary. It can return any expected response from the
@@ -172,6 +375,10 @@ class MForceSerialComm(SerialComm):
         :param term_char: The terminal character expected in a response
         :type term_char: str
 
+        :param timeout: Deadline in seconds to wait for the response,
+            including any error query. Defaults to 1 s.
+        :type timeout: float
+
         :returns: The requested response, or an empty string
         :rtype: str
         """
@@ -182,22 +389,22 @@ class MForceSerialComm(SerialComm):
             data = data.encode()
 
         out = ''
-        timeout = 1
         start_time = time.time()
         try:
-            with self.ser as s:
+            with self._open_port() as s:
+                self._clear_input(s)
                 s.write(data)
                 if get_response:
-                    while not out.strip().endswith(term_char) and time.time()-start_time<timeout:
-                        if s.in_waiting > 0:
-                            ret = s.read(s.in_waiting)
-                            out += ret.decode('ascii')
+                    while True:
+                        remaining = timeout - (time.time()-start_time)
+                        out = self._read_frame(s, [term_char, '?'], max(remaining, 0))
 
-                        if out.strip().endswith('?'):
+                        if out.strip().endswith('?') and time.time()-start_time < timeout:
+                            # Controller flagged an error, get the error code
                             s.write('PR ER\r\n'.encode())
                             out = ''
-
-                        time.sleep(.001)
+                        else:
+                            break
         except ValueError:
             logger.exception("Failed to write %r to serial device on port %s", data, self.ser.port)
 
@@ -212,7 +419,7 @@ class PHD4400SerialComm(SerialComm):
     """
 
     def write(self, data, pump_address, get_response=False, send_term_char = '\r',
-        term_chars=':></*^'):
+        term_chars=':></*^', timeout=None):
         """
         This warps the Serial.write() function. It encodes the input
         data if necessary. It can return any expected response from the
@@ -224,6 +431,10 @@ class PHD4400SerialComm(SerialComm):
         :param term_char: The terminal character expected in a response
         :type term_char: str
 
+        :param timeout: Deadline in seconds to wait for the response. If
+            ``None`` (default), waits until the response is received.
+        :type timeout: float
+
         :returns: The requested response, or an empty string
         :rtype: str
         """
@@ -237,21 +448,11 @@ class PHD4400SerialComm(SerialComm):
 
         possible_term = ['\n{}{}'.format(pump_address, char) for char in term_chars]
         try:
-            with self.ser as s:
+            with self._open_port() as s:
+                self._clear_input(s)
                 s.write(data)
                 if get_response:
-                    got_resp = False
-                    while not got_resp:
-                        if s.in_waiting > 0:
-                            ret = s.read(s.in_waiting)
-                            out += ret.decode('ascii')
-                            # logger.debug(out)
-                            for term in possible_term:
-                                if out.endswith(term):
-                                    got_resp = True
-                                    break
-
-                        time.sleep(.001)
+                    out = self._read_frame(s, possible_term, timeout)
         except ValueError:
             logger.exception("Failed to write '%s' to serial device on port %s", data, self.ser.port)
         except Exception:
@@ -420,7 +621,8 @@ class M50Pump(Pump):
         >>> my_pump.stop_flow()
     """
 
-    def __init__(self, device, name, comm_lock=threading.Lock(), flow_cal=628., backlash_cal=1.5):
+    def __init__(self, device, name, comm_lock=threading.Lock(), flow_cal=628.,
+        backlash_cal=1.5, persistent_comm=False):
         """
         This makes the initial serial connection, and then sets the MForce
         controller parameters to the correct values.
@@ -436,6 +638,10 @@ class M50Pump(Pump):
 
         :param backlash_cal: The pump-specific backlash calibration, in uL. Default to 1.5 uL
         :type backlash_cal: float
+
+        :param persistent_comm: If ``True`` the serial port is kept open for
+            the lifetime of the pump. Defaults to ``False``.
+        :type persistent_comm: bool
         """
         Pump.__init__(self, device, name)
 
@@ -447,7 +653,7 @@ class M50Pump(Pump):
         self.comm_lock = comm_lock
 
         self.comm_lock.acquire()
-        self.pump_comm = MForceSerialComm(device)
+        self.pump_comm = MForceSerialComm.get_comm(device, persistent=persistent_comm)
         self.comm_lock.release()
 
 
@@ -620,7 +826,7 @@ class M50Pump(Pump):
 
     def disconnect(self):
         logger.debug("Closing pump %s serial connection", self.name)
-        self.pump_comm.ser.close()
+        self.pump_comm.close()
 
 class PHD4400Pump(Pump):
     """
@@ -633,13 +839,17 @@ class PHD4400Pump(Pump):
     """
 
     def __init__(self, device, name, pump_address, diameter, max_volume, max_rate,
-        syringe_id, dual_syringe, comm_lock):
+        syringe_id, dual_syringe, comm_lock, persistent_comm=False):
         """
         :param device: The device comport as sent to pyserial
         :type device: str
 
         :param name: A unique identifier for the pump
         :type name: str
+
+        :param persistent_comm: If ``True`` the serial port is kept open for
+            the lifetime of the pump. Defaults to ``False``.
+        :type persistent_comm: bool
         """
 
         Pump.__init__(self, device, name)
@@ -650,8 +860,8 @@ class PHD4400Pump(Pump):
         self.comm_lock = comm_lock
 
         self.comm_lock.acquire()
-        self.pump_comm = PHD4400SerialComm(device, stopbits=serial.STOPBITS_TWO,
-            baudrate=19200)
+        self.pump_comm = PHD4400SerialComm.get_comm(device, stopbits=serial.STOPBITS_TWO,
+            baudrate=19200, persistent=persistent_comm)
         self.comm_lock.release()
 
         self._is_flowing = False
@@ -1004,7 +1214,7 @@ class PHD4400Pump(Pump):
     def disconnect(self):
         """Close any communication connections"""
         logger.debug("Closing pump %s serial connection", self.name)
-        self.pump_comm.ser.close()
+        self.pump_comm.close()
 
 
 class NE500Pump(Pump):
@@ -1018,13 +1228,17 @@ class NE500Pump(Pump):
     """
 
     def __init__(self, device, name, pump_address, diameter, max_volume, max_rate,
-        syringe_id, dual_syringe, comm_lock):
+        syringe_id, dual_syringe, comm_lock, persistent_comm=False):
         """
         :param device: The device comport as sent to pyserial
         :type device: str
 
         :param name: A unique identifier for the pump
         :type name: str
+
+        :param persistent_comm: If ``True`` the serial port is kept open for
+            the lifetime of the pump. Defaults to ``False``.
+        :type persistent_comm: bool
         """
 
         Pump.__init__(self, device, name)
@@ -1035,7 +1249,8 @@ class NE500Pump(Pump):
         self.comm_lock = comm_lock
 
         self.comm_lock.acquire()
-        self.pump_comm = SerialComm(device, baudrate=19200)
+        self.pump_comm = SerialComm.get_comm(device, baudrate=19200,
+            persistent=persistent_comm)
         self.comm_lock.release()
 
         self._is_flowing = False
@@ -1380,7 +1595,7 @@ class NE500Pump(Pump):
     def disconnect(self):
         """Close any communication connections"""
         logger.debug("Closing pump %s serial connection", self.name)
-        self.pump_comm.ser.close()
+        self.pump_comm.close()
 
 
 class SoftPump(Pump):
@@ -1967,7 +2182,7 @@ class SoftSyringePump(Pump):
         self.sim_thread.join()
 
 
-class PumpCommThread(threading.Thread):
+class PumpCommThread(commthread.CommThread):
     """
     This class creates a control thread for pumps attached to the system.
     This thread is designed for using a GUI application. For command line
@@ -1979,9 +2194,10 @@ class PumpCommThread(threading.Thread):
         import collections
         import threading
 
-        pump_cmd_q = collections.deque()
+        pump_cmd_q = commthread.CommandQueue()
+        pump_return_q = collections.deque()
         abort_event = threading.Event()
-        my_pumpcon = PumpCommThread(pump_cmd_q, abort_event)
+        my_pumpcon = PumpCommThread(pump_cmd_q, pump_return_q, abort_event)
         my_pumpcon.start()
 
         init_cmd = ('connect', ('COM6', 'pump2', 'VICI_M50'),
@@ -1996,9 +2212,29 @@ class PumpCommThread(threading.Thread):
         time.sleep(5)
         pump_cmd_q.append(stop_cmd)
 
+        # Alternatively, get a future for the command answer
+        volume = my_pumpcon.submit('get_volume', ('pump2',)).result()
+
         my_pumpcon.stop()
+
+    Commands for each serial port run on a separate worker thread (see
+    :py:class:`commthread.CommThread`), so a slow pump on one port doesn't
+    delay a ``stop`` for a pump on another port.
     """
 
+    thread_type = 'pump'
+
+    port_workers = True
+
+    control_commands = ('stop',)
+
+    connect_commands = ('connect', 'connect_remote', 'add_pump')
+
+    monitor_commands = ('get_status', 'get_status_multi', 'is_moving',
+        'get_volume', 'get_cached')
+
+    coalesce_commands = ('set_flow_rate', 'set_refill_rate')
+
     def __init__(self, command_queue, return_queue, abort_event, name=None):
         """
         Initializes the custom thread. Important parameters here are the
@@ -2010,16 +2246,11 @@ class PumpCommThread(threading.Thread):
         :param threading.Event abort_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
         """
-        threading.Thread.__init__(self, name=name)
-        self.daemon = True
+        commthread.CommThread.__init__(self, command_queue, return_queue,
+            abort_event, name=name)
 
         logger.info("Starting pump control thread: %s", self.name)
 
-        self.command_queue = command_queue
-        self.return_queue = return_queue
-        self._abort_event = abort_event
-        self._stop_event = threading.Event()
-
         self._commands = {'connect'     : self._connect_pump,
                         'set_flow_rate' : self._set_flow_rate,
                         'set_refill_rate': self._set_refill_rate,
@@ -2042,10 +2273,14 @@ class PumpCommThread(threading.Thread):
                         'get_status'    : self._get_status,
                         'get_status_multi': self._get_status_multiple,
                         'set_pump_dual_syringe': self._set_dual_syringe,
+                        'get_cached'    : self._get_cached,
                         }
 
         self._connected_pumps = OrderedDict()
 
+        # Pumps are connected and disconnected on the port workers
+        self._pumps_lock = threading.Lock()
+
         self.comm_locks = {}
 
         self.known_pumps = {'VICI_M50'      : M50Pump,
@@ -2055,51 +2290,14 @@ class PumpCommThread(threading.Thread):
                             'Soft_Syringe'  : SoftSyringePump,
                             }
 
-    def run(self):
-        """
-        Custom run method for the thread.
-        """
-        while True:
-            if len(self.command_queue) > 0:
-                logger.debug("Getting new command")
-                command, args, kwargs = self.command_queue.popleft()
-            else:
-                command = None
-
-            if self._abort_event.is_set():
-                logger.debug("Abort event detected")
-                self._abort()
-                command = None
+    def _command_failed(self, command, args, kwargs):
+        if command == 'connect':
+            self._return_value((args[1], 'connect', False))
+        elif command == 'disconnect':
+            self._return_value((args[0], 'disconnect', False))
 
-            if self._stop_event.is_set():
-                logger.debug("Stop event detected")
-                self._abort()
-                break
-
-            if command is not None:
-                logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ", command, ', '.join(['{}'.format(a) for a in args]), ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()]))
-                try:
-                    self._commands[command](*args, **kwargs)
-                except Exception:
-                    msg = ("Pump control thread failed to run command '%s' "
-                        "with args: %s and kwargs: %s " %(command,
-                        ', '.join(['{}'.format(a) for a in args]),
-                        ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()])))
-                    logger.exception(msg)
-
-                    if command == 'connect':
-                        self.return_queue.append((args[1], 'connect', False))
-                    elif command == 'disconnect':
-                        self.return_queue.append((args[0], 'disconnect', False))
-
-            else:
-                time.sleep(0.01)
-
-        if self._stop_event.is_set():
-            self._stop_event.clear()
-        else:
-            self._abort()
-        logger.info("Quitting pump control thread: %s", self.name)
+    def _get_device(self, name):
+        return self._connected_pumps.get(name)
 
     def _connect_pump(self, device, name, pump_type, **kwargs):
         """
@@ -2123,8 +2321,10 @@ class PumpCommThread(threading.Thread):
         """
         logger.info("Connecting pump %s", name)
         new_pump = self.known_pumps[pump_type](device, name, **kwargs)
-        self._connected_pumps[name] = new_pump
-        self.return_queue.append((name, 'connect', True))
+        with self._pumps_lock:
+            self._connected_pumps[name] = new_pump
+        self.state_cache.invalidate(name)
+        self._return_value((name, 'connect', True))
         logger.debug("Pump %s connected", name)
 
     def _connect_pump_remote(self, device, name, pump_type, **kwargs):
@@ -2153,8 +2353,10 @@ class PumpCommThread(threading.Thread):
 
         new_pump = self.known_pumps[pump_type](device, name, **kwargs)
 
-        self._connected_pumps[name] = new_pump
-        self.return_queue.append((name, 'connect', True))
+        with self._pumps_lock:
+            self._connected_pumps[name] = new_pump
+        self.state_cache.invalidate(name)
+        self._return_value((name, 'connect', True))
         logger.debug("Pump %s connected", name)
 
     def _disconnect_pump(self, name):
@@ -2169,14 +2371,18 @@ class PumpCommThread(threading.Thread):
         logger.info("Disconnecting pump %s", name)
         pump = self._connected_pumps[name]
         pump.disconnect()
-        del self._connected_pumps[name]
-        self.return_queue.append((name, 'disconnect', True))
+        with self._pumps_lock:
+            del self._connected_pumps[name]
+        self.state_cache.invalidate(name)
+        self._return_value((name, 'disconnect', True))
         logger.debug("Pump %s disconnected", name)
 
     def _add_pump(self, pump, name, **kwargs):
         logger.info('Adding pump %s', name)
-        self._connected_pumps[name] = pump
-        self.return_queue.append((name, 'add', True))
+        with self._pumps_lock:
+            self._connected_pumps[name] = pump
+        self.state_cache.invalidate(name)
+        self._return_value((name, 'add', True))
         logger.debug('Pump %s added', name)
 
     def _set_flow_rate(self, name, flow_rate):
@@ -2191,6 +2397,7 @@ class PumpCommThread(threading.Thread):
         logger.info("Setting pump %s flow rate", name)
         pump = self._connected_pumps[name]
         pump.flow_rate = flow_rate
+        self.state_cache.update(name, flow_rate=flow_rate)
         logger.debug("Pump %s flow rate set", name)
 
     def _set_refill_rate(self, name, refill_rate):
@@ -2206,6 +2413,7 @@ class PumpCommThread(threading.Thread):
         logger.info("Setting pump %s refill rate", name)
         pump = self._connected_pumps[name]
         pump.refill_rate = refill_rate
+        self.state_cache.update(name, refill_rate=refill_rate)
         logger.debug("Pump %s refill rate set", name)
 
     def _set_units(self, name, units):
@@ -2223,6 +2431,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Setting pump %s units", name)
         pump = self._connected_pumps[name]
         pump.units = units
+        # Cached rates and volumes are in the old units
+        self.state_cache.invalidate(name)
         logger.debug("Pump %s units set", name)
 
     def _set_volume(self, name, volume):
@@ -2237,6 +2447,7 @@ class PumpCommThread(threading.Thread):
         logger.info("Setting pump %s volume", name)
         pump = self._connected_pumps[name]
         pump.volume = volume
+        self.state_cache.update(name, volume=volume)
         logger.debug("Pump %s volume set", name)
 
     def _get_volume(self, name):
@@ -2249,7 +2460,8 @@ class PumpCommThread(threading.Thread):
         logger.debug("Getting pump %s volume", name)
         pump = self._connected_pumps[name]
         volume = pump.volume
-        self.return_queue.append((name, 'volume', volume))
+        self.state_cache.update(name, volume=volume)
+        self._return_value((name, 'volume', volume))
         logger.debug("Pump %s volume is %f", name, volume)
 
     def _start_flow(self, name, callback=None):
@@ -2262,7 +2474,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Starting pump %s continuous flow", name)
         pump = self._connected_pumps[name]
         pump.start_flow()
-        self.return_queue.append((name, 'start', True))
+        self._set_started(name)
+        self._return_value((name, 'start', True))
 
         if callback is not None:
             callback()
@@ -2279,7 +2492,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Stopping pump %s", name)
         pump = self._connected_pumps[name]
         pump.stop()
-        self.return_queue.append((name, 'stop', True))
+        self.state_cache.update(name, moving=False)
+        self._return_value((name, 'stop', True))
         logger.debug("Pump %s stopped", name)
 
     def _aspirate(self, name, vol, callback=None, units='uL'):
@@ -2296,7 +2510,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Aspirating pump %s", name)
         pump = self._connected_pumps[name]
         pump.aspirate(vol, units)
-        self.return_queue.append((name, 'start', True))
+        self._set_started(name)
+        self._return_value((name, 'start', True))
 
         if callback is not None:
             callback()
@@ -2313,7 +2528,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Aspirating all for pump %s", name)
         pump = self._connected_pumps[name]
         pump.aspirate_all()
-        self.return_queue.append((name, 'start', True))
+        self._set_started(name)
+        self._return_value((name, 'start', True))
 
         if callback is not None:
             callback()
@@ -2334,7 +2550,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Dispensing pump %s", name)
         pump = self._connected_pumps[name]
         pump.dispense(vol, units)
-        self.return_queue.append((name, 'start', True))
+        self._set_started(name)
+        self._return_value((name, 'start', True))
 
         if callback is not None:
             callback()
@@ -2351,7 +2568,8 @@ class PumpCommThread(threading.Thread):
         logger.info("Dispensing all from pump %s", name)
         pump = self._connected_pumps[name]
         pump.dispense_all()
-        self.return_queue.append((name, 'start', True))
+        self._set_started(name)
+        self._return_value((name, 'start', True))
 
         if callback is not None:
             callback()
@@ -2373,13 +2591,15 @@ class PumpCommThread(threading.Thread):
         logger.debug("Checking if pump %s is moving", name)
         pump = self._connected_pumps[name]
         is_moving = pump.is_moving()
-        self.return_queue.append((name, 'moving', is_moving))
+        self.state_cache.update(name, moving=is_moving)
+        self._return_value((name, 'moving', is_moving))
         logger.debug("Pump %s is moving: %s", name, str(is_moving))
 
     def _set_pump_cal(self, name, diameter, max_volume, max_rate, syringe_id):
         logger.info("Setting pump %s calibration parameters", name)
         pump = self._connected_pumps[name]
         pump.set_pump_cal(diameter, max_volume, max_rate, syringe_id)
+        self.state_cache.invalidate(name)
         logger.debug("Pump %s calibration parameters set", name)
 
     def _set_dual_syringe(self, name, dual_syringe):
@@ -2390,20 +2610,44 @@ class PumpCommThread(threading.Thread):
 
     def _get_status(self, name):
         logger.debug("Getting pump status")
+        self._return_value((name, 'status', self._read_status(name)))
+
+    def _get_status_multiple(self, names=None):
+        if names is None:
+            with self._pumps_lock:
+                names = list(self._connected_pumps.keys())
+
+        status = self._map_devices(self._read_status, names)
+
+        self._return_value((names, 'multi_status', status))
+
+    def _read_status(self, name):
         pump = self._connected_pumps[name]
         is_moving = pump.is_moving()
         volume = pump.volume
-        self.return_queue.append((name, 'status', (is_moving, volume)))
 
-    def _get_status_multiple(self, names):
-        status = []
-        for name in names:
-            pump = self._connected_pumps[name]
-            is_moving = pump.is_moving()
-            volume = pump.volume
-            status.append((is_moving, volume))
+        self.state_cache.update(name, moving=is_moving, volume=volume)
+
+        return is_moving, volume
+
+    def _read_state(self, name, fields):
+        pump = self._connected_pumps[name]
+        values = {}
+
+        for field in fields:
+            if field == 'moving':
+                values[field] = pump.is_moving()
+            elif field in ('volume', 'flow_rate', 'refill_rate'):
+                values[field] = getattr(pump, field)
+            else:
+                raise KeyError('Unknown pump state field {}'.format(field))
+
+        return values
 
-        self.return_queue.append((names, 'multi_status', status))
+    def _set_started(self, name):
+        # The volume changes until the pump stops
+        self.state_cache.invalidate(name, 'volume')
+        self.state_cache.update(name, moving=True)
 
     def _send_cmd(self, name, cmd, get_response=True):
         """
@@ -2430,19 +2674,18 @@ class PumpCommThread(threading.Thread):
     def _abort(self):
         """Clears the ``command_queue`` and aborts all current pump motions."""
         logger.info("Aborting pump control thread %s current and future commands", self.name)
-        self.command_queue.clear()
+        self._clear_commands()
 
-        for name, pump in self._connected_pumps.items():
+        with self._pumps_lock:
+            pumps = list(self._connected_pumps.items())
+
+        for name, pump in pumps:
             pump.stop()
+            self.state_cache.update(name, moving=False)
 
         self._abort_event.clear()
         logger.debug("Pump control thread %s aborted", self.name)
 
-    def stop(self):
-        """Stops the thread cleanly."""
-        logger.info("Starting to clean up and shut down pump control thread: %s", self.name)
-        self._stop_event.set()
-
 class PumpPanel(wx.Panel):
     """
     This pump panel supports standard flow controls and settings, including
@@ -3370,7 +3613,7 @@ class PumpFrame(wx.Frame):
         """
         super(PumpFrame, self).__init__(*args, **kwargs)
         logger.debug('Setting up the PumpFrame')
-        self.pump_cmd_q = deque()
+        self.pump_cmd_q = commthread.CommandQueue()
         self.pump_answer_q = deque()
         self.abort_event = threading.Event()
         self.pump_con = PumpCommThread(self.pump_cmd_q, self.pump_answer_q, self.abort_event, 'PumpCon')
@@ -25,7 +25,9 @@ from io import open
 import threading
 import logging
 import logging.handlers as handlers
-from collections import deque
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from functools import partial
 import traceback
 import time
 import sys
@@ -37,6 +39,8 @@ if __name__ != '__main__':
 import zmq
 import wx
 
+import commthread
+import netcodec
 import pumpcon
 import fmcon
 import valvecon
@@ -44,11 +48,49 @@ import valvecon
 
 class ControlServer(threading.Thread):
     """
-
+    Runs device commands sent by :py:class:`client.ControlClient` instances.
+
+    The server uses a ROUTER socket, so any number of clients (e.g. the
+    coflow and TR-SAXS GUIs and monitoring scripts) can connect to the same
+    server, and each answer is routed back to the client that sent the
+    request. One server handles the pump, flow meter and valve devices.
+
+    If a request carries an ``id``, the answer is sent back as
+    ``{'id': id, 'answer': answer}``, otherwise as the bare answer. Answers
+    are sent as soon as the device thread has them, so the server never
+    waits on one device while requests for other devices, or from other
+    clients, are waiting.
+
+    If a ``telemetry_port`` is given, the server also samples every connected
+    device at the rates set in ``telemetry`` and publishes the results on a
+    PUB socket on that port, so any number of clients can follow device
+    status (see :py:class:`client.TelemetryClient`) while each device is
+    only polled once. Each device is published with the topic
+    ``'<device type>/<device name>'`` (e.g. ``'pump/sheath_pump'``) and a
+    ``[time, values]`` message, where values is a dictionary such as
+    ``{'moving': False, 'volume': 10.0}``.
+
+    A request for the ``'multi'`` device carries a list of commands for
+    several devices, which are run in parallel where possible and answered
+    together in one reply (see :py:func:`_process_batch`).
+
+    Messages are encoded with :py:mod:`netcodec`. Answers are encoded the
+    same way as the request they answer, and a client can ask for msgpack
+    when it pings the server. Telemetry is encoded with
+    ``telemetry_codec``, JSON by default so any subscriber can read it.
     """
 
+    #: Default telemetry sampling, a list of (command, interval in s) for
+    #: each device type.
+    default_telemetry = {
+        'pump'  : [('get_status_multi', 1.)],
+        'fm'    : [('get_fr_multi', 0.1), ('get_all_multi', 0.5)],
+        'valve' : [('get_position_multi', 1.)],
+        }
+
     def __init__(self, ip, port, name='ControlServer', pump_comm_locks = None,
-        valve_comm_locks=None):
+        valve_comm_locks=None, telemetry_port=None, telemetry=None,
+        telemetry_codec='json'):
         """
         Initializes the custom thread. Important parameters here are the
         list of known commands ``_commands`` and known pumps ``known_pumps``.
@@ -58,6 +100,15 @@ class ControlServer(threading.Thread):
 
         :param threading.Event stop_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
+
+        :param str telemetry_port: The port to publish device telemetry on.
+            If ``None`` (default), no telemetry is published.
+
+        :param dict telemetry: The telemetry sampling, in the same format as
+            ``default_telemetry``, which is used if this is ``None``.
+
+        :param str telemetry_codec: The telemetry encoding, ``'json'``
+            (default) or ``'msgpack'``.
         """
         threading.Thread.__init__(self, name=name)
         self.daemon = True
@@ -73,14 +124,48 @@ class ControlServer(threading.Thread):
         self._stop_event = threading.Event()
 
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.PAIR)
+        self.socket = self.context.socket(zmq.ROUTER)
         self.socket.set(zmq.LINGER, 0)
         self.socket.bind("tcp://{}:{}".format(self.ip, self.port))
 
+        # Device threads hand answers back through _replies, and wake the
+        # server through an inproc socket, since the zmq socket can only be
+        # used from the server thread.
+        self._replies = deque()
+        self._wake_address = 'inproc://{}-{}-replies'.format(self.name, id(self))
+        self._wake_socket = self.context.socket(zmq.PULL)
+        self._wake_socket.bind(self._wake_address)
+        self._wake_senders = threading.local()
+
+        self._poller = zmq.Poller()
+        self._poller.register(self.socket, zmq.POLLIN)
+        self._poller.register(self._wake_socket, zmq.POLLIN)
+
+        self.telemetry_port = telemetry_port
+        self._telemetry = deque()
+
+        if telemetry is None:
+            telemetry = self.default_telemetry
+
+        self.telemetry_settings = telemetry
+        self.telemetry_codec = telemetry_codec
+
+        if self.telemetry_port is not None:
+            self.pub_socket = self.context.socket(zmq.PUB)
+            self.pub_socket.set(zmq.LINGER, 0)
+            self.pub_socket.bind("tcp://{}:{}".format(self.ip, self.telemetry_port))
+
+            self._telemetry_thread = threading.Thread(target=self._sample_telemetry,
+                name='{}Telemetry'.format(self.name))
+            self._telemetry_thread.daemon = True
+        else:
+            self.pub_socket = None
+            self._telemetry_thread = None
+
         self.pump_comm_locks = pump_comm_locks
         self.valve_comm_locks = valve_comm_locks
 
-        pump_cmd_q = deque()
+        pump_cmd_q = commthread.CommandQueue()
         pump_return_q = deque()
         pump_abort_event = threading.Event()
         pump_con = pumpcon.PumpCommThread(pump_cmd_q, pump_return_q, pump_abort_event, 'PumpCon')
@@ -97,7 +182,7 @@ class ControlServer(threading.Thread):
 
         self._device_control['pump'] = pump_ctrl
 
-        fm_cmd_q = deque()
+        fm_cmd_q = commthread.CommandQueue()
         fm_return_q = deque()
         fm_abort_event = threading.Event()
         fm_con = fmcon.FlowMeterCommThread(fm_cmd_q, fm_return_q, fm_abort_event, 'FMCon')
@@ -111,7 +196,7 @@ class ControlServer(threading.Thread):
 
         self._device_control['fm'] = fm_ctrl
 
-        valve_cmd_q = deque()
+        valve_cmd_q = commthread.CommandQueue()
         valve_return_q = deque()
         valve_abort_event = threading.Event()
         valve_con = valvecon.ValveCommThread(valve_cmd_q, valve_return_q, valve_abort_event, 'ValveCon')
@@ -132,16 +217,15 @@ class ControlServer(threading.Thread):
         """
         Custom run method for the thread.
         """
+        if self._telemetry_thread is not None:
+            self._telemetry_thread.start()
+
         while True:
             try:
                 try:
-                    if self.socket.poll(10) > 0:
-                        logger.debug("Getting new command")
-                        command = self.socket.recv_json()
-                    else:
-                        command = None
+                    events = dict(self._poller.poll(10))
                 except Exception:
-                    command = None
+                    events = {}
 
                 # if self._abort_event.is_set():
                 #     logger.debug("Abort event detected")
@@ -152,54 +236,36 @@ class ControlServer(threading.Thread):
                     logger.debug("Stop event detected")
                     break
 
-                if command is not None:
-                    device = command['device']
-                    device_cmd = command['command']
-                    get_response = command['response']
-                    logger.debug("For device %s, processing cmd '%s' with args: %s and kwargs: %s ", device, device_cmd[0], ', '.join(['{}'.format(a) for a in device_cmd[1]]), ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()]))
-                    try:
-
-                        if device == 'server':
-                            if device_cmd[0] == 'ping':
-                                answer = 'ping received'
-                            else:
-                                answer = ''
-                        else:
-                            device_q = self._device_control[device]['queue']
-                            device_q.append(device_cmd)
-
-                            if get_response:
-                                answer_q = self._device_control[device]['answer_q']
-
-                                start_time = time.time()
-                                while len(answer_q) == 0 and time.time()-start_time < 5:
-                                    time.sleep(0.01)
-
-                                if len(answer_q) == 0:
-                                    answer = ''
-                                else:
-                                    answer = answer_q.popleft()
-                            else:
-                                answer = 'cmd sent'
-
-                        if answer == '':
-                            logger.exception('No response received from device')
-                        else:
-                            logger.debug('Sending command response: %s', answer)
-                            self.socket.send_json(answer)
-
-                    except Exception:
-                        device = command['device']
-                        device_cmd = command['command']
-                        msg = ("Device %s failed to run command '%s' "
-                            "with args: %s and kwargs: %s. Exception follows:" %(device, device_cmd[0],
-                            ', '.join(['{}'.format(a) for a in device_cmd[1]]),
-                            ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()])))
-                        logger.exception(msg)
-                        logger.exception(traceback.print_exc())
+                if self._wake_socket in events:
+                    while True:
+                        try:
+                            self._wake_socket.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+
+                while len(self._replies) > 0:
+                    self._send_answer(*self._replies.popleft())
+
+                while len(self._telemetry) > 0:
+                    topic, sample_time, values = self._telemetry.popleft()
+                    self.pub_socket.send_multipart([topic.encode('utf-8')]
+                        + netcodec.encode([sample_time, values],
+                        self.telemetry_codec), copy=False)
+
+                if self.socket in events:
+                    while True:
+                        try:
+                            frames = self.socket.recv_multipart(zmq.NOBLOCK,
+                                copy=False)
+                        except zmq.Again:
+                            break
+
+                        client_id = frames[0].bytes
+                        command, codec = netcodec.decode([frame.buffer
+                            for frame in frames[1:]])
 
-                else:
-                    time.sleep(0.01)
+                        logger.debug("Getting new command")
+                        self._process_command(client_id, command, codec)
 
             except Exception:
                 logger.error('Error in server thread:\n{}'.format(traceback.format_exc()))
@@ -210,6 +276,240 @@ class ControlServer(threading.Thread):
         #     self._abort()
         logger.info("Quitting pump control thread: %s", self.name)
 
+    def _process_command(self, client_id, command, codec):
+        device = command['device']
+        device_cmd = command['command']
+        get_response = command['response']
+        req_id = command.get('id')
+
+        if device == 'multi':
+            self._process_batch(client_id, req_id, codec, device_cmd, get_response)
+            return
+
+        logger.debug("For device %s, processing cmd '%s' with args: %s and kwargs: %s ", device, device_cmd[0], ', '.join(['{}'.format(a) for a in device_cmd[1]]), ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()]))
+        try:
+
+            if device == 'server':
+                if device_cmd[0] == 'ping':
+                    answer = 'ping received'
+                else:
+                    answer = ''
+
+                if 'codecs' in command:
+                    reply_codec = netcodec.choose_codec(command['codecs'])
+                else:
+                    reply_codec = None
+
+                self._send_answer(client_id, req_id, answer, codec, reply_codec)
+
+            else:
+                device_thread = self._device_control[device]['thread']
+                answer_future = device_thread.submit(device_cmd[0],
+                    device_cmd[1], device_cmd[2])
+
+                if get_response:
+                    answer_future.add_done_callback(partial(self._answer_ready,
+                        client_id, req_id, codec))
+                else:
+                    self._send_answer(client_id, req_id, 'cmd sent', codec)
+
+        except Exception:
+            msg = ("Device %s failed to run command '%s' "
+                "with args: %s and kwargs: %s. Exception follows:" %(device, device_cmd[0],
+                ', '.join(['{}'.format(a) for a in device_cmd[1]]),
+                ', '.join(['{}:{}'.format(kw, item) for kw, item in device_cmd[2].items()])))
+            logger.exception(msg)
+            logger.exception(traceback.print_exc())
+
+    def _process_batch(self, client_id, req_id, codec, entries, get_response):
+        """
+        Runs a batch of commands, sent as ``{'device': 'multi', 'command':
+        [(device, (cmd, args, kwargs)), ...]}``. The commands for each device
+        type are sent to that device thread as a single ``'batch'`` command,
+        which runs them in parallel where the devices are on different
+        ports. The answer is ``('multi', answers)``, with one answer per
+        entry (``None`` if it failed), sent when all the commands are done.
+        """
+        logger.debug("Processing batch of %i commands", len(entries))
+
+        by_device = OrderedDict()
+
+        for i, (device, device_cmd) in enumerate(entries):
+            indices, commands = by_device.setdefault(device, ([], []))
+            indices.append(i)
+            commands.append(device_cmd)
+
+        answers = [None]*len(entries)
+        batch_lock = threading.Lock()
+        remaining = {'count': len(by_device)}
+
+        def batch_ready(indices, batch_future):
+            try:
+                batch_answers = batch_future.result()[1]
+            except Exception:
+                batch_answers = [None]*len(indices)
+
+            with batch_lock:
+                for i, answer in zip(indices, batch_answers):
+                    answers[i] = answer
+
+                remaining['count'] -= 1
+                done = remaining['count'] == 0
+
+            if done and get_response:
+                self._replies.append((client_id, req_id, ('multi', answers), codec))
+                self._wake()
+
+        if not get_response:
+            self._send_answer(client_id, req_id, 'cmd sent', codec)
+        elif len(by_device) == 0:
+            self._send_answer(client_id, req_id, ('multi', answers), codec)
+
+        for device, (indices, commands) in by_device.items():
+            if device in self._device_control:
+                device_thread = self._device_control[device]['thread']
+                batch_future = device_thread.submit('batch', (commands,))
+            else:
+                logger.error("Batch command for unknown device %s", device)
+                batch_future = Future()
+                batch_future.set_result(('batch', [None]*len(indices)))
+
+            batch_future.add_done_callback(partial(batch_ready, indices))
+
+    def _send_answer(self, client_id, req_id, answer, codec, reply_codec=None):
+        """
+        Sends an answer to a client.
+
+        :param str codec: The encoding to send the answer with.
+
+        :param str reply_codec: If not ``None``, tells the client to use this
+            encoding for future requests.
+        """
+        if isinstance(answer, str) and answer == '':
+            logger.error('No response received from device')
+        else:
+            logger.debug('Sending command response: %s', answer)
+
+            if req_id is not None:
+                answer = {'id': req_id, 'answer': answer}
+
+                if reply_codec is not None:
+                    answer['codec'] = reply_codec
+
+            self.socket.send_multipart([client_id] + netcodec.encode(answer,
+                codec), copy=False)
+
+    def _answer_ready(self, client_id, req_id, codec, answer_future):
+        """
+        Called by the device thread when a command answer is ready. Queues
+        the answer and wakes the server thread to send it.
+        """
+        try:
+            answer = answer_future.result()
+        except Exception:
+            answer = ''
+
+        self._replies.append((client_id, req_id, answer, codec))
+        self._wake()
+
+    def _wake(self):
+        """
+        Wakes the server thread. Can be called from any thread.
+        """
+        try:
+            sender = getattr(self._wake_senders, 'socket', None)
+
+            if sender is None:
+                sender = self.context.socket(zmq.PUSH)
+                sender.set(zmq.LINGER, 0)
+                sender.connect(self._wake_address)
+                self._wake_senders.socket = sender
+
+            sender.send(b'', zmq.NOBLOCK)
+
+        except zmq.ZMQError:
+            pass
+
+    def _sample_telemetry(self):
+        """
+        Samples all connected devices at the telemetry rate and queues the
+        results for the server thread to publish. A command is not sent
+        again while the previous sample from it is still pending, so a slow
+        device doesn't build up a backlog of telemetry commands.
+        """
+        logger.info("Starting telemetry sampling for control server: %s", self.name)
+
+        samples = []
+
+        for device, commands in self.telemetry_settings.items():
+            if device in self._device_control:
+                for cmd, interval in commands:
+                    samples.append([device, cmd, interval, 0, None])
+
+        while not self._stop_event.is_set() and len(samples) > 0:
+            now = time.time()
+
+            for sample in samples:
+                device, cmd, interval, next_time, future = sample
+
+                if now >= next_time and (future is None or future.done()):
+                    device_thread = self._device_control[device]['thread']
+                    future = device_thread.submit(cmd)
+                    future.add_done_callback(partial(self._telemetry_ready,
+                        device))
+
+                    sample[3] = max(next_time + interval, now)
+                    sample[4] = future
+
+            next_time = min(sample[3] for sample in samples)
+
+            self._stop_event.wait(max(next_time - time.time(), 0.001))
+
+        logger.info("Stopping telemetry sampling for control server: %s", self.name)
+
+    def _telemetry_ready(self, device, answer_future):
+        """
+        Called by the device thread when a telemetry sample is ready. Splits
+        the answer by device and queues it to be published.
+        """
+        sample_time = time.time()
+
+        try:
+            answer = answer_future.result()
+        except Exception:
+            return
+
+        if answer is None:
+            return
+
+        if device == 'pump':
+            names, _, status = answer
+            values = [{'moving': moving, 'volume': volume}
+                for moving, volume in status]
+
+        elif device == 'valve':
+            _, names, positions = answer
+            values = [{'position': position} for position in positions]
+
+        elif device == 'fm':
+            ret_type, names, vals = answer
+
+            if ret_type == 'multi_flow':
+                values = [{'flow_rate': flow_rate} for flow_rate in vals]
+            else:
+                values = [{'flow_rate': flow_rate, 'density': density,
+                    'temperature': temperature} for flow_rate, density,
+                    temperature in vals]
+
+        else:
+            return
+
+        for name, value in zip(names, values):
+            self._telemetry.append(('{}/{}'.format(device, name),
+                sample_time, value))
+
+        self._wake()
+
     def stop(self):
         """Stops the thread cleanly."""
         # logger.info("Starting to clean up and shut down pump control thread: %s", self.name)
@@ -218,7 +518,7 @@ class ControlServer(threading.Thread):
         self.context.destroy(0)
 
         for device in self._device_control:
-            self._device_control[device]['abort'].set()
+            self._device_control[device]['thread'].abort()
 
         self._stop_event.set()
 
@@ -246,9 +546,8 @@ if __name__ == '__main__':
 
     logger.addHandler(h2)
 
-    port1 = '5556'
-    port2 = '5557'
-    port3 = '5558'
+    port = '5556'
+    telemetry_port = '5559'
 
     # Coflow
     ip = '164.54.204.53'
@@ -268,18 +567,10 @@ if __name__ == '__main__':
         'COM9'  : threading.Lock(),
         }
 
-    control_server1 = ControlServer(ip, port1, name='PumpControlServer',
-        pump_comm_locks = pump_comm_locks)
-    control_server1.start()
-
-    control_server2 = ControlServer(ip, port2, name='FMControlServer')
-    control_server2.start()
-
-    # TR SAXS
-
-    # control_server3 = ControlServer(ip, port3, name='ValveControlServer',
-    #     valve_comm_locks = valve_comm_locks)
-    # control_server3.start()
+    control_server = ControlServer(ip, port, name='ControlServer',
+        pump_comm_locks = pump_comm_locks, valve_comm_locks = valve_comm_locks,
+        telemetry_port = telemetry_port)
+    control_server.start()
 
     # Coflow
 
@@ -348,13 +639,7 @@ if __name__ == '__main__':
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        control_server1.stop()
-        control_server1.join()
-
-        control_server2.stop()
-        control_server2.join()
-
-        # control_server3.stop()
-        # control_server3.join()
+        control_server.stop()
+        control_server.join()
 
     logger.info("Quitting server")
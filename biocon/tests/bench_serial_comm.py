@@ -0,0 +1,74 @@
+"""
+Benchmarks pumpcon.SerialComm with the port opened and closed around every
+command against a persistent connection. A pty stands in for the device and
+answers each command the way an MForce controller does, so this measures
+the host side overhead of a status poll. Linux/macOS only.
+
+Usage: python bench_serial_comm.py [number of commands]
+"""
+from __future__ import print_function
+
+import os
+import pty
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pumpcon
+
+
+def loopback_device(fd):
+    """Echoes each command back followed by a '0' response and a prompt."""
+    buf = b''
+    while True:
+        try:
+            data = os.read(fd, 1024)
+        except OSError:
+            return
+
+        buf += data
+        while b'\r\n' in buf:
+            line, buf = buf.split(b'\r\n', 1)
+            os.write(fd, line + b'\r\n0\r\n>')
+
+def open_loopback():
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+
+    device = threading.Thread(target=loopback_device, args=(master,))
+    device.daemon = True
+    device.start()
+
+    return os.ttyname(slave)
+
+def run(port, persistent, num_cmds):
+    comm = pumpcon.SerialComm.get_comm(port, persistent=persistent)
+
+    start = time.time()
+    for i in range(num_cmds):
+        comm.write('PR MV', get_response=True)
+    elapsed = time.time() - start
+
+    comm.close()
+
+    return num_cmds/elapsed
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        num_cmds = int(sys.argv[1])
+    else:
+        num_cmds = 2000
+
+    for persistent in (False, True):
+        rate = run(open_loopback(), persistent, num_cmds)
+
+        if persistent:
+            mode = 'persistent connection'
+        else:
+            mode = 'open/close per command'
+
+        print('%-24s %8.0f commands/s' %(mode, rate))
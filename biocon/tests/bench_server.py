@@ -0,0 +1,127 @@
+"""
+Load test for the ROUTER based server.ControlServer. Starts a server with
+soft pumps and valves, then has N DEALER clients (client.ControlClient)
+each send a series of status requests, alternating pump get_status_multi
+and valve get_position_multi, and reports the p50/p99 request latency and
+total throughput for each number of clients.
+
+Usage: python bench_server.py [port] [requests per client]
+"""
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+import commthread
+import server
+
+num_pumps = 4
+num_valves = 4
+num_clients = (1, 4, 16, 32)
+
+
+def make_client(port, name):
+    control_client = client.ControlClient('127.0.0.1', port,
+        commthread.CommandQueue(), deque(), threading.Event(),
+        threading.Event(), name=name)
+    control_client.start()
+
+    return control_client
+
+def send(control_client, device, cmd):
+    future = control_client.submit({'device': device, 'command': cmd,
+        'response': True})
+
+    return future.result(10)
+
+def connect_devices(control_client):
+    for i in range(num_pumps):
+        send(control_client, 'pump', ('connect', ('COM{}'.format(i),
+            'pump{}'.format(i), 'Soft_Syringe'), {'diameter': 23.5,
+            'max_volume': 30, 'max_rate': 30, 'syringe_id': '30 mL',
+            'dual_syringe': False}))
+
+    for i in range(num_valves):
+        send(control_client, 'valve', ('connect', ('COM{}'.format(i),
+            'valve{}'.format(i), 'Soft'), {'positions': 6}))
+
+def run_clients(port, n, num_requests):
+    """Returns the request latencies (in s) and the throughput (in 1/s)."""
+    pump_names = ['pump{}'.format(i) for i in range(num_pumps)]
+    valve_names = ['valve{}'.format(i) for i in range(num_valves)]
+
+    cmds = [('pump', ('get_status_multi', (pump_names,), {})),
+        ('valve', ('get_position_multi', (valve_names,), {}))]
+
+    clients = [make_client(port, 'Client{}'.format(i)) for i in range(n)]
+    latencies = [[] for i in range(n)]
+
+    def work(index):
+        for i in range(num_requests):
+            device, cmd = cmds[(i + index) % len(cmds)]
+
+            start = time.time()
+            answer = send(clients[index], device, cmd)
+            latencies[index].append(time.time() - start)
+
+            assert answer is not None
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(n)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    for control_client in clients:
+        control_client.stop()
+        control_client.join(2)
+
+    latencies = np.concatenate(latencies)
+
+    return latencies, len(latencies)/elapsed
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    else:
+        port = 5610
+
+    if len(sys.argv) > 2:
+        num_requests = int(sys.argv[2])
+    else:
+        num_requests = 300
+
+    control_server = server.ControlServer('127.0.0.1', port, name='BenchServer')
+    control_server.start()
+
+    setup_client = make_client(port, 'SetupClient')
+    connect_devices(setup_client)
+
+    print('{:>8} {:>10} {:>10} {:>10}'.format('clients', 'p50 (ms)',
+        'p99 (ms)', 'req/s'))
+
+    for n in num_clients:
+        latencies, throughput = run_clients(port, n, num_requests)
+
+        print('{:>8} {:>10.2f} {:>10.2f} {:>10.0f}'.format(n,
+            np.percentile(latencies, 50)*1e3, np.percentile(latencies, 99)*1e3,
+            throughput))
+
+    setup_client.stop()
+    setup_client.join(2)
+    control_server.stop()
+    control_server.join(2)
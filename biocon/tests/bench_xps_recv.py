@@ -0,0 +1,104 @@
+"""
+Benchmarks reading long XPS replies (e.g. GatheringDataMultipleLinesGet)
+with XPS_C8_drivers against the previous reader, which received 1 kB at a
+time and searched the whole reply string for the terminator after every
+receive. A local TCP server stands in for the controller.
+
+Usage: python bench_xps_recv.py
+"""
+from __future__ import print_function
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import XPS_C8_drivers
+
+
+def gathering_reply(num_lines):
+    line = ';'.join('{:.6f}'.format(1.2345678*i) for i in range(4))
+    return '\n'.join([line]*num_lines)
+
+def serve(server, replies):
+    while True:
+        conn, addr = server.accept()
+
+        handler = threading.Thread(target=handle, args=(conn, replies))
+        handler.daemon = True
+        handler.start()
+
+def handle(conn, replies):
+    while True:
+        cmd = conn.recv(65536)
+        if not cmd:
+            break
+
+        # The driver checks the error list when it connects
+        conn.sendall(replies.get(cmd.decode(), b'0,EndOfAPI'))
+
+    conn.close()
+
+def old_send(sock, command):
+    """The reader XPS_C8_drivers used before."""
+    sock.send(command.encode())
+    ret = sock.recv(1024).decode()
+    while (ret.find(',EndOfAPI') == -1):
+        ret += sock.recv(1024).decode()
+
+    for i in range(len(ret)):
+        if (ret[i] == ','):
+            return [int(ret[0:i]), ret[i+1:-9]]
+
+def time_send(send, command, reps):
+    start = time.time()
+    for i in range(reps):
+        send(command)
+
+    return (time.time() - start)/reps
+
+if __name__ == '__main__':
+    replies = {}
+
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+
+    server_thread = threading.Thread(target=serve, args=(server, replies))
+    server_thread.daemon = True
+    server_thread.start()
+
+    xps = XPS_C8_drivers.XPS()
+    socket_id = xps.TCP_ConnectToServer('127.0.0.1', port, 20)
+
+    old_sock = socket.create_connection(('127.0.0.1', port))
+
+    print('{:>8} {:>8} {:>12} {:>12}'.format('lines', 'MB', 'old (ms)',
+        'new (ms)'))
+
+    for num_lines in (10, 10000, 50000, 100000):
+        command = 'GatheringDataMultipleLinesGet(0,{})'.format(num_lines)
+        payload = gathering_reply(num_lines)
+        replies[command] = ('0,' + payload + ',EndOfAPI').encode()
+
+        if num_lines > 10:
+            reps = 3
+        else:
+            reps = 1000
+
+        assert tuple(xps.Send(socket_id, command)) == (0, payload)
+        assert old_send(old_sock, command) == [0, payload]
+
+        old_time = time_send(lambda cmd: old_send(old_sock, cmd), command, reps)
+        new_time = time_send(lambda cmd: xps.Send(socket_id, cmd), command, reps)
+
+        print('{:>8} {:>8.2f} {:>12.3f} {:>12.3f}'.format(num_lines,
+            len(payload)/1e6, old_time*1e3, new_time*1e3))
+
+    xps.TCP_CloseSocket(socket_id)
+    old_sock.close()
@@ -0,0 +1,265 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from collections import deque
+from concurrent.futures import CancelledError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import commthread
+
+
+class FakeCommThread(commthread.CommThread):
+    """A control thread for fake devices that records the commands it runs."""
+
+    coalesce_commands = ('set_flow_rate',)
+
+    def __init__(self, *args, **kwargs):
+        commthread.CommThread.__init__(self, *args, **kwargs)
+
+        self.devices = {'p1': object(), 'p2': object()}
+        self.ran = []
+        self.release = threading.Event()
+
+        self._commands = {'block': self._block,
+            'set_flow_rate': self._record('set_flow_rate'),
+            'start_flow': self._record('start_flow'),
+            'dispense': self._record('dispense'),
+            'stop': self._record('stop'),
+            }
+
+    def _get_device(self, name):
+        return self.devices.get(name)
+
+    def _block(self, *args):
+        self.release.wait(5)
+
+    def _record(self, command):
+        def run(name, *args):
+            self.ran.append((command, name) + args)
+        return run
+
+    def _abort(self):
+        self._clear_commands()
+        self._abort_event.clear()
+
+
+class FakeDevice(object):
+
+    def __init__(self, port):
+        self.device = port
+
+
+class FakePortCommThread(FakeCommThread):
+    """A control thread for fake devices on ports, with slow (dis)connects."""
+
+    port_workers = True
+
+    connect_commands = ('connect',)
+
+    def __init__(self, *args, **kwargs):
+        FakeCommThread.__init__(self, *args, **kwargs)
+
+        self.devices = {'p1': FakeDevice('COM1')}
+
+        self._commands['connect'] = self._connect
+        self._commands['disconnect'] = self._disconnect
+
+    def _connect(self, port, name):
+        time.sleep(0.2)
+        self.devices[name] = FakeDevice(port)
+        self.ran.append(('connect', name))
+
+    def _disconnect(self, name):
+        time.sleep(0.1)
+        del self.devices[name]
+        self.ran.append(('disconnect', name))
+
+
+class TestSetpointCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.thread = FakeCommThread(commthread.CommandQueue(), deque(),
+            threading.Event())
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.release.set()
+        self.thread.stop()
+        self.thread.join(5)
+
+    def run_commands(self, commands):
+        """Sends the commands while the thread is busy, and waits for them."""
+        block = self.thread.submit('block')
+        futures = [self.thread.submit(*cmd) for cmd in commands]
+        self.thread.release.set()
+        block.result(5)
+
+        for future in futures:
+            future.result(5)
+
+        return self.thread.ran
+
+    def test_newest_setpoint_is_sent_once(self):
+        ran = self.run_commands([('set_flow_rate', ('p1', i)) for i in range(5)])
+
+        self.assertEqual(ran, [('set_flow_rate', 'p1', 4)])
+
+    def test_setpoint_does_not_pass_commands_for_same_device(self):
+        commands = [('set_flow_rate', ('p1', i)) for i in range(5)]
+        commands.append(('start_flow', ('p1',)))
+        commands.append(('set_flow_rate', ('p1', 99)))
+
+        ran = self.run_commands(commands)
+
+        self.assertEqual(ran, [('start_flow', 'p1'), ('set_flow_rate', 'p1', 99)])
+
+    def test_setpoint_dispense_setpoint_keeps_order(self):
+        ran = self.run_commands([('set_flow_rate', ('p1', 1)),
+            ('dispense', ('p1', 10)), ('set_flow_rate', ('p1', 2))])
+
+        self.assertEqual(ran, [('dispense', 'p1', 10), ('set_flow_rate', 'p1', 2)])
+
+    def test_setpoint_coalesces_past_other_devices(self):
+        ran = self.run_commands([('set_flow_rate', ('p1', 1)),
+            ('start_flow', ('p2',)), ('set_flow_rate', ('p1', 2))])
+
+        self.assertEqual(ran, [('set_flow_rate', 'p1', 2), ('start_flow', 'p2')])
+
+    def test_unknown_device_command_is_a_barrier(self):
+        ran = self.run_commands([('set_flow_rate', ('p1', 1)),
+            ('start_flow', ('p3',)), ('set_flow_rate', ('p1', 2))])
+
+        self.assertEqual(ran, [('start_flow', 'p3'), ('set_flow_rate', 'p1', 2)])
+
+
+class TestStopOrdering(unittest.TestCase):
+
+    thread_class = FakeCommThread
+
+    def setUp(self):
+        self.thread = self.thread_class(commthread.CommandQueue(), deque(),
+            threading.Event())
+        self.thread.devices = {'p1': FakeDevice('COM1'),
+            'p2': FakeDevice('COM2')}
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.release.set()
+        self.thread.stop()
+        self.thread.join(5)
+
+    def run_commands(self, commands):
+        """Sends the commands while the device is busy, and waits for them."""
+        block = self.thread.submit('block', ('p1',))
+        time.sleep(0.1)
+        futures = [self.thread.submit(*cmd) for cmd in commands]
+        time.sleep(0.1)
+        self.thread.release.set()
+        block.result(5)
+
+        for future in futures:
+            try:
+                future.result(5)
+            except CancelledError:
+                pass
+
+        return futures
+
+    def test_nothing_runs_after_stop(self):
+        futures = self.run_commands([('start_flow', ('p1',)),
+            ('set_flow_rate', ('p1', 5)), ('stop', ('p1',))])
+
+        self.assertEqual(self.thread.ran, [('stop', 'p1')])
+        self.assertTrue(futures[0].cancelled())
+        self.assertTrue(futures[1].cancelled())
+
+    def test_stop_keeps_commands_for_other_devices(self):
+        self.run_commands([('start_flow', ('p1',)), ('start_flow', ('p2',)),
+            ('stop', ('p1',))])
+
+        self.assertNotIn(('start_flow', 'p1'), self.thread.ran)
+        self.assertIn(('start_flow', 'p2'), self.thread.ran)
+        self.assertIn(('stop', 'p1'), self.thread.ran)
+
+
+class TestStopOrderingPortWorkers(TestStopOrdering):
+
+    thread_class = FakePortCommThread
+
+
+class TestConnectOrdering(unittest.TestCase):
+
+    def setUp(self):
+        self.thread = FakePortCommThread(commthread.CommandQueue(), deque(),
+            threading.Event())
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.stop()
+        self.thread.join(5)
+
+    def test_commands_after_reconnect_wait_for_connect(self):
+        futures = [self.thread.submit('disconnect', ('p1',)),
+            self.thread.submit('connect', ('COM1', 'p1')),
+            self.thread.submit('set_flow_rate', ('p1', 5))]
+
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.thread.ran, [('disconnect', 'p1'),
+            ('connect', 'p1'), ('set_flow_rate', 'p1', 5)])
+
+    def test_commands_for_new_device_run_on_its_port(self):
+        futures = [self.thread.submit('connect', ('COM2', 'p2')),
+            self.thread.submit('set_flow_rate', ('p2', 5))]
+
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.thread._get_comm_key('set_flow_rate', ('p2', 5),
+            {}), ('port', 'COM2'))
+        self.assertEqual(self.thread.ran, [('connect', 'p2'),
+            ('set_flow_rate', 'p2', 5)])
+
+
+class TestAdaptivePoller(unittest.TestCase):
+
+    def test_backs_off_while_idle(self):
+        poller = commthread.AdaptivePoller(1, 4)
+
+        intervals = []
+        for i in range(4):
+            poller.update(False)
+            intervals.append(poller.interval)
+
+        self.assertEqual(intervals, [2, 4, 4, 4])
+
+        poller.update(True)
+        self.assertEqual(poller.interval, 1)
+
+    def test_wake_during_poll_is_kept(self):
+        poller = commthread.AdaptivePoller(1, 16)
+        stop = threading.Event()
+
+        poller.update(False)
+        poller.update(False)
+
+        # Woken while a poll is running, the poll then finds nothing active
+        poller.wake()
+        poller.update(False)
+        self.assertEqual(poller.interval, 1)
+
+        start = time.time()
+        poller.wait(time.time(), stop)
+        self.assertLess(time.time() - start, 0.5)
+
+        # The poll after the wake has seen it, so the backoff starts again
+        poller.update(False)
+        self.assertEqual(poller.interval, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
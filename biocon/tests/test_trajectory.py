@@ -0,0 +1,102 @@
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trajectory
+
+
+class TrajectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = trajectory.serpentine([((0., y), (10., y)) for y in
+            (0., 0.5, 1., 1.5)])
+        self.segments, self.passes = trajectory.raster_trajectory(self.lines,
+            2., 50., 10., 100.)
+        self.start = self.lines[0][0]
+
+    def assertListAlmostEqual(self, first, second, places=7):
+        self.assertEqual(len(first), len(second))
+        for a, b in zip(first, second):
+            self.assertAlmostEqual(a, b, places=places)
+
+    def test_continuity(self):
+        """Position and velocity are continuous at the segment boundaries."""
+        t = 0.
+        for seg_time, displacements, velocities in self.segments:
+            t += seg_time
+            pos_before, vel_before = trajectory.evaluate(self.segments,
+                self.start, t-1e-9)
+            pos_after, vel_after = trajectory.evaluate(self.segments,
+                self.start, t+1e-9)
+
+            self.assertListAlmostEqual(pos_before, pos_after, places=6)
+            self.assertListAlmostEqual(vel_before, vel_after, places=4)
+
+        pos, vel = trajectory.evaluate(self.segments, self.start,
+            trajectory.get_duration(self.segments))
+
+        self.assertListAlmostEqual(pos, self.lines[-1][1])
+        self.assertListAlmostEqual(vel, [0., 0.])
+
+    def test_cruise_speed(self):
+        """The constant speed part of every pass runs at the scan speed."""
+        for info in self.passes:
+            for frac in (0., 0.25, 0.5, 0.75, 1.):
+                t = info['cruise_start'] + frac*(info['cruise_end']
+                    - info['cruise_start'])
+                pos, vel = trajectory.evaluate(self.segments, self.start, t)
+
+                self.assertAlmostEqual(math.hypot(*vel), 2.)
+
+    def test_pass_end_points(self):
+        """Every pass starts and ends at rest at the line ends."""
+        for info, (start, end) in zip(self.passes, self.lines):
+            pos, vel = trajectory.evaluate(self.segments, self.start,
+                info['start_time'])
+            self.assertListAlmostEqual(pos, start)
+            self.assertListAlmostEqual(vel, [0., 0.])
+
+            pos, vel = trajectory.evaluate(self.segments, self.start,
+                info['end_time'])
+            self.assertListAlmostEqual(pos, end)
+            self.assertListAlmostEqual(vel, [0., 0.])
+
+        self.assertEqual(self.passes[0]['first_segment'], 1)
+        self.assertEqual(self.passes[-1]['last_segment'], len(self.segments))
+
+    def test_short_move(self):
+        """A move too short to reach full speed accelerates then decelerates."""
+        segments = trajectory.move_segments((0., 0.), (0., 0.5), 10., 100.)
+
+        self.assertEqual(len(segments), 2)
+
+        peak = math.sqrt(0.5*100.)
+        self.assertAlmostEqual(segments[0][0], peak/100.)
+        self.assertListAlmostEqual(segments[0][1], [0., 0.25])
+        self.assertListAlmostEqual(segments[0][2], [0., peak])
+        self.assertListAlmostEqual(segments[1][1], [0., 0.25])
+        self.assertListAlmostEqual(segments[1][2], [0., 0.])
+
+        pos, vel = trajectory.evaluate(segments, (0., 0.),
+            trajectory.get_duration(segments))
+        self.assertListAlmostEqual(pos, [0., 0.5])
+        self.assertListAlmostEqual(vel, [0., 0.])
+
+        self.assertEqual(trajectory.move_segments((1., 1.), (1., 1.), 10.,
+            100.), [])
+
+    def test_line_too_short(self):
+        """A scan line too short to reach the scan speed is rejected."""
+        with self.assertRaises(ValueError):
+            trajectory.line_segments((0., 0.), (0.01, 0.), 2., 50.)
+
+        # Exactly long enough has no constant speed segment
+        segments = trajectory.line_segments((0., 0.), (1., 0.), 2., 4.)
+        self.assertEqual(len(segments), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
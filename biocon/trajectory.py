@@ -0,0 +1,273 @@
+# coding: utf-8
+#
+#    Project: BioCAT user beamline control software (BioCON)
+#             https://github.com/biocatiit/beamline-control-user
+#
+#
+#    Principal author:       Jesse Hopkins
+#
+#    This is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This software is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Trajectory generation for the Newport XPS multiple axes PVT (position,
+velocity, time) mode, used to run a whole multi-pass TR-SAXS raster as one
+controller trajectory.
+
+A trajectory is a list of segments ``(time, displacements, velocities)``,
+where ``displacements`` is the move of each axis during the segment and
+``velocities`` is the velocity of each axis at the end of the segment. The
+velocity at the start of a segment is the end velocity of the previous
+segment, and the trajectory starts and ends at rest. All of the segments
+made here have constant acceleration.
+
+Scan passes are straight lines run at constant speed, with the acceleration
+and deceleration inside the line ends, the same as a point to point move.
+Passes are joined by rest to rest moves.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import object, range, map
+from io import open
+
+import math
+import logging
+
+if __name__ != '__main__':
+    logger = logging.getLogger(__name__)
+
+
+def line_segments(start, end, speed, accel):
+    """
+    Makes the segments for a scan pass from ``start`` to ``end``, starting
+    and ending at rest, with constant speed between the acceleration and
+    deceleration.
+
+    :param list start: The start position of each axis.
+
+    :param list end: The end position of each axis.
+
+    :param float speed: The scan speed along the line.
+
+    :param float accel: The acceleration along the line.
+
+    :returns: The segments. These are the acceleration, constant speed and
+        deceleration segments, without the constant speed segment if the
+        line is exactly long enough to reach the scan speed.
+    :rtype: list
+
+    :raises ValueError: If the line is too short to reach the scan speed.
+    """
+    length, direction = _get_direction(start, end)
+
+    accel_time = speed/accel
+    accel_dist = speed**2/(2*accel)
+
+    if length < 2*accel_dist:
+        raise ValueError(('The scan line ({} long) is too short to reach the '
+            'scan speed, it needs to be at least {} long').format(length,
+            2*accel_dist))
+
+    velocity = [speed*d for d in direction]
+    zero = [0. for d in direction]
+
+    segments = [(accel_time, [accel_dist*d for d in direction], velocity)]
+
+    cruise_dist = length - 2*accel_dist
+
+    if cruise_dist > 0:
+        segments.append((cruise_dist/speed, [cruise_dist*d for d in direction],
+            velocity))
+
+    segments.append((accel_time, [accel_dist*d for d in direction], zero))
+
+    return segments
+
+def move_segments(start, end, speed, accel):
+    """
+    Makes the segments for a rest to rest move from ``start`` to ``end``
+    along a straight line. The move reaches ``speed`` if the move is long
+    enough, otherwise it accelerates for half the move and decelerates for
+    the other half.
+
+    :param list start: The start position of each axis.
+
+    :param list end: The end position of each axis.
+
+    :param float speed: The maximum speed along the line.
+
+    :param float accel: The acceleration along the line.
+
+    :returns: The segments, or an empty list if start and end are the same.
+    :rtype: list
+    """
+    length, direction = _get_direction(start, end)
+
+    if length == 0:
+        return []
+
+    if length >= speed**2/accel:
+        return line_segments(start, end, speed, accel)
+
+    # Too short to reach full speed, so the move is accelerate then decelerate
+    speed = math.sqrt(length*accel)
+    accel_time = speed/accel
+    half = [length/2.*d for d in direction]
+
+    return [(accel_time, half, [speed*d for d in direction]),
+        (accel_time, list(half), [0. for d in direction])]
+
+def raster_trajectory(lines, scan_speed, scan_accel, move_speed, move_accel):
+    """
+    Makes a trajectory that runs each line as a scan pass, joining the end
+    of each pass to the start of the next one with a rest to rest move.
+
+    :param list lines: The scan passes, each a ``(start, end)`` pair of
+        positions. The trajectory starts at the start of the first line.
+
+    :param float scan_speed: The speed along the scan passes.
+
+    :param float scan_accel: The acceleration for the scan passes.
+
+    :param float move_speed: The maximum speed for the moves between passes.
+
+    :param float move_accel: The acceleration for the moves between passes.
+
+    :returns: ``(segments, passes)``. ``passes`` has a dictionary for each
+        line, with the first and last segment numbers of the pass (counted
+        from 1, as the XPS counts trajectory elements), the start and end
+        times of the pass, and the start and end times of the constant
+        speed part of the pass.
+    :rtype: tuple
+    """
+    segments = []
+    passes = []
+    total_time = 0.
+
+    for i, (start, end) in enumerate(lines):
+        if i > 0:
+            move = move_segments(lines[i-1][1], start, move_speed, move_accel)
+            segments.extend(move)
+            total_time += sum(seg[0] for seg in move)
+
+        scan = line_segments(start, end, scan_speed, scan_accel)
+
+        pass_info = {
+            'first_segment' : len(segments)+1,
+            'last_segment'  : len(segments)+len(scan),
+            'start_time'    : total_time,
+            'cruise_start'  : total_time + scan[0][0],
+            'cruise_end'    : total_time + sum(seg[0] for seg in scan[:-1]),
+            'end_time'      : total_time + sum(seg[0] for seg in scan),
+            }
+
+        passes.append(pass_info)
+        segments.extend(scan)
+        total_time = pass_info['end_time']
+
+    return segments, passes
+
+def serpentine(lines):
+    """
+    Reverses every other line, so that each pass starts where the previous
+    one ended on the scan axis.
+
+    :param list lines: The ``(start, end)`` line pairs.
+
+    :returns: The lines, with the odd numbered lines (counting from 0)
+        reversed.
+    :rtype: list
+    """
+    return [(start, end) if i % 2 == 0 else (end, start) for i, (start, end)
+        in enumerate(lines)]
+
+def format_pvt(segments):
+    """
+    Formats a trajectory as an XPS multiple axes PVT trajectory file. Each
+    line is the segment time followed by the displacement and end velocity
+    of each axis.
+
+    :param list segments: The trajectory segments.
+
+    :rtype: str
+    """
+    lines = []
+
+    for seg_time, displacements, velocities in segments:
+        values = [seg_time]
+        for disp, vel in zip(displacements, velocities):
+            values.extend([disp, vel])
+
+        lines.append(', '.join('{:.9f}'.format(val) for val in values))
+
+    return '\n'.join(lines) + '\n'
+
+def evaluate(segments, start, t):
+    """
+    Returns the position and velocity of each axis at a time in a
+    trajectory, using the cubic interpolation the XPS uses for PVT elements.
+
+    :param list segments: The trajectory segments.
+
+    :param list start: The start position of each axis.
+
+    :param float t: The time from the start of the trajectory.
+
+    :returns: ``(positions, velocities)``
+    :rtype: tuple
+    """
+    position = list(start)
+    velocity = [0. for pos in start]
+
+    for seg_time, displacements, end_velocities in segments:
+        if t <= seg_time:
+            return _interpolate(position, velocity, seg_time, displacements,
+                end_velocities, t)
+
+        position = [pos+disp for pos, disp in zip(position, displacements)]
+        velocity = list(end_velocities)
+        t -= seg_time
+
+    return position, velocity
+
+def get_duration(segments):
+    """
+    Returns the total time of a trajectory.
+
+    :param list segments: The trajectory segments.
+
+    :rtype: float
+    """
+    return sum(seg[0] for seg in segments)
+
+def _interpolate(position, velocity, seg_time, displacements, end_velocities, t):
+    positions = []
+    velocities = []
+
+    for pos, v0, disp, v1 in zip(position, velocity, displacements,
+        end_velocities):
+        # p(t) = pos + v0*t + b*t**2 + c*t**3, with p(T) = pos+disp, p'(T) = v1
+        b = (3*disp - (2*v0 + v1)*seg_time)/seg_time**2
+        c = ((v0 + v1)*seg_time - 2*disp)/seg_time**3
+
+        positions.append(pos + v0*t + b*t**2 + c*t**3)
+        velocities.append(v0 + 2*b*t + 3*c*t**2)
+
+    return positions, velocities
+
+def _get_direction(start, end):
+    delta = [e-s for s, e in zip(start, end)]
+    length = math.sqrt(sum(d**2 for d in delta))
+
+    if length == 0:
+        return 0., [0. for d in delta]
+
+    return length, [d/length for d in delta]
@@ -44,7 +44,7 @@ import pumpcon
 import fmcon
 import valvecon
 import client
-import XPS_C8_drivers as xps_drivers
+import commthread
 import utils
 
 class TRScanPanel(wx.Panel):
@@ -110,8 +110,6 @@ class TRScanPanel(wx.Panel):
         self.settings = settings
         self.motor = None
 
-        self.xps = None
-
         self._abort_event = threading.Event()
 
         self._create_layout()
@@ -352,10 +350,7 @@ class TRScanPanel(wx.Panel):
             self.scan_end_offset_dist.Enable()
 
         if self.settings['motor_type'] == 'Newport_XPS':
-            if self.xps is None:
-                self.xps = xps_drivers.XPS()
-
-            self.motor = motorcon.NewportXPSMotor('TRSAXS', self.xps, self.settings['motor_ip'],
+            self.motor = motorcon.NewportXPSMotor('TRSAXS', None, self.settings['motor_ip'],
                 int(self.settings['motor_port']), 20, self.settings['motor_group_name'],
                 2)
 
@@ -444,7 +439,7 @@ class TRScanPanel(wx.Panel):
                 x_motor = str(scan_settings['motor_x_name'])
                 y_motor = str(scan_settings['motor_y_name'])
 
-            motor_cmd_q = deque()
+            motor_cmd_q = commthread.CommandQueue()
             motor_answer_q = deque()
             abort_event = threading.Event()
             motor_con = motorcon.MotorCommThread(motor_cmd_q, motor_answer_q, abort_event, name='MotorCon')
@@ -1560,6 +1555,13 @@ class TRScanPanel(wx.Panel):
                 scan_values['pco_direction'] = self.settings['pco_direction']
                 scan_values['pco_pulse_width'] = self.settings['pco_pulse_width']
                 scan_values['pco_encoder_settle_t'] =  self.settings['pco_encoder_settle_t']
+                scan_values['xps_gathering'] = self.settings['xps_gathering']
+                scan_values['xps_gathering_quantities'] = self.settings['xps_gathering_quantities']
+                scan_values['xps_gathering_divisor'] = self.settings['xps_gathering_divisor']
+                scan_values['pvt_mode'] = self.settings['pvt_mode']
+                scan_values['pvt_serpentine'] = self.settings['pvt_serpentine']
+                scan_values['xps_ftp_user'] = self.settings['xps_ftp_user']
+                scan_values['xps_ftp_password'] = self.settings['xps_ftp_password']
 
         return scan_values, valid
 
@@ -1758,17 +1760,17 @@ class TRFlowPanel(wx.Panel):
             self.outlet_T.SetLabel('22')
 
     def _init_connections(self):
-        self.pump_cmd_q = deque()
+        self.pump_cmd_q = commthread.CommandQueue()
         self.pump_return_q = deque()
         self.pump_abort_event = threading.Event()
         self.pump_event = threading.Event()
 
-        self.fm_cmd_q = deque()
+        self.fm_cmd_q = commthread.CommandQueue()
         self.fm_return_q = deque()
         self.fm_abort_event = threading.Event()
         self.fm_event = threading.Event()
 
-        self.valve_cmd_q = deque()
+        self.valve_cmd_q = commthread.CommandQueue()
         self.valve_return_q = deque()
         self.valve_abort_event = threading.Event()
         self.valve_event = threading.Event()
@@ -1808,6 +1810,24 @@ class TRFlowPanel(wx.Panel):
 
             self.local_devices = False
 
+        self.telemetry = {}
+
+        telemetry_port = self.settings['remote_telemetry_port']
+
+        if not self.local_devices and telemetry_port is not None:
+            telemetry_clients = {}
+
+            for device, ip in [('pump', pump_ip), ('fm', fm_ip), ('valve', valve_ip)]:
+                if ip not in telemetry_clients:
+                    telemetry_clients[ip] = client.TelemetryClient(ip,
+                        telemetry_port, name='TelemetryClient')
+
+                telemetry_clients[ip].subscribe(device)
+                self.telemetry[device] = telemetry_clients[ip]
+
+            for telemetry_client in telemetry_clients.values():
+                telemetry_client.start()
+
         self.pump_con.start()
         self.fm_con.start()
         self.valve_con.start()
@@ -1840,6 +1860,17 @@ class TRFlowPanel(wx.Panel):
         self.fm_monitor_interval = 2
         self.fm_monitor_all_interval = 10
 
+        # Monitors poll at the intervals above while devices are active, and
+        # back off to this while they are idle
+        self.monitor_max_interval = 16
+
+        self.valve_poller = commthread.AdaptivePoller(self.valve_monitor_interval,
+            self.monitor_max_interval)
+        self.pump_poller = commthread.AdaptivePoller(self.pump_monitor_interval,
+            self.monitor_max_interval)
+        self.fm_poller = commthread.AdaptivePoller(self.fm_monitor_interval,
+            self.monitor_max_interval)
+
         self._on_flow_change(None)
 
         #For communicating with exposure thread
@@ -2694,20 +2725,24 @@ class TRFlowPanel(wx.Panel):
             wx.CallAfter(self._set_valve_status, position[1], position[2])
 
     def get_all_valve_positions(self):
-        cmd = ('get_position_multi', ([valve for valve in self.valves],), {})
+        names = [valve for valve in self.valves]
+        values = self._get_cached_state(self._send_valvecmd, names,
+            ['position'], self.valve_monitor_interval/2.,
+            ('get_position_multi', (names,), {}))
 
-        ret = self._send_valvecmd(cmd, True)
-
-        if ret is not None and ret[0] == 'multi_positions':
-            for i in range(len(ret[1])):
-                wx.CallAfter(self._set_valve_status, ret[1][i], ret[2][i])
+        if values is not None:
+            for name, val in zip(names, values):
+                wx.CallAfter(self._set_valve_status, name, val[0])
 
     def set_multiple_valve_positions(self, valve_names, positions):
-        cmd = ('set_position_multi', (valve_names, positions), {})
-        ret = self._send_valvecmd(cmd, True)
-
-        if ret is not None and ret[0] == 'set_position_multi':
-            success = all(ret[2])
+        # Sent as a batch so valves on different ports move at the same time
+        cmds = [('set_position', (name, position), {}) for name, position
+            in zip(valve_names, positions)]
+        ret = self._send_valvecmd(('batch', (cmds,), {}), True)
+
+        if ret is not None and ret[0] == 'batch':
+            success = all([answer is not None and answer[0] == 'set_position'
+                and answer[2] for answer in ret[1]])
         else:
             success = False
 
@@ -2753,24 +2788,42 @@ class TRFlowPanel(wx.Panel):
     def _monitor_valve_position(self):
         logger.info('Starting continuous monitoring of valve positions')
 
-        monitor_cmd = ('get_position_multi', ([valve for valve in self.valves],), {})
+        names = [valve for valve in self.valves]
+
+        positions = {}
 
         while not self.stop_valve_monitor.is_set():
             start_time = time.time()
+            active = True
+
             if (not self.stop_valve_monitor.is_set() and
                 not self.pause_valve_monitor.is_set()):
-                ret = self._send_valvecmd(monitor_cmd, True)
+                values = self._get_telemetry('valve', names, ['position'],
+                    self.valve_monitor_interval)
+
+                if values is None:
+                    values = self._get_cached_state(self._send_valvecmd, names,
+                        ['position'], self.valve_monitor_interval/2.,
+                        ('get_position_multi', (names,), {}))
+
+                if values is not None:
+                    ret = ('multi_positions', names, [val[0] for val in values])
+                else:
+                    ret = None
 
                 if (ret is not None and ret[0] == 'multi_positions'
                     and not self.pause_valve_monitor.is_set()):
+                    active = False
+
                     for i, name in enumerate(ret[1]):
                         wx.CallAfter(self._set_valve_status, name, ret[2][i])
 
-            while time.time() - start_time < self.valve_monitor_interval:
-                time.sleep(0.1)
+                        if positions.get(name) != ret[2][i]:
+                            positions[name] = ret[2][i]
+                            active = True
 
-                if self.stop_valve_monitor.is_set():
-                    break
+            self.valve_poller.update(active)
+            self.valve_poller.wait(start_time, self.stop_valve_monitor)
 
         logger.info('Stopping continuous monitoring of valve positions')
 
@@ -2822,14 +2875,17 @@ class TRFlowPanel(wx.Panel):
         success = True
         names = [pump_name for pump_name in self.pumps]
 
-        for pump_name in names:
-            cmd = ('stop', (pump_name,), {})
-            ret = self._send_pumpcmd(cmd, True)
+        # Sent as a batch so pumps on different ports stop at the same time
+        cmds = [('stop', (pump_name,), {}) for pump_name in names]
+        ret = self._send_pumpcmd(('batch', (cmds,), {}), True)
 
-            if (ret is not None and ret[0] == pump_name and ret[1] == 'stop'):
-                success = ret[1] and success
-            else:
-                success = False
+        if ret is not None and ret[0] == 'batch':
+            for pump_name, answer in zip(names, ret[1]):
+                if not (answer is not None and answer[0] == pump_name
+                    and answer[1] == 'stop'):
+                    success = False
+        else:
+            success = False
 
         if success:
             self.get_all_pump_status()
@@ -2908,28 +2964,43 @@ class TRFlowPanel(wx.Panel):
 
     def get_all_pump_status(self):
         names = [pump_name for pump_name in self.pumps]
-        cmd = ('get_status_multi', (names,), {})
+        values = self._get_cached_state(self._send_pumpcmd, names,
+            ['moving', 'volume'], self.pump_monitor_interval/2.,
+            ('get_status_multi', (names,), {}))
 
-        ret = self._send_pumpcmd(cmd, True)
-
-        if ret is not None and ret[1] == 'multi_status':
-            for i, pump_name in enumerate(ret[0]):
-                self.set_pump_moving(pump_name, ret[2][i][0])
-                self.set_pump_status_volume(pump_name, ret[2][i][1])
+        if values is not None:
+            for pump_name, val in zip(names, values):
+                self.set_pump_moving(pump_name, val[0])
+                self.set_pump_status_volume(pump_name, val[1])
 
     def _monitor_pump_status(self):
         logger.info('Starting continuous monitoring of pump status')
 
-        monitor_cmd = ('get_status_multi', ([pump for pump in self.pumps],), {})
+        names = [pump for pump in self.pumps]
 
         while not self.stop_pump_monitor.is_set():
             start_time = time.time()
+            active = True
+
             if (not self.stop_pump_monitor.is_set() and
                 not self.pause_pump_monitor.is_set()):
-                ret = self._send_pumpcmd(monitor_cmd, True)
+                values = self._get_telemetry('pump', names, ['moving', 'volume'],
+                    self.pump_monitor_interval)
+
+                if values is None:
+                    values = self._get_cached_state(self._send_pumpcmd, names,
+                        ['moving', 'volume'], self.pump_monitor_interval/2.,
+                        ('get_status_multi', (names,), {}))
+
+                if values is not None:
+                    ret = (names, 'multi_status', values)
+                else:
+                    ret = None
 
                 if (ret is not None and ret[1] == 'multi_status'
                     and not self.pause_pump_monitor.is_set()):
+                    active = False
+
                     for i, name in enumerate(ret[0]):
                         pump_panel = self.pump_panels[name]
 
@@ -2938,14 +3009,16 @@ class TRFlowPanel(wx.Panel):
 
                         if moving != pump_panel.moving:
                             wx.CallAfter(self.set_pump_moving, name, moving)
+                            active = True
                         if round(float(vol), 3) != float(pump_panel.get_status_volume()):
                             wx.CallAfter(self.set_pump_status_volume, name, vol)
+                            active = True
 
-            while time.time() - start_time < self.pump_monitor_interval:
-                time.sleep(0.1)
+                        if moving:
+                            active = True
 
-                if self.stop_pump_monitor.is_set():
-                    break
+            self.pump_poller.update(active)
+            self.pump_poller.wait(start_time, self.stop_pump_monitor)
 
         logger.info('Stopping continuous monitoring of pump status')
 
@@ -2961,19 +3034,33 @@ class TRFlowPanel(wx.Panel):
     def _monitor_fm_status(self):
         logger.info('Starting continuous monitoring of flow rate')
 
-        flow_cmd = ('get_fr_multi', ([fm for fm in self.fms],), {})
-        all_cmd = ('get_all_multi', ([fm for fm in self.fms],), {})
+        names = [fm for fm in self.fms]
 
         monitor_all_time = time.time()
 
+        flow_rates = {}
+
         while not self.stop_fm_monitor.is_set():
             start_time = time.time()
+            active = True
+
             if (not self.stop_fm_monitor.is_set() and
                 not self.pause_fm_monitor.is_set()):
 
                 if (time.time()-monitor_all_time < self.fm_monitor_all_interval
                     or self.pause_fm_den_T_monitor.is_set()):
-                    ret = self._send_fmcmd(flow_cmd, True)
+                    values = self._get_telemetry('fm', names, ['flow_rate'],
+                        self.fm_monitor_interval)
+
+                    if values is None:
+                        values = self._get_cached_state(self._send_fmcmd,
+                            names, ['flow_rate'], self.fm_monitor_interval/2.,
+                            ('get_fr_multi', (names,), {}))
+
+                    if values is not None:
+                        ret = ('multi_flow', names, [val[0] for val in values])
+                    else:
+                        ret = None
 
                     if (ret is not None and ret[0] == 'multi_flow'
                         and not self.pause_fm_monitor.is_set()):
@@ -2981,8 +3068,23 @@ class TRFlowPanel(wx.Panel):
                         for i, name in enumerate(ret[1]):
                             flow_rate = ret[2][i]
                             wx.CallAfter(self._set_fm_values, name, flow_rate=flow_rate)
+
+                        active = self._fm_flow_active(flow_rates, ret[1],
+                            ret[2])
                 else:
-                    ret = self._send_fmcmd(all_cmd, True)
+                    values = self._get_telemetry('fm', names, ['flow_rate',
+                        'density', 'temperature'], self.fm_monitor_all_interval)
+
+                    if values is None:
+                        values = self._get_cached_state(self._send_fmcmd,
+                            names, ['flow_rate', 'density', 'temperature'],
+                            self.fm_monitor_interval/2.,
+                            ('get_all_multi', (names,), {}))
+
+                    if values is not None:
+                        ret = ('multi_all', names, values)
+                    else:
+                        ret = None
 
                     if (ret is not None and ret[0] == 'multi_all'
                         and not self.pause_fm_monitor.is_set()):
@@ -2994,16 +3096,37 @@ class TRFlowPanel(wx.Panel):
                             wx.CallAfter(self._set_fm_values, name,
                                 flow_rate=flow_rate, density=density, T=T)
 
+                        active = self._fm_flow_active(flow_rates, ret[1],
+                            [val[0] for val in ret[2]])
+
                     monitor_all_time = time.time()
 
-            while time.time() - start_time < self.fm_monitor_interval:
-                time.sleep(0.1)
-
-                if self.stop_fm_monitor.is_set():
-                    break
+            self.fm_poller.update(active)
+            self.fm_poller.wait(start_time, self.stop_fm_monitor)
 
         logger.info('Stopping continuous monitoring of flow rate')
 
+    def _fm_flow_active(self, flow_rates, names, values):
+        """
+        Returns True if any flow meter shows flow, or a flow rate changed
+        at the displayed precision since the last poll.
+        """
+        active = False
+
+        for name, flow_rate in zip(names, values):
+            try:
+                flow_rate = round(float(flow_rate), 2)
+            except (TypeError, ValueError):
+                active = True
+                continue
+
+            if flow_rate != 0 or flow_rates.get(name) != flow_rate:
+                active = True
+
+            flow_rates[name] = flow_rate
+
+        return active
+
     def _set_fm_values(self, fm_name, flow_rate=None, density=None, T=None):
         if fm_name == 'outlet_fm':
             rate_ctrl = self.outlet_flow
@@ -3326,22 +3449,82 @@ class TRFlowPanel(wx.Panel):
 
         return success
 
+    def _get_telemetry(self, device, names, fields, max_age):
+        """
+        Gets device values from the server telemetry, if there is any.
+
+        :returns: A list of the field values for each device, or ``None`` if
+            there is no telemetry for the devices newer than ``max_age``.
+        """
+        telemetry_client = self.telemetry.get(device)
+
+        if telemetry_client is None:
+            return None
+
+        sample_time, values = telemetry_client.get(device, names, fields, max_age)
+
+        return values
+
+    def _get_cached_state(self, send_cmd, names, fields, max_age,
+        fallback_cmd=None):
+        """
+        Gets device state from the control thread state cache, which only
+        queries the devices for values older than ``max_age``. If that fails
+        (e.g. a control server without the cache), the state is read with
+        ``fallback_cmd`` instead.
+
+        :param callable send_cmd: The send method for the device type, e.g.
+            :py:func:`_send_pumpcmd`.
+
+        :param tuple fallback_cmd: A command that reads the same fields for
+            the devices, e.g. ``get_status_multi`` for the pumps.
+
+        :returns: A list of the field values for each device, or ``None`` if
+            there is no answer.
+        """
+        cmd = ('get_cached', (names, fields), {'max_age': max_age})
+        ret = send_cmd(cmd, True)
+
+        if ret is not None and len(ret) == 3 and ret[1] == 'cached':
+            return ret[2]
+
+        if fallback_cmd is None:
+            return None
+
+        logger.debug('Cached state unavailable, sending %s', fallback_cmd[0])
+
+        ret = send_cmd(fallback_cmd, True)
+
+        if ret is None or len(ret) != 3:
+            return None
+
+        if ret[0] == 'multi_positions' or ret[0] == 'multi_flow':
+            return [[val] for val in ret[2]]
+
+        elif ret[0] == 'multi_all' or ret[1] == 'multi_status':
+            return [list(val) for val in ret[2]]
+
+        return None
+
     def _send_valvecmd(self, cmd, response=False):
         ret_val = None
 
+        if cmd[0] not in valvecon.ValveCommThread.monitor_commands:
+            self.valve_poller.wake()
+
         if not self.timeout_event.is_set():
             if not self.local_devices:
                 full_cmd = {'device': 'valve', 'command': cmd, 'response': response}
+                answer_future = self.valve_con.submit(full_cmd)
             else:
-                full_cmd = cmd
-            self.valve_cmd_q.append(full_cmd)
+                answer_future = self.valve_con.submit(*cmd)
 
             if response:
-                while len(self.valve_return_q) == 0 and not self.timeout_event.is_set():
-                    time.sleep(0.01)
+                answer = commthread.wait_for_answer(answer_future,
+                    self.timeout_event, ret_val)
 
                 if not self.timeout_event.is_set():
-                    ret_val = self.valve_return_q.popleft()
+                    ret_val = answer
                 else:
                     msg = ('Lost connection to the flow control server. '
                         'Contact your beamline scientist.')
@@ -3363,19 +3546,24 @@ class TRFlowPanel(wx.Panel):
     def _send_pumpcmd(self, cmd, response=False):
         ret_val = None
 
+        # Pump commands change the flow, so the flow meters are woken too
+        if cmd[0] not in pumpcon.PumpCommThread.monitor_commands:
+            self.pump_poller.wake()
+            self.fm_poller.wake()
+
         if not self.timeout_event.is_set():
             if not self.local_devices:
                 full_cmd = {'device': 'pump', 'command': cmd, 'response': response}
+                answer_future = self.pump_con.submit(full_cmd)
             else:
-                full_cmd = cmd
-            self.pump_cmd_q.append(full_cmd)
+                answer_future = self.pump_con.submit(*cmd)
 
             if response:
-                while len(self.pump_return_q) == 0 and not self.timeout_event.is_set():
-                    time.sleep(0.01)
+                answer = commthread.wait_for_answer(answer_future,
+                    self.timeout_event, ret_val)
 
                 if not self.timeout_event.is_set():
-                    ret_val = self.pump_return_q.popleft()
+                    ret_val = answer
                 else:
                     msg = ('Lost connection to the flow control server. '
                         'Contact your beamline scientist.')
@@ -3403,19 +3591,23 @@ class TRFlowPanel(wx.Panel):
             :py:class:`FlowMeterCommThread` ``_commands`` dictionary.
         """
         ret_val = (None, None)
+
+        if cmd[0] not in fmcon.FlowMeterCommThread.monitor_commands:
+            self.fm_poller.wake()
+
         if not self.timeout_event.is_set():
             if not self.local_devices:
                 full_cmd = {'device': 'fm', 'command': cmd, 'response': response}
+                answer_future = self.fm_con.submit(full_cmd)
             else:
-                full_cmd = cmd
-            self.fm_cmd_q.append(full_cmd)
+                answer_future = self.fm_con.submit(*cmd)
 
             if response:
-                while len(self.fm_return_q) == 0 and not self.timeout_event.is_set():
-                    time.sleep(0.01)
+                answer = commthread.wait_for_answer(answer_future,
+                    self.timeout_event, ret_val)
 
                 if not self.timeout_event.is_set():
-                    ret_val = self.fm_return_q.popleft()
+                    ret_val = answer
 
                 else:
                     msg = ('Lost connection to the flow control server. '
@@ -3601,6 +3793,9 @@ class TRFlowPanel(wx.Panel):
         self.pump_con.stop()
         self.fm_con.stop()
 
+        for telemetry_client in set(self.telemetry.values()):
+            telemetry_client.stop()
+
         if not self.timeout_event.is_set():
             try:
                 self.valve_con.join(5)
@@ -4253,6 +4448,13 @@ if __name__ == '__main__':
         'pco_direction'         : 'x',
         'pco_pulse_width'       : D('10'), #In microseconds, opt: 0.2, 1, 2.5, 10
         'pco_encoder_settle_t'  : D('0.075'), #In microseconds, opt: 0.075, 1, 4, 12
+        'xps_gathering'         : False, #Record XPS positions during scans
+        'xps_gathering_quantities': ['CurrentPosition'],
+        'xps_gathering_divisor' : 10, #Gather every N 10 kHz XPS servo cycles
+        'pvt_mode'              : False, #Run all scan passes as one XPS PVT trajectory, needs a MultipleAxes group
+        'pvt_serpentine'        : True, #Alternate pass directions in PVT mode
+        'xps_ftp_user'          : 'Administrator',
+        'xps_ftp_password'      : '', #Set for the local controller, not kept in the repository
         'encoder_resolution'    : D('0.000001'), #for ILS50PP, in mm
         'encoder_precision'     : D(6), #Number of significant decimals in encoder value
         'min_off_time'          : D('0.001'),
@@ -4263,9 +4465,10 @@ if __name__ == '__main__':
         'remote_pump_ip'        : '164.54.204.8',
         'remote_pump_port'      : '5556',
         'remote_fm_ip'          : '164.54.204.8',
-        'remote_fm_port'        : '5557',
+        'remote_fm_port'        : '5556',
         'remote_valve_ip'       : '164.54.204.8',
-        'remote_valve_port'     : '5558',
+        'remote_valve_port'     : '5556',
+        'remote_telemetry_port' : '5559',
         # 'device_communication'  : 'remote',
         # 'injection_valve'       : [('Rheodyne', 'COM6', [], {'positions' : 2}, 'Injection'),],
         # 'sample_valve'          : [('Rheodyne', 'COM7', [], {'positions' : 6}, 'Sample'),],
@@ -23,6 +23,8 @@ from builtins import object, range, map
 from io import open
 
 import threading
+import contextlib
+import re
 import time
 from collections import OrderedDict, deque
 import logging
@@ -39,6 +41,7 @@ import serial.tools.list_ports as list_ports
 from six import string_types
 
 import utils
+import commthread
 
 print_lock = threading.RLock()
 
@@ -46,18 +49,36 @@ class SerialComm(object):
     """
     This class impliments a generic serial communication setup. The goal is
     to provide a lightweight wrapper around a pyserial Serial device to make sure
-    ports are properly opened and closed whenever used.
+    ports are properly opened and closed whenever used. In persistent mode
+    the port is instead opened once and kept open for the lifetime of the
+    device, and is reopened automatically after a communication error.
+    Persistent connections are shared between all devices on a port, see
+    :py:func:`get_comm`.
     """
+    _shared_comms = {}
+    _shared_comms_lock = threading.Lock()
+
+    # How far (in s) a read may run past the deadline in _read_frame
+    timeout_slack = 0.05
+
     def __init__(self, port=None, baudrate=9600, bytesize=serial.EIGHTBITS,
         parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=None,
         xonxoff=False, rtscts=False, write_timeout=None, dsrdtr=False,
-        inter_byte_timeout=None, exclusive=None):
+        inter_byte_timeout=None, exclusive=None, persistent=False):
         """
         Parameters are all of those accepted by a
         `pyserial.Serial <https://pyserial.readthedocs.io/en/latest/pyserial_api.html#serial.Serial>`_
         device, defaults are set to those default values.
+
+        :param bool persistent: If ``True``, the port is left open between
+            commands instead of being opened and closed around every read
+            and write. Defaults to ``False``.
         """
         self.ser = None
+        self.port = port
+        self.persistent = persistent
+        self._frame_buffer = bytearray()
+        self._users = 1
 
         logger.info("Attempting to connect to serial device on port %s", port)
 
@@ -70,15 +91,190 @@ class SerialComm(object):
         except serial.SerialException:
             logger.exception("Failed to connect to serial device on port %s", port)
         finally:
-            if self.ser is not None:
+            if self.ser is not None and not self.persistent:
                 self.ser.close()
 
+    @classmethod
+    def get_comm(cls, port, persistent=False, **kwargs):
+        """
+        Returns a ``SerialComm`` (of the calling class) for the port. In
+        persistent mode the port can only be held open once, so devices
+        that are daisy-chained on the same port (and so share a
+        ``comm_lock``) share a single persistent connection. The port is
+        closed when the last device using it calls :py:func:`close`.
+        Outside of persistent mode a new ``SerialComm`` is returned.
+
+        :param str port: The device comport as sent to pyserial.
+
+        :param bool persistent: Whether to use a persistent connection.
+
+        :param \*\*kwargs: Any other ``SerialComm`` parameters. For a port
+            that is already open these must match those used to open it.
+
+        :returns: The serial communication object for the port.
+        :rtype: SerialComm
+        """
+        if not persistent:
+            return cls(port, **kwargs)
+
+        with SerialComm._shared_comms_lock:
+            comm = SerialComm._shared_comms.get(port)
+
+            if comm is not None and comm.ser is not None:
+                if type(comm) is not cls:
+                    logger.error("Serial device on port %s is already open as "
+                        "a %s", port, type(comm).__name__)
+                    raise ValueError("Port %s is already open as a %s"
+                        %(port, type(comm).__name__))
+
+                comm._users += 1
+                logger.info("Sharing persistent connection to serial device "
+                    "on port %s", port)
+
+            else:
+                comm = cls(port, persistent=True, **kwargs)
+                SerialComm._shared_comms[port] = comm
+
+        return comm
+
     def __repr__(self):
         return self.ser
 
     def __str__(self):
         return print(self.ser)
 
+    @contextlib.contextmanager
+    def _open_port(self):
+        """
+        Context manager that yields an open Serial device. Outside of
+        persistent mode the port is opened on entry and closed on exit.
+        In persistent mode the port is only (re)opened if it isn't already
+        open, and it is closed if a communication error occurs so that the
+        next command reconnects.
+        """
+        if not self.persistent:
+            with self.ser as s:
+                yield s
+
+        else:
+            if not self.ser.is_open:
+                logger.info("Reconnecting to serial device on port %s", self.ser.port)
+                self.ser.open()
+
+            try:
+                yield self.ser
+            except (serial.SerialException, OSError):
+                logger.error("Communication error on serial device on port %s, "
+                    "closing port", self.ser.port)
+                self.ser.close()
+                raise
+
+    def close(self):
+        """
+        Closes the serial port. For a persistent connection shared between
+        several devices, the port is only closed once every device has
+        closed it.
+        """
+        with SerialComm._shared_comms_lock:
+            if self._users > 1:
+                self._users -= 1
+                return
+
+            self._users = 0
+            if SerialComm._shared_comms.get(self.port) is self:
+                del SerialComm._shared_comms[self.port]
+
+        if self.ser is not None:
+            self.ser.close()
+
+    def _clear_input(self, s):
+        """
+        Discards any unread bytes left over from a previous command, both
+        in the partial frame buffer and, for a persistent port, in the
+        serial input buffer. Called before a new command is sent.
+
+        :param serial.Serial s: The open serial device.
+        """
+        if len(self._frame_buffer) > 0:
+            logger.debug("Discarding %r from serial device on port %s",
+                bytes(self._frame_buffer), self.ser.port)
+            del self._frame_buffer[:]
+
+        if self.persistent:
+            s.reset_input_buffer()
+
+    def _read_frame(self, s, terminator, timeout=None):
+        """
+        Reads a response frame from the serial device. This blocks in the
+        serial read (rather than polling) until the terminator has been
+        received or the timeout expires. Data are accumulated in a partial
+        frame buffer, so a response that arrives split across several reads
+        is stitched together, and any bytes received after the terminator
+        are kept for the next frame.
+
+        :param serial.Serial s: The open serial device.
+
+        :param terminator: The terminator that ends the frame. Can be a
+            string, a list of strings (any of which ends the frame), or a
+            compiled bytes regular expression.
+
+        :param float timeout: Deadline in seconds for the whole frame, which
+            may be overrun by up to ``timeout_slack``. If ``None`` (default),
+            waits until the terminator is received.
+
+        :returns: The ascii (decoded) frame including the terminator. If
+            the timeout expires, whatever partial frame was received.
+        :rtype: str
+        """
+        if isinstance(terminator, string_types):
+            terminator = [terminator]
+
+        if not hasattr(terminator, 'search'):
+            terminator = re.compile(b'|'.join([re.escape(term.encode())
+                for term in terminator]))
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        old_timeout = s.timeout
+        match = terminator.search(self._frame_buffer)
+
+        try:
+            while match is None:
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+
+                    # Setting the timeout reconfigures the port, so it's only
+                    # shortened once the read could overrun the deadline by
+                    # more than timeout_slack
+                    if s.timeout is None or s.timeout > remaining + self.timeout_slack:
+                        s.timeout = remaining
+
+                elif s.timeout is not None:
+                    s.timeout = None
+
+                ret = s.read(max(1, s.in_waiting))
+                if len(ret) > 0:
+                    self._frame_buffer.extend(ret)
+                    match = terminator.search(self._frame_buffer)
+        finally:
+            if s.timeout != old_timeout:
+                s.timeout = old_timeout
+
+        if match is not None:
+            end = match.end()
+        else:
+            end = len(self._frame_buffer)
+            logger.debug("Timed out waiting for response from serial device "
+                "on port %s", self.ser.port)
+
+        frame = bytes(self._frame_buffer[:end])
+        del self._frame_buffer[:end]
+
+        return frame.decode('ascii')
+
     def read(self, size=1):
         """
         This wraps the Serial.read() function for reading in a specified
@@ -90,8 +286,12 @@ class SerialComm(object):
         :returns: The ascii (decoded) value of the ``Serial.read()``
         :rtype: str
         """
-        with self.ser as s:
-            ret = s.read(size)
+        with self._open_port() as s:
+            ret = bytes(self._frame_buffer[:size])
+            del self._frame_buffer[:size]
+
+            if len(ret) < size:
+                ret = ret + s.read(size-len(ret))
 
         logger.debug("Read %i bytes from serial device on port %s", size, self.ser.port)
         logger.debug("Serial device on port %s returned %s", self.ser.port, ret.decode())
@@ -106,8 +306,9 @@ class SerialComm(object):
         :returns: The ascii (decoded) value of the ``Serial.read()``
         :rtype: str
         """
-        with self.ser as s:
-            ret = s.read(s.in_waiting())
+        with self._open_port() as s:
+            ret = bytes(self._frame_buffer) + s.read(s.in_waiting)
+            del self._frame_buffer[:]
 
         logger.debug("Read all waiting bytes from serial device on port %s", self.ser.port)
         logger.debug("Serial device on port %s returned %s", self.ser.port, ret.decode())
@@ -127,6 +328,10 @@ class SerialComm(object):
         :param term_char: The terminal character expected in a response
         :type term_char: str
 
+        :param timeout: Deadline in seconds to wait for the response.
+            Defaults to 0.25 s.
+        :type timeout: float
+
         :returns: The requested response, or an empty string
         :rtype: str
         """
@@ -138,16 +343,11 @@ class SerialComm(object):
 
         out = ''
         try:
-            with self.ser as s:
+            with self._open_port() as s:
+                self._clear_input(s)
                 s.write(data)
                 if get_response:
-                    start_time = time.time()
-                    while not out.endswith(term_char) and time.time()-start_time <timeout:
-                        if s.in_waiting > 0:
-                            ret = s.read(s.in_waiting)
-                            out += ret.decode('ascii')
-
-                        time.sleep(.001)
+                    out = self._read_frame(s, term_char, timeout)
         except ValueError:
             logger.exception("Failed to write '%s' to serial device on port %s", data, self.ser.port)
 
@@ -218,7 +418,8 @@ class RheodyneValve(Valve):
         >>> print(my_bfs.flow_rate)
     """
 
-    def __init__(self, device, name, positions, comm_lock=None):
+    def __init__(self, device, name, positions, comm_lock=None,
+        persistent_comm=False):
         """
         This makes the initial serial connection, and then sets the MForce
         controller parameters to the correct values.
@@ -229,6 +430,9 @@ class RheodyneValve(Valve):
 
         :param float bfs_filter: Smoothing factor for measurement. 1 = minimum
             filter, 0.00001 = maximum filter. Defaults to 1
+
+        :param bool persistent_comm: If ``True`` the serial port is kept open
+            for the lifetime of the valve. Defaults to ``False``.
         """
         Valve.__init__(self, device, name, comm_lock=comm_lock)
 
@@ -237,7 +441,8 @@ class RheodyneValve(Valve):
         logger.info(logstr)
 
         self.comm_lock.acquire()
-        self.valve_comm = SerialComm(device, 19200)
+        self.valve_comm = SerialComm.get_comm(device, baudrate=19200,
+            persistent=persistent_comm)
         self.comm_lock.release()
 
         self.send_command('M', False) #Homes valve
@@ -333,14 +538,22 @@ class RheodyneValve(Valve):
 
         return ret, success
 
+    def stop(self):
+        """Close any communication connections"""
+        logger.debug("Closing valve %s serial connection", self.name)
+        self.valve_comm.close()
+
 
 class CheminertValve(Valve):
     """
     A VICI cheminert valve with universal actuator and serial control.
     """
 
-    def __init__(self, device, name, positions, comm_lock=None):
+    def __init__(self, device, name, positions, comm_lock=None,
+        persistent_comm=False):
         """
+        :param bool persistent_comm: If ``True`` the serial port is kept open
+            for the lifetime of the valve. Defaults to ``False``.
         """
         Valve.__init__(self, device, name, comm_lock=comm_lock)
 
@@ -349,7 +562,8 @@ class CheminertValve(Valve):
         logger.info(logstr)
 
         self.comm_lock.acquire()
-        self.valve_comm = SerialComm(device, 9600)
+        self.valve_comm = SerialComm.get_comm(device, baudrate=9600,
+            persistent=persistent_comm)
         self.comm_lock.release()
 
         # self.send_command('IFM1', False) #Sets the response mode to basic
@@ -409,6 +623,11 @@ class CheminertValve(Valve):
 
         return ret, success
 
+    def stop(self):
+        """Close any communication connections"""
+        logger.debug("Closing valve %s serial connection", self.name)
+        self.valve_comm.close()
+
 class SoftValve(Valve):
     """
     This class contains the settings and communication for a generic valve.
@@ -456,7 +675,7 @@ class SoftValve(Valve):
 
         return success
 
-class ValveCommThread(threading.Thread):
+class ValveCommThread(commthread.CommThread):
     """
     This class creates a control thread for flow meters attached to the system.
     This thread is designed for using a GUI application. For command line
@@ -467,7 +686,7 @@ class ValveCommThread(threading.Thread):
         import collections
         import threading
 
-        valve_cmd_q = deque()
+        valve_cmd_q = commthread.CommandQueue()
         valve_return_q = deque()
         abort_event = threading.Event()
         my_valvecon = ValveCommThread(valve_cmd_q, valve_return_q, abort_event, 'ValveCon')
@@ -484,8 +703,21 @@ class ValveCommThread(threading.Thread):
         valve_cmd_q.append(status_cmd)
         time.sleep(5)
         my_valvecon.stop()
+
+    Commands for each serial port run on a separate worker thread (see
+    :py:class:`commthread.CommThread`), so a slow valve on one port doesn't
+    delay commands for valves on other ports.
     """
 
+    thread_type = 'valve'
+
+    port_workers = True
+
+    connect_commands = ('connect', 'connect_remote', 'add_valve')
+
+    monitor_commands = ('get_position', 'get_position_multi', 'get_status',
+        'get_cached')
+
     def __init__(self, command_queue, return_queue, abort_event, name=None):
         """
         Initializes the custom thread. Important parameters here are the
@@ -500,16 +732,11 @@ class ValveCommThread(threading.Thread):
         :param threading.Event abort_event: An event that is set when the thread
             needs to abort, and otherwise is not set.
         """
-        threading.Thread.__init__(self, name=name)
-        self.daemon = True
+        commthread.CommThread.__init__(self, command_queue, return_queue,
+            abort_event, name=name)
 
         logger.info("Starting valve control thread: %s", self.name)
 
-        self.command_queue = command_queue
-        self.return_queue = return_queue
-        self._abort_event = abort_event
-        self._stop_event = threading.Event()
-
         self._commands = {'connect'         : self._connect_valve,
                         'get_position'      : self._get_position,
                         'set_position'      : self._set_position,
@@ -520,10 +747,14 @@ class ValveCommThread(threading.Thread):
                         'connect_remote'    : self._connect_valve_remote,
                         'get_position_multi': self._get_position_multiple,
                         'set_position_multi': self._set_position_multiple,
+                        'get_cached'        : self._get_cached,
                         }
 
         self._connected_valves = OrderedDict()
 
+        # Valves are connected and disconnected on the port workers
+        self._valves_lock = threading.Lock()
+
         self.comm_locks = {}
 
         self.known_valves = {'Rheodyne' : RheodyneValve,
@@ -531,53 +762,19 @@ class ValveCommThread(threading.Thread):
             'Cheminert' : CheminertValve,
             }
 
-    def run(self):
-        """
-        Custom run method for the thread.
-        """
-        while True:
-            if len(self.command_queue) > 0:
-                logger.debug("Getting new command")
-                command, args, kwargs = self.command_queue.popleft()
-            else:
-                command = None
-
-            if self._abort_event.is_set():
-                logger.debug("Abort event detected")
-                self._abort()
-                command = None
-
-            if self._stop_event.is_set():
-                logger.debug("Stop event detected")
-                self._abort()
-                break
-
-            if command is not None:
-                logger.debug("Processing cmd '%s' with args: %s and kwargs: %s ", command, ', '.join(['{}'.format(a) for a in args]), ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()]))
-                try:
-                    self._commands[command](*args, **kwargs)
-                except Exception:
-                    msg = ("Valve control thread failed to run command '%s' "
-                        "with args: %s and kwargs: %s " %(command,
-                        ', '.join(['{}'.format(a) for a in args]),
-                        ', '.join(['{}:{}'.format(kw, item) for kw, item in kwargs.items()])))
-                    logger.exception(msg)
-
-                    if command == 'connect' or command == 'disconnect':
-                        self.return_queue.append((command, False))
-
-            else:
-                time.sleep(0.01)
+    def _command_failed(self, command, args, kwargs):
+        if command == 'connect' or command == 'disconnect':
+            self._return_value((command, False))
 
-        if self._stop_event.is_set():
-            self._stop_event.clear()
-        else:
-            self._abort()
+    def _cleanup(self):
+        with self._valves_lock:
+            valves = list(self._connected_valves.values())
 
-        for valve in self._connected_valves.values():
+        for valve in valves:
             valve.stop()
 
-        logger.info("Quitting valve control thread: %s", self.name)
+    def _get_device(self, name):
+        return self._connected_valves.get(name)
 
     def _connect_valve(self, device, name, valve_type, **kwargs):
         """
@@ -598,10 +795,12 @@ class ValveCommThread(threading.Thread):
         """
         logger.info("Connecting valve %s", name)
         new_valve = self.known_valves[valve_type](device, name, **kwargs)
-        self._connected_valves[name] = new_valve
+        with self._valves_lock:
+            self._connected_valves[name] = new_valve
+        self.state_cache.invalidate(name)
         logger.debug("Valve %s connected", name)
 
-        self.return_queue.append(('connected', name, True))
+        self._return_value(('connected', name, True))
 
     def _connect_valve_remote(self, device, name, valve_type, **kwargs):
         """
@@ -625,25 +824,31 @@ class ValveCommThread(threading.Thread):
             kwargs['comm_lock'] = self.comm_locks[device]
 
         new_valve = self.known_valves[valve_type](device, name, **kwargs)
-        self._connected_valves[name] = new_valve
-        self.return_queue.append(('connected', name, True))
+        with self._valves_lock:
+            self._connected_valves[name] = new_valve
+        self.state_cache.invalidate(name)
+        self._return_value(('connected', name, True))
 
         logger.debug("Valve %s connected", name)
 
     def _add_valve(self, valve, name, **kwargs):
         logger.info('Adding valve %s', name)
-        self._connected_valves[name] = valve
-        self.return_queue.append((name, 'add', True))
+        with self._valves_lock:
+            self._connected_valves[name] = valve
+        self.state_cache.invalidate(name)
+        self._return_value((name, 'add', True))
         logger.debug('Valve %s added', name)
 
     def _disconnect(self, name):
         logger.info("Disconnecting valve %s", name)
         valve = self._connected_valves[name]
         valve.stop()
-        del self._connected_valves[name]
+        with self._valves_lock:
+            del self._connected_valves[name]
+        self.state_cache.invalidate(name)
         logger.debug("Valve %s disconnected", name)
 
-        self.return_queue.append(('disconnected', name, True))
+        self._return_value(('disconnected', name, True))
 
     def _get_position(self, name):
         """
@@ -653,22 +858,20 @@ class ValveCommThread(threading.Thread):
             in the :py:func:`_connect_fm` method.
         """
         logger.debug("Getting valve %s position", name)
-        valve = self._connected_valves[name]
-        position = valve.get_position()
+        position = self._read_position(name)
         logger.debug("Valve %s position: %s", name, position)
 
-        self.return_queue.append(('position', name, position))
+        self._return_value(('position', name, position))
 
-    def _get_position_multiple(self, names):
+    def _get_position_multiple(self, names=None):
         logger.debug("Getting multiple valve positions")
-        positions = []
-        for name in names:
-            valve = self._connected_valves[name]
-            position = valve.get_position()
+        if names is None:
+            with self._valves_lock:
+                names = list(self._connected_valves.keys())
 
-            positions.append(position)
+        positions = self._map_devices(self._read_position, names)
 
-        self.return_queue.append(('multi_positions', names, positions))
+        self._return_value(('multi_positions', names, positions))
 
     def _get_status(self, name):
         """
@@ -684,7 +887,7 @@ class ValveCommThread(threading.Thread):
         status = valve.get_status()
         logger.debug("Valve %s status: %f", name, status)
 
-        self.return_queue.append(('status', name, status))
+        self._return_value(('status', name, status))
 
     def _set_position(self, name, position):
         """
@@ -699,12 +902,13 @@ class ValveCommThread(threading.Thread):
         logger.debug("Setting valve %s position", name)
         valve = self._connected_valves[name]
         success = valve.set_position(position)
+        self._set_cached_position(name, position, success)
         if success:
             logger.info("Valve %s position set to %i", name, position)
         else:
             logger.info("Failed setting valve %s position to %i", name, position)
 
-        self.return_queue.append(('set_position', name, success))
+        self._return_value(('set_position', name, success))
 
     def _set_position_multiple(self, names, positions):
         logger.debug('Setting multiple valve positions')
@@ -713,6 +917,7 @@ class ValveCommThread(threading.Thread):
             logger.debug("Setting valve %s position", name)
             valve = self._connected_valves[name]
             t_success = valve.set_position(positions[i])
+            self._set_cached_position(name, positions[i], t_success)
             if t_success:
                 logger.info("Valve %s position set to %i", name, positions[i])
             else:
@@ -722,8 +927,33 @@ class ValveCommThread(threading.Thread):
         if all(success):
             logger.info('Set all valve positions successfully')
 
-        self.return_queue.append(('set_position_multi', names, success))
+        self._return_value(('set_position_multi', names, success))
+
+
+    def _read_position(self, name):
+        position = self._connected_valves[name].get_position()
 
+        if position is not None:
+            self.state_cache.update(name, position=position)
+
+        return position
+
+    def _set_cached_position(self, name, position, success):
+        if success:
+            self.state_cache.update(name, position=position)
+        else:
+            self.state_cache.invalidate(name, 'position')
+
+    def _read_state(self, name, fields):
+        values = {}
+
+        for field in fields:
+            if field == 'position':
+                values[field] = self._connected_valves[name].get_position()
+            else:
+                raise KeyError('Unknown valve state field {}'.format(field))
+
+        return values
 
     def _add_comlocks(self, comm_locks):
         self.comm_locks.update(comm_locks)
@@ -733,17 +963,12 @@ class ValveCommThread(threading.Thread):
         Clears the ``command_queue`` and the ``return_queue``.
         """
         logger.info("Aborting valve control thread %s current and future commands", self.name)
-        self.command_queue.clear()
+        self._clear_commands()
         self.return_queue.clear()
 
         self._abort_event.clear()
         logger.debug("Valve control thread %s aborted", self.name)
 
-    def stop(self):
-        """Stops the thread cleanly."""
-        logger.info("Starting to clean up and shut down valve control thread: %s", self.name)
-        self._stop_event.set()
-
 class ValvePanel(wx.Panel):
     """
     This flow meter panel supports standard settings, including connection settings,
@@ -1063,7 +1288,7 @@ class ValveFrame(wx.Frame):
         """
         super(ValveFrame, self).__init__(*args, **kwargs)
         logger.debug('Setting up the ValveFrame')
-        self.valve_cmd_q = deque()
+        self.valve_cmd_q = commthread.CommandQueue()
         self.valve_return_q = deque()
         self.abort_event = threading.Event()
         self.valve_con = ValveCommThread(self.valve_cmd_q, self.valve_return_q,
@@ -36,6 +36,7 @@ class plot_gui(wx.Frame):
         self.flipY = True
         self.swap_xy = False
         self.x = self.y = self.z = None
+        self.mesh = None
         self.manualIntensity = False
         self.plotting = False
         x_step = y_step = None
@@ -43,7 +44,8 @@ class plot_gui(wx.Frame):
             x_step = xlim[2]
         if ylim is not None:
             y_step = ylim[2]
-        self.plotter = Plotter(self.motor_x, self.motor_y, formula, x_step, y_step)
+        self.plotter = Plotter(self.motor_x, self.motor_y, formula, x_step,
+            y_step, xlim=xlim, ylim=ylim)
 
     def initUI(self):
         """Initialize all gui"""
@@ -230,11 +232,52 @@ class plot_gui(wx.Frame):
 
         # Read and update plot
         if self.plotter.read(output):
-            self.update_plot()
+            self.update_plot_data()
 
         self.plotting = False
 
 
+    def update_plot_data(self):
+        """
+        Updates the values of the plotted map in place, which is all that
+        changes when a scan row is added to a map grid of the same size.
+        If there is no plot yet, or the grid changed size, the map is
+        replotted with :py:meth:`update_plot`.
+        """
+        z = self.plotter.getZ()
+
+        if (self.mesh is None or self.z is None or z is None
+            or z.shape != self.z.shape):
+            self.update_plot()
+            return
+
+        self.z = z
+
+        self.mesh.set_array(self._scale_intensity(self.z).ravel())
+        self.mesh.autoscale()
+
+        self.canvas.draw_idle()
+
+    def _scale_intensity(self, z):
+        """
+        Clips the map values to the min and max intensity, as a percentage
+        of the range of the values. Positions that haven't been measured
+        yet are masked.
+        """
+        z = np.copy(z)
+        minInt = self.minInt.GetValue()
+        maxInt = self.maxInt.GetValue()
+        if (minInt != 0 or maxInt != 0) and not np.all(np.isnan(z)):
+            min_val = np.nanmin(z)
+            max_val = np.nanmax(z)
+            ran = max_val - min_val
+            minInt = min_val + ran * minInt / 100.
+            maxInt = min_val + ran * maxInt / 100.
+            z = np.clip(z, minInt, maxInt)
+            z -= min_val
+
+        return np.ma.masked_invalid(z)
+
     def update_plot(self, e=None):
         """
         Get x,y,z from Plotter and plot
@@ -245,25 +288,14 @@ class plot_gui(wx.Frame):
             self.y, self.x, self.z = self.plotter.getXYZ()
 
         if self.x is not None:
-            z = np.copy(self.z)
-            minInt = self.minInt.GetValue()
-            maxInt = self.maxInt.GetValue()
-            if minInt != 0 or maxInt != 0:
-                min_val = z.min()
-                max_val = z.max()
-                ran = max_val - min_val
-                minInt = min_val + ran * minInt / 100.
-                maxInt = min_val + ran * maxInt / 100.
-                z[z > maxInt] = maxInt
-                z[z < minInt] = minInt
-                z -= min_val
+            z = self._scale_intensity(self.z)
 
             xlabel = self.axes.get_xlabel()
             ylabel = self.axes.get_ylabel()
             title = self.axes.get_title()
 
             self.axes.cla()
-            self.axes.pcolormesh(self.x, self.y, z, cmap=str(self.colors.GetStringSelection()))
+            self.mesh = self.axes.pcolormesh(self.x, self.y, z, cmap=str(self.colors.GetStringSelection()))
 
             self.axes.set_xlabel(xlabel)
             self.axes.set_ylabel(ylabel)
@@ -1,4 +1,3 @@
-from os import listdir
 from os.path import join
 from threading import Thread
 
@@ -7,6 +6,7 @@ import wx
 from plot_gui import plot_gui
 from ..utils.formula import calculate
 from ..utils.Plotter import get_cols
+from ..utils.scanfile import find_scan_files
 
 class read_gui(wx.Frame):
     """GUI for scan output file reader"""
@@ -77,30 +77,18 @@ class read_gui(wx.Frame):
         print(str(path+ " is selected."))
 
         # Get columns from a file
-        all_files = listdir(path)
-        selected_file = ""
-        for f in all_files:
-            if '.0' in f and f.find('.') == f.rfind('.'):
-                self.file_name = f[:f.find('.')]
-                selected_file = f
-                break
-
-        if len(selected_file) < 0:
+        self.file_name, self.files = find_scan_files(path)
+
+        if self.file_name is None:
             print("Error : No file")
             return
 
         self.filename_widget.SetLabelText(str(self.file_name))
 
         # Get all columns
-        self.columns = get_cols(join(path, selected_file))
+        self.columns = get_cols(join(path, self.files[0]))
         self.all_scalers.SetLabelText(", ".join(self.columns))
 
-        self.files = []
-        for f in all_files:
-            if self.file_name in f and f.find('.') == f.rfind('.'):
-                self.files.append(f)
-        self.files = sorted(self.files)
-
         return
 
     def plotPressed(self, e):
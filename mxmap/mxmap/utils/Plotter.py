@@ -1,36 +1,64 @@
 from os.path import exists
 
-import pandas as pd
 import numpy as np
 
 from formula import calculate
+from scanfile import read_scan, get_columns
 
 class Plotter(object):
     """
-    A class to process scan data from a :mod:`Scanner` scan, and send it to a plot
+    A class to process scan data from a :mod:`Scanner` scan, and send it to a plot.
+
+    The data are kept in a 2D grid for each column, indexed by (row, column)
+    positions ``start + i*step`` along y and x. Each data file (scan row)
+    read is put into the grid in place, and the plot formula is only
+    recalculated for the rows that changed.
     """
-    def __init__(self, motor_x, motor_y, formula, x_step=None, y_step=None, columns=None):
+    def __init__(self, motor_x, motor_y, formula, x_step=None, y_step=None,
+        columns=None, xlim=None, ylim=None):
         """
         Initializes the plotter
 
         :param str motor_x: The x motor name.
         :param str motor_y: The y motor name.
         :param str formula: The plot formula.
-        :param float x_step: The step size in x.
-        :param float y_step: The step size in y.
+        :param float x_step: The step size in x. If None, it is taken from
+            the data.
+        :param float y_step: The step size in y. If None, it is taken from
+            the data.
         :param columns: The column names. Defaults to None.
+        :param tuple xlim: The x (start, end, step) of the scan, used to
+            allocate the whole grid up front. Defaults to None.
+        :param tuple ylim: The y (start, end, step) of the scan, used to
+            allocate the whole grid up front. Defaults to None.
         """
         self.motor_x = motor_x
         self.motor_y = motor_y
-        self.formula = formula
+        self._formula = formula
         self.columns = columns
-        self.scandata = None
         self.x_step = x_step
         self.y_step = y_step
 
+        self._x_axis = GridAxis(x_step, xlim)
+        self._y_axis = GridAxis(y_step, ylim)
+
+        self._data = {}
+        self._z = None
+        self._z_valid = False
+
+    @property
+    def formula(self):
+        """The plot formula. Setting it recalculates the whole map."""
+        return self._formula
+
+    @formula.setter
+    def formula(self, formula):
+        self._formula = formula
+        self._z_valid = False
+
     def read(self, full_path):
         """
-        Read scan data file and encapsulate data
+        Read a scan data file and put the data in the map grid.
 
         :param str full_path: The path to the scan data file.
 
@@ -41,30 +69,45 @@ class Plotter(object):
             print(str(full_path)+ " does not exist")
             return False
 
-        # Load data
-        data = np.loadtxt(full_path)
+        # Load data, only parsing what is new since the last read
+        all_columns, data = read_scan(full_path)
+
+        if data.shape[0] == 0:
+            return True
 
         # Number of column
         n_cols = data.shape[1]
 
-        # Get Column names
-        self.columns = get_cols(full_path)
+        # Get Column names, without the detectors
+        columns = all_columns[:n_cols]
 
-        # Remove detectors
-        self.columns = self.columns[:n_cols]
+        if columns != self.columns:
+            if self._data:
+                self._reset()
+            self.columns = columns
 
-        # Put/Add data to pandas dataframe
-        scandata = pd.DataFrame(data, columns=self.columns)
-        if self.scandata is None:
-            self.scandata = scandata
-        else:
-            self.scandata = pd.concat([self.scandata, scandata])
+        x_vals = data[:, self.columns.index(self.motor_x)]
+        y_vals = data[:, self.columns.index(self.motor_y)]
+
+        self._fit(self._x_axis, x_vals, 1)
+        self._fit(self._y_axis, y_vals, 0)
+
+        ix = self._x_axis.indices(x_vals)
+        iy = self._y_axis.indices(y_vals)
+
+        if not self._data:
+            shape = (self._y_axis.capacity, self._x_axis.capacity)
+            for c in self.columns:
+                self._data[c] = np.full(shape, np.nan)
+            self._z = np.full(shape, np.nan)
 
-        # sort data by motory and motorx position
-        self.scandata = self.scandata.sort_values(by=[self.motor_y, self.motor_x]) # TODO
+        # Later points replace earlier points at the same position
+        for j, c in enumerate(self.columns):
+            self._data[c][iy, ix] = data[:, j]
+
+        if self._z_valid:
+            self._calc_z(np.unique(iy))
 
-        # Remove duplicate data
-        self.scandata = self.scandata.drop_duplicates(keep='first')
         return True
 
     def getXYZ(self):
@@ -73,61 +116,291 @@ class Plotter(object):
 
         :returns: Three items, either the x and y coordinates as the result
             of a np.meshgrid call and the intensity value calculated by
-            the ``formula``, in a grid. If the scan data is not there, it returns
-            None three times.
+            the ``formula``, in a grid. Positions that haven't been read
+            are NaN. If the scan data is not there, it returns None three
+            times.
         :rtype: np.array, np.array, np.array
         """
+        z = self.getZ()
 
-        if self.scandata is not None:
-            scan_data = self.scandata.copy()
-            x = sorted(list(set(np.array(scan_data[self.motor_x]))))
-            y = sorted(list(set(np.array(scan_data[self.motor_y]))))
+        if z is None:
+            return None, None, None
 
-            # Set x and y step if they're available
-            if self.x_step is not None:
-                xs = self.x_step
-            else:
-                if len(x) > 1:
-                    xs = x[1] - x[0]
-                else:
-                    xs = 1
+        # Use the x step for y if there is only one y position
+        xs = self._x_axis.step if self._x_axis.step is not None else 1
+        ys = self._y_axis.step if self._y_axis.step is not None else xs
 
-            if self.y_step is not None:
-                ys = self.y_step
-            else:
-                if len(y) > 1:
-                    ys = y[1] - y[0]
-                else:
-                    ys = xs
+        x = self._x_axis.edges(xs)
+        y = self._y_axis.edges(ys)
 
-            # Cauculate new data from formula
-            d = {}
-            for c in self.columns:
-                d[c] = np.array(scan_data[c])
+        x_coor, y_coor = np.meshgrid(x, y)
 
-            z = calculate(self.formula, d)
+        return x_coor, y_coor, z
 
-            # Reshape for displaying
-            z = np.reshape(z, (len(y), len(x)))
+    def getZ(self):
+        """
+        Returns the map values calculated by the ``formula``, in the same
+        grid as :py:meth:`getXYZ`, without making the coordinates. This is
+        all that changes when a new row is read into a grid that didn't
+        have to grow.
 
-            z[np.isinf(z)] = 0.
+        :rtype: np.array
+        """
+        if not self._data:
+            return None
 
-            # Add 1 row and 1 column to support pcolormesh (pcolormesh requires 1 extra row and column to display)
-            if xs > 0:
-                x.append(x[-1] + xs)
-            else:
-                x.insert(0, x[0] + xs)
+        if not self._z_valid:
+            self._calc_z()
+
+        z = self._z[:self._y_axis.size, :self._x_axis.size]
+
+        # Coordinates are increasing, so negative step axes are reversed
+        if self._y_axis.step is not None and self._y_axis.step < 0:
+            z = z[::-1, :]
+        if self._x_axis.step is not None and self._x_axis.step < 0:
+            z = z[:, ::-1]
+
+        return np.copy(z)
 
-            if ys > 0:
-                y.append(y[-1] + ys)
+    def _calc_z(self, rows=None):
+        """Calculates the formula for the given grid rows, or all rows."""
+        if rows is None:
+            rows = slice(0, self._y_axis.size)
+            self._z_valid = True
+
+        d = {}
+        for c in self.columns:
+            d[c] = self._data[c][rows, :self._x_axis.size]
+
+        z = np.asarray(calculate(self.formula, d), dtype=float)
+
+        z[np.isinf(z)] = 0.
+
+        self._z[rows, :self._x_axis.size] = z
+
+    def _fit(self, axis, values, dim):
+        """
+        Extends the axis and grids to hold ``values``. If the axis step was
+        taken from the data and the values aren't on it, the data read so
+        far are put on a new axis that holds both.
+        """
+        if not axis.fits(values):
+            old = self._filled_positions()
+            axis.refit(values, old[1-dim])
+            self._regrid(old)
+
+        before, after = axis.extend(values)
+
+        if self._data and (before > 0 or after > 0):
+            self._grow(dim, before, axis.capacity)
+
+    def _grow(self, dim, before, capacity):
+        """Resizes the grids along ``dim``, shifting the data by ``before``."""
+        arrays = [self._z] + [self._data[c] for c in self.columns]
+        new_arrays = []
+
+        for arr in arrays:
+            shape = list(arr.shape)
+            old_size = shape[dim]
+            shape[dim] = capacity
+            new_arr = np.full(shape, np.nan)
+
+            if dim == 0:
+                new_arr[before:before+old_size, :] = arr
             else:
-                y.insert(0, y[0] + ys)
+                new_arr[:, before:before+old_size] = arr
+
+            new_arrays.append(new_arr)
+
+        self._z = new_arrays[0]
+        for c, arr in zip(self.columns, new_arrays[1:]):
+            self._data[c] = arr
+
+    def _filled_positions(self):
+        """Returns the x and y positions and values of every point read."""
+        if not self._data:
+            return np.array([]), np.array([]), {}
+
+        ny = self._y_axis.size
+        nx = self._x_axis.size
+
+        filled = np.zeros((ny, nx), dtype=bool)
+        for c in self.columns:
+            filled |= ~np.isnan(self._data[c][:ny, :nx])
+
+        iy, ix = np.nonzero(filled)
+
+        values = dict((c, self._data[c][iy, ix]) for c in self.columns)
+
+        return self._x_axis.positions(ix), self._y_axis.positions(iy), values
+
+    def _regrid(self, old):
+        """Puts the points from :py:meth:`_filled_positions` on new grids."""
+        x_vals, y_vals, values = old
+
+        self._data = {}
+        self._z_valid = False
 
-            x_coor, y_coor = np.meshgrid(x, y)
+        if len(x_vals) == 0:
+            return
 
-            return x_coor, y_coor, z
+        self._x_axis.extend(x_vals)
+        self._y_axis.extend(y_vals)
+
+        ix = self._x_axis.indices(x_vals)
+        iy = self._y_axis.indices(y_vals)
+
+        shape = (self._y_axis.capacity, self._x_axis.capacity)
+        for c in self.columns:
+            self._data[c] = np.full(shape, np.nan)
+            self._data[c][iy, ix] = values[c]
+        self._z = np.full(shape, np.nan)
+
+    def _reset(self):
+        """Clears the data, e.g. when the file columns change."""
+        self._data = {}
+        self._z = None
+        self._z_valid = False
+        self._x_axis.clear()
+        self._y_axis.clear()
+
+class GridAxis(object):
+    """
+    The positions along one axis of the map grid, ``start + i*step`` for
+    ``i`` in ``range(size)``. Storage is allocated ``capacity`` positions
+    at a time, and grows by doubling when positions are added after the end.
+    """
+    def __init__(self, step=None, lim=None):
+        """
+        :param float step: The step size. If None, it is taken from the data.
+        :param tuple lim: The (start, end, step) of the scan. If given, the
+            whole axis is allocated up front, with the same number of
+            points as the :mod:`Scanner` scan.
+        """
+        self.fixed_step = step is not None
+        self._lim = lim
+        self._init_step = step
+        self.clear()
+
+    def clear(self):
+        """Removes all positions from the axis."""
+        self.step = self._init_step
+        self.start = None
+        self.size = 0
+        self.capacity = 0
+
+        lim = self._lim
+
+        if lim is not None and lim[2]:
+            self.step = lim[2]
+            self.fixed_step = True
+            self.start = lim[0]
+            self.size = abs(int(np.floor((lim[1] - lim[0]) / lim[2]))) + 1
+            self.capacity = self.size
+
+    def fits(self, values):
+        """
+        Returns False if the step was taken from the data and the values
+        aren't close to positions on the axis.
+        """
+        if self.fixed_step or self.start is None or self.step is None:
+            return True
+
+        frac = (np.asarray(values) - self.start)/self.step
+        return bool(np.all(np.abs(frac - np.round(frac)) < 0.01))
+
+    def refit(self, values, positions):
+        """Makes a new axis holding both the values and the old positions."""
+        all_vals = np.unique(np.concatenate([np.asarray(values, dtype=float),
+            np.asarray(positions, dtype=float)]))
+
+        self.start = None
+        self.size = 0
+        self.capacity = 0
+
+        if len(all_vals) > 1:
+            self.step = np.min(np.diff(all_vals))
         else:
-            return None, None, None
+            self.step = None
+
+    def extend(self, values):
+        """
+        Extends the axis to include the values.
+
+        :returns: The number of positions added before the start, and after
+            the end.
+        :rtype: tuple
+        """
+        values = np.asarray(values, dtype=float)
+
+        if self.start is None:
+            # Step from the data, as the smallest spacing of the values
+            unique = np.unique(values)
+            if self.step is None and len(unique) > 1:
+                self.step = unique[1] - unique[0]
+
+            self.start = unique[0] if self.step is None or self.step > 0 else unique[-1]
+            self.size = 1
+            self.capacity = 1
+
+        if self.step is None:
+            others = values[values != self.start]
+            if len(others) == 0:
+                return 0, 0
+            self.step = abs(others[0] - self.start)
+
+        idx = self._raw_indices(values)
+
+        before = max(-int(idx.min()), 0)
+        after = max(int(idx.max()) + 1 - self.size, 0)
+
+        if before > 0:
+            self.start = self.start - before*self.step
+            self.size += before
+            self.capacity = max(self.capacity + before, self.size)
+
+        if after > 0:
+            self.size += after
+
+        if self.size > self.capacity:
+            self.capacity = max(self.size, 2*self.capacity)
+            after = max(after, 1)
+
+        return before, after
+
+    def indices(self, values):
+        """Returns the grid index for each value."""
+        if self.step is None:
+            return np.zeros(len(values), dtype=int)
+
+        return self._raw_indices(values)
+
+    def positions(self, indices):
+        """Returns the positions for grid indices."""
+        if self.step is None:
+            return np.full(len(indices), self.start, dtype=float)
+
+        return self.start + np.asarray(indices)*self.step
+
+    def edges(self, step):
+        """
+        Returns the increasing positions of the axis, with one more
+        position added for ``pcolormesh``, which needs the cell edges.
+
+        :param float step: The step size used for the extra position.
+        """
+        pos = self.positions(np.arange(self.size))
+
+        if step > 0:
+            pos = np.append(pos, pos[-1] + step)
+        else:
+            pos = pos[::-1]
+            pos = np.insert(pos, 0, pos[0] + step)
+
+        return pos
+
+    def _raw_indices(self, values):
+        return np.round((np.asarray(values, dtype=float) - self.start)/self.step).astype(int)
 
 def get_cols(full_path):
     """
@@ -138,19 +411,4 @@ def get_cols(full_path):
     :returns: all column names
     :rtype: list
     """
-    file = open(full_path, 'r')
-    # Get column names
-    cols = []
-    for line in file:
-        # Go to each line and file '%device'
-        if "%devices" in line:
-            toks = line.split()
-            equal_ind = toks.index('=')
-            for i in range(equal_ind + 1, len(toks)):
-                c = toks[i]
-                if len(c) > 0:
-                    c = c.rstrip('\n')
-                    c = c.rstrip(';')
-                    cols.append(c)
-            break
-    return cols
+    return get_columns(full_path)
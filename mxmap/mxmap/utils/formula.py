@@ -1,3 +1,150 @@
+import ast
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Functions that can be called in a formula
+_functions = {
+    'abs'   : np.abs,
+    'sqrt'  : np.sqrt,
+    'exp'   : np.exp,
+    'log'   : np.log,
+    'log10' : np.log10,
+    'sin'   : np.sin,
+    'cos'   : np.cos,
+    'tan'   : np.tan,
+    }
+
+_operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+    ast.FloorDiv, ast.UAdd, ast.USub)
+
+# numexpr doesn't do floor division
+_numexpr_operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+    ast.UAdd, ast.USub)
+
+# Arrays smaller than this are faster with numpy than numexpr
+_numexpr_min_size = 10000
+
+_cache = {}
+_max_cache_size = 100
+
+class Formula(object):
+    """
+    A plot formula, parsed and checked once so that it can be evaluated
+    quickly on each plot update. Only numbers, variable names, arithmetic
+    operators and the functions in ``_functions`` are allowed.
+    """
+    def __init__(self, formula):
+        """
+        :param str formula: Formula e.g. "(x+y)/10"
+
+        :raises SyntaxError: If the formula isn't a valid expression.
+        :raises ValueError: If the formula has anything other than numbers,
+            names, arithmetic and the allowed functions.
+        """
+        self.formula = formula
+
+        tree = ast.parse(formula.strip(), mode='eval')
+
+        self.names = set()
+        self._use_numexpr = numexpr is not None
+
+        for node in ast.walk(tree.body):
+            self._check(node)
+
+        self._code = compile(tree, '<formula>', 'eval')
+
+    def __call__(self, d):
+        """
+        Evaluates the formula.
+
+        :param dict d: Formula variables e.g. {'x':10, 'y':20}. The values
+            can be numbers or numpy arrays.
+
+        :returns: calculated result e.g. (10+20)/10 = 3
+        :rtype: float or np.array
+
+        :raises NameError: If a name in the formula isn't in ``d``.
+        """
+        missing = [name for name in self.names if name not in d]
+        if missing:
+            raise NameError("name '{}' is not defined".format(missing[0]))
+
+        variables = dict((name, d[name]) for name in self.names)
+
+        # numexpr is only worth it for large arrays, and it doesn't raise
+        # ZeroDivisionError for numbers like python does
+        if (self._use_numexpr and any(isinstance(val, np.ndarray) and
+            val.size >= _numexpr_min_size for val in variables.values())):
+            try:
+                return numexpr.evaluate(self.formula.strip(),
+                    local_dict=variables, global_dict={})
+            except Exception:
+                self._use_numexpr = False
+
+        variables.update(_functions)
+
+        return eval(self._code, {'__builtins__': {}}, variables)
+
+    def _check(self, node):
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            if not isinstance(node.op, _operators):
+                raise ValueError('Operator {} is not allowed in a formula'.format(
+                    type(node.op).__name__))
+            if not isinstance(node.op, _numexpr_operators):
+                self._use_numexpr = False
+
+        elif isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.func.id not in _functions
+                or node.keywords or len(node.args) != 1):
+                raise ValueError('Only the functions {} can be called in a '
+                    'formula, with one argument'.format(', '.join(sorted(_functions))))
+
+        elif isinstance(node, ast.Name):
+            if node.id not in _functions:
+                self.names.add(node.id)
+
+        elif _is_number(node):
+            pass
+
+        elif not isinstance(node, (ast.Load,) + _operators):
+            raise ValueError('{} is not allowed in a formula'.format(
+                type(node).__name__))
+
+def _is_number(node):
+    if hasattr(ast, 'Constant'):
+        return (isinstance(node, ast.Constant)
+            and isinstance(node.value, (int, float, complex))
+            and not isinstance(node.value, bool))
+
+    return isinstance(node, ast.Num)
+
+def compile_formula(formula):
+    """
+    Returns the parsed :py:class:`Formula` for a formula string, from a
+    cache of the formulas already used.
+
+    :param str formula: Formula e.g. "(x+y)/10"
+
+    :rtype: Formula
+    """
+    try:
+        return _cache[formula]
+    except KeyError:
+        pass
+
+    if len(_cache) >= _max_cache_size:
+        _cache.clear()
+
+    compiled = Formula(formula)
+    _cache[formula] = compiled
+
+    return compiled
+
 def calculate(formula, d):
     """
     Calculate value from string of formula
@@ -8,5 +155,4 @@ def calculate(formula, d):
     :returns: calculated result e.g. (10+20)/10 = 3
     :rtype: float
     """
-    locals().update(d)
-    return eval(formula)
+    return compile_formula(formula)(d)
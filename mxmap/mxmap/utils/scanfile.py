@@ -0,0 +1,265 @@
+from collections import OrderedDict
+from io import BytesIO
+import os
+import re
+import threading
+
+import numpy as np
+
+# Most recently used last, so the least recently used are dropped first
+_files = OrderedDict()
+_dirs = OrderedDict()
+_lock = threading.Lock()
+
+_max_files = 20
+_max_dirs = 20
+
+_scan_file_re = re.compile(r'^([^.]+)\.(\d+)$')
+
+# From numpy 1.23 loadtxt is written in C, before that it is slower than
+# splitting and converting all of the values at once
+_c_loadtxt = tuple(int(v) for v in np.__version__.split('.')[:2]) >= (1, 23)
+
+class ScanFile(object):
+    """
+    A scan data file, as written by :mod:`Scanner`. The header is parsed once,
+    and the data are kept so that when the file is read again only rows
+    appended since the last read are parsed. The file is read again from
+    the start if it is replaced or gets shorter.
+    """
+    def __init__(self, full_path):
+        """
+        :param str full_path: The path to the scan data file.
+        """
+        self.full_path = full_path
+        self._reset()
+
+    def read(self):
+        """
+        Reads anything new in the file.
+
+        :returns: The column names and the data, with a row for each
+            complete line of data in the file.
+        :rtype: list, np.array
+
+        :raises OSError: If the file can't be read.
+        """
+        st = os.stat(self.full_path)
+        key = (st.st_mtime, st.st_size)
+
+        if key == self._key and st.st_ino == self._ino:
+            return self.columns, self.data
+
+        if (st.st_size < self._offset or st.st_mtime < self._key[0]
+            or st.st_ino != self._ino):
+            self._reset()
+            self._ino = st.st_ino
+
+        with open(self.full_path, 'rb') as f:
+            f.seek(self._offset)
+            new_bytes = f.read()
+
+        if not self._header_done:
+            new_bytes = self._read_header(new_bytes)
+
+        # Complete lines are only parsed once, the rest is read again next time
+        end = new_bytes.rfind(b'\n') + 1
+        self._offset += end
+
+        rows = _parse_rows(new_bytes[:end], self._n_cols)
+
+        if rows.shape[0] > 0:
+            if self._n_cols is None or self._rows.shape[0] == 0:
+                self._n_cols = rows.shape[1]
+                self._rows = rows
+            else:
+                self._rows = np.concatenate((self._rows, rows))
+
+        # The last line of a finished file may not end with a newline
+        tail = _parse_tail(new_bytes[end:], self._n_cols)
+
+        if tail is not None:
+            if self._rows.shape[0] == 0:
+                self.data = tail
+            else:
+                self.data = np.concatenate((self._rows, tail))
+        else:
+            self.data = self._rows
+
+        self._key = key
+
+        return self.columns, self.data
+
+    def _read_header(self, new_bytes):
+        """
+        Parses the comment lines at the start of the file, and returns the
+        bytes after them.
+        """
+        pos = 0
+
+        while pos < len(new_bytes):
+            end = new_bytes.find(b'\n', pos)
+
+            if end == -1:
+                # The line isn't finished, so parse it next time
+                break
+
+            line = new_bytes[pos:end+1]
+
+            if not line.lstrip().startswith(b'#'):
+                self._header_done = True
+                break
+
+            if b'%devices' in line:
+                self.columns = _parse_devices(line.decode('utf-8', 'replace'))
+
+            pos = end + 1
+
+        self._offset += pos
+
+        return new_bytes[pos:]
+
+    def _reset(self):
+        self.columns = []
+        self.data = np.empty((0, 0))
+        self._rows = self.data
+        self._key = (0, -1)
+        self._offset = 0
+        self._header_done = False
+        self._n_cols = None
+        self._ino = None
+
+def _parse_devices(line):
+    """Gets the column names from the ``%devices`` header line."""
+    cols = []
+    toks = line.split()
+    equal_ind = toks.index('=')
+    for i in range(equal_ind + 1, len(toks)):
+        c = toks[i]
+        if len(c) > 0:
+            c = c.rstrip('\n')
+            c = c.rstrip(';')
+            cols.append(c)
+    return cols
+
+def _parse_rows(raw, n_cols):
+    """
+    Parses whitespace separated numbers, a row per line, in bulk. Uses
+    ``np.loadtxt`` if it is fast, or if there are comments or the lines
+    aren't all the same length.
+    """
+    if len(raw.strip()) == 0:
+        return np.empty((0, n_cols if n_cols is not None else 0))
+
+    if not _c_loadtxt and b'#' not in raw:
+        if n_cols is None:
+            n_cols = len(raw.split(b'\n', 1)[0].split())
+
+        values = np.array(raw.split(), dtype=float)
+
+        if n_cols > 0 and values.size % n_cols == 0:
+            rows = values.reshape(-1, n_cols)
+
+            if rows.shape[0] == len(raw.strip().splitlines()):
+                return rows
+
+    return np.loadtxt(BytesIO(raw), ndmin=2)
+
+def _parse_tail(raw, n_cols):
+    """
+    Parses a line without a newline at the end, if it is a whole row of data.
+    """
+    toks = raw.split()
+
+    if len(toks) == 0 or b'#' in raw or (n_cols is not None and len(toks) != n_cols):
+        return None
+
+    try:
+        return np.array(toks, dtype=float).reshape(1, -1)
+    except ValueError:
+        return None
+
+def read_scan(full_path):
+    """
+    Reads a scan data file, using the cached data from previous reads of
+    the same file if it hasn't changed. If it has more data than before,
+    only the new lines are read.
+
+    :param str full_path: The path to the scan data file.
+
+    :returns: The column names (including any detectors that don't have
+        data columns) and the data, with a row for each scan point.
+    :rtype: list, np.array
+    """
+    with _lock:
+        try:
+            scan_file = _files.pop(full_path)
+        except KeyError:
+            scan_file = ScanFile(full_path)
+
+        _add_cached(_files, full_path, scan_file, _max_files)
+
+        return scan_file.read()
+
+def get_columns(full_path):
+    """
+    Gets the column names of a scan data file, from the cache if it has
+    been read before and hasn't changed.
+
+    :param str full_path: The path to the scan data file.
+
+    :rtype: list
+    """
+    return list(read_scan(full_path)[0])
+
+def find_scan_files(path):
+    """
+    Finds the scan data files in a directory. These are named as
+    ``<prefix>.<number>``, and the prefix is taken from the first file
+    numbered from 0. The directory is only listed again if it changed.
+
+    :param str path: The directory.
+
+    :returns: The prefix and the sorted file names with that prefix. The
+        prefix is None if there are no scan files.
+    :rtype: str, list
+    """
+    mtime = os.stat(path).st_mtime
+
+    with _lock:
+        cached = _dirs.pop(path, None)
+
+        if cached is not None and cached[0] == mtime:
+            _add_cached(_dirs, path, cached, _max_dirs)
+            prefix, files = cached[1]
+            return prefix, list(files)
+
+    scans = {}
+    for f in sorted(os.listdir(path)):
+        match = _scan_file_re.match(f)
+        if match is not None:
+            scans.setdefault(match.group(1), []).append(f)
+
+    prefix = None
+    for f in sorted(sum(scans.values(), [])):
+        if f.split('.')[1].startswith('0'):
+            prefix = f.split('.')[0]
+            break
+
+    files = scans.get(prefix, [])
+
+    with _lock:
+        _add_cached(_dirs, path, (mtime, (prefix, files)), _max_dirs)
+
+    return prefix, list(files)
+
+def _add_cached(cache, key, value, max_size):
+    """
+    Adds a value as the most recently used in a cache, dropping the least
+    recently used values if the cache is full. Call with ``_lock`` held.
+    """
+    cache.pop(key, None)
+    cache[key] = value
+
+    while len(cache) > max_size:
+        cache.popitem(last=False)